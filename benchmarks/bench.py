@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the formatting and parsing hot paths of xmpp-ircd
+
+Drives ClientSession and XmppComponent with synthetic stanzas and IRC lines,
+the IRC side is a local socketpair and the XMPP side a connection that only
+counts bytes, nothing touches the network. Every benchmark reports the best
+ops/sec of a few rounds and the net number of gc tracked (container) objects
+allocated per operation, strings are not tracked by gc and don't show up.
+
+    ./benchmarks/bench.py                       # run everything
+    ./benchmarks/bench.py --occupants=5000 selfjoin
+    ./benchmarks/bench.py --save-baseline=benchmarks/baseline.json
+    ./benchmarks/bench.py --baseline=benchmarks/baseline.json
+
+With --baseline the results are compared against a saved run and the exit
+status is 1 when a benchmark lost more throughput than --tolerance allows.
+"""
+
+import errno
+import gc
+import getopt
+import imp
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import time
+
+from xmpp import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+
+SERVER = 'irc.example.com'
+MUC_SERVER = 'chat.example.com'
+ROOM = JID('bench@%s' % MUC_SERVER)
+
+class NullConnection(object):
+    """Stands in for the component socket, counts what would be written"""
+
+    def __init__(self):
+        self.written = 0
+
+    def send(self, data):
+        self.written += len(data)
+
+class NullDispatcher(object):
+    def __init__(self):
+        self._metastream = Node('stream:stream')
+
+class NullClient(object):
+    """Just enough of xmpp.Component for XmppComponent to run without a
+    server"""
+
+    Namespace = 'jabber:component:accept'
+    Server = SERVER
+
+    def __init__(self):
+        self.handlers = {}
+        self.Connection = NullConnection()
+        self.Dispatcher = NullDispatcher()
+
+    def RegisterHandler(self, name, handler, *args, **kwargs):
+        self.handlers[name] = handler
+
+    def Process(self, timeout=0):
+        return True
+
+    def disconnect(self):
+        pass
+
+class Gateway(object):
+    """A component with IRC sessions attached to a loop that is never run,
+    queued output is pushed through the sockets by drain()"""
+
+    def __init__(self, fanout=False):
+        logger = logging.getLogger('bench')
+        logger.setLevel(logging.WARNING)
+        if not logger.handlers:
+            logger.addHandler(logging.NullHandler())
+        options = dict(xmppircd.DEFAULTOPTIONS)
+        options['sendq'] = 1 << 30
+        # measure the handlers, not the flood control
+        options['flood'] = {}
+        options['global_flood'] = {}
+        options['max_joining'] = 0
+        options['fanout'] = fanout
+        self.client = NullClient()
+        self.component = xmppircd.XmppComponent(self.client, logger, options)
+        # stanzas are serialized by the writer thread, keep it out of the
+        # measurements
+        self.component.writer.stop()
+        self.loop = xmppircd.EventLoop(logger, 'bench')
+        # IQ request timeouts are scheduled on the component's loop
+        self.component.loop = self.loop
+        self.peers = {}
+
+    def session(self, nick):
+        """Connect and register an IRC client"""
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(0)
+        session = xmppircd.ClientSession(ours, 6667, SERVER, MUC_SERVER, self.component)
+        session.start(self.loop)
+        self.peers[session] = theirs
+        session.handleLine('NICK %s' % nick)
+        session.handleLine('USER %s 0 * :%s' % (nick, nick))
+        self.drain()
+        return session
+
+    def presence(self, session, nick, role='participant', typ=None, statuscode=None, newnick=None):
+        """Build the presence of a room occupant as the MUC sends it"""
+        pres = Presence(to=session.JID, frm='%s/%s' % (ROOM, nick), typ=typ)
+        x = pres.setTag('x', namespace=NS_MUC_USER)
+        item = x.setTag('item', {'affiliation': 'none', 'role': role})
+        if newnick is not None:
+            item.setAttr('nick', newnick)
+        if statuscode is not None:
+            x.setTag('status', {'code': statuscode})
+        return pres
+
+    def groupchat(self, session, nick, text):
+        return Message(to=session.JID, frm='%s/%s' % (ROOM, nick), typ='groupchat', body=text)
+
+    def join(self, session, occupants):
+        """Join the benchmark room with the given number of other occupants"""
+        session.handleLine('JOIN #%s' % ROOM.getNode())
+        for i in xrange(occupants):
+            self.component.presenceHandler(None, self.presence(session, 'user%d' % i))
+        self.component.presenceHandler(None, self.presence(session, session.nickname, role='moderator'))
+        self.drain()
+
+    def drain(self):
+        """Run the queued flushes and read everything the sessions wrote"""
+        # batched MODE lines wait for a timer on the loop, flush them here
+        for room in self.component.rooms.values():
+            self.component.flushModes(room)
+        self.loop.runCallbacks()
+        self.component.writer.queue.clear()
+        for session, peer in self.peers.items():
+            while True:
+                try:
+                    if not peer.recv(1 << 20):
+                        break
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    if not session.outbuf or session.closed:
+                        break
+                    session.writeToIRC()
+
+    def close(self):
+        for session, peer in self.peers.items():
+            session.loop.unregister(session)
+            session.handleClose()
+            peer.close()
+        self.peers.clear()
+        self.component.writer.queue.clear()
+
+# every benchmark returns (operation count, function doing them) from its
+# setup, only the returned function is timed
+
+def benchPRIVMSG(occupants):
+    """ClientSession.ircCommandPRIVMSG for groupchat lines"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, 10)
+    jids = [JID('%s/user%d' % (ROOM, i % 10)) for i in xrange(2000)]
+    def run():
+        for jid in jids:
+            session.ircCommandPRIVMSG(jid, True, False, u'hello everyone, how is it going today?')
+        gw.drain()
+    return len(jids), run, gw
+
+def benchPRIVMSGDELAYED(occupants):
+    """ClientSession.ircCommandPRIVMSG for multi-line delayed history"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, 10)
+    jids = [JID('%s/user%d' % (ROOM, i % 10)) for i in xrange(1000)]
+    stamp = 1577934245.0
+    def run():
+        for jid in jids:
+            session.ircCommandPRIVMSG(jid, True, False, u'first line\n/me second line', stamp)
+        gw.drain()
+    return len(jids), run, gw
+
+def benchDELAYED(occupants):
+    """messageHandler for MUC history with XEP-0203 delays, stamp parsing included"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, 10)
+    messages = list()
+    for i in xrange(1000):
+        mess = gw.groupchat(session, 'user%d' % (i % 10), u'history line %d' % i)
+        mess.setTag('delay', namespace='urn:xmpp:delay',
+                    attrs={'stamp': '2020-01-02T03:%02d:%02d.%03dZ' % (i // 60 % 60, i % 60, i)})
+        messages.append(mess)
+    def run():
+        for mess in messages:
+            gw.component.messageHandler(None, mess)
+        gw.drain()
+    return len(messages), run, gw
+
+def groupchatCopies(fanout):
+    gw = Gateway(fanout)
+    sessions = [gw.session('irc%d' % i) for i in xrange(20)]
+    for session in sessions:
+        gw.join(session, 10)
+    # the MUC sends every message once to every occupant
+    copies = list()
+    for i in xrange(500):
+        for session in sessions:
+            copies.append(gw.groupchat(session, 'user%d' % (i % 10), u'hello everyone, how is it going today?'))
+    def run():
+        for mess in copies:
+            gw.component.messageHandler(None, mess)
+        gw.drain()
+    return len(copies) / len(sessions), run, gw
+
+def benchGROUPCHAT(occupants):
+    """messageHandler for live groupchat to 20 IRC users in a room, one copy each"""
+    return groupchatCopies(False)
+
+def benchGROUPCHATFANOUT(occupants):
+    """like groupchat with --fanout, lines rendered once for all IRC users"""
+    return groupchatCopies(True)
+
+def benchJOINBURST(occupants):
+    """presenceHandler for the occupant burst of a room being joined"""
+    gw = Gateway()
+    session = gw.session('alice')
+    session.handleLine('JOIN #%s' % ROOM.getNode())
+    presences = [gw.presence(session, 'user%d' % i) for i in xrange(occupants)]
+    presences.append(gw.presence(session, 'alice', role='moderator'))
+    def run():
+        for pres in presences:
+            gw.component.presenceHandler(None, pres)
+        gw.drain()
+    return len(presences), run, gw
+
+def benchJOINS(occupants):
+    """presenceHandler for occupants joining a room we are in"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, occupants)
+    presences = [gw.presence(session, 'newcomer%d' % i) for i in xrange(1000)]
+    def run():
+        for pres in presences:
+            gw.component.presenceHandler(None, pres)
+        gw.drain()
+    return len(presences), run, gw
+
+def benchROLECHANGES(occupants):
+    """presenceHandler for role changes in a large room"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, occupants)
+    presences = [gw.presence(session, 'user%d' % i, role='moderator') for i in xrange(min(occupants, 1000))]
+    def run():
+        for pres in presences:
+            gw.component.presenceHandler(None, pres)
+        gw.drain()
+    return len(presences), run, gw
+
+def benchCOMMANDPRIVMSG(occupants):
+    """commandHandler for PRIVMSG to a channel, parsing included"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, 10)
+    lines = ['PRIVMSG #%s :message number %d with some text' % (ROOM.getNode(), i) for i in xrange(2000)]
+    def run():
+        for line in lines:
+            session.handleLine(line)
+        gw.drain()
+    return len(lines), run, gw
+
+def benchCOMMANDJOIN(occupants):
+    """commandHandler for JOIN, parsing included"""
+    gw = Gateway()
+    session = gw.session('alice')
+    lines = ['JOIN #room%d' % i for i in xrange(1000)]
+    def run():
+        for line in lines:
+            session.handleLine(line)
+        gw.drain()
+    return len(lines), run, gw
+
+def benchCOMMANDMODE(occupants):
+    """commandHandler for MODE +o/-o, parsing included"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, 10)
+    lines = ['MODE #%s %so user%d' % (ROOM.getNode(), '+-'[i % 2], i % 10) for i in xrange(2000)]
+    def run():
+        for line in lines:
+            session.handleLine(line)
+        gw.drain()
+    return len(lines), run, gw
+
+def benchNICKFROMJID(occupants):
+    """makeNickFromJID over the occupants of a large room"""
+    gw = Gateway()
+    session = gw.session('alice')
+    jids = [JID('%s/user %d' % (ROOM, i)) for i in xrange(occupants)]
+    def run():
+        for jid in jids:
+            session.makeNickFromJID(jid, True)
+    return len(jids), run, gw
+
+def benchHOSTFROMJID(occupants):
+    """makeHostFromJID over the occupants of a large room"""
+    gw = Gateway()
+    session = gw.session('alice')
+    jids = [JID('%s/user %d' % (ROOM, i)) for i in xrange(occupants)]
+    def run():
+        for jid in jids:
+            session.makeHostFromJID(jid)
+    return len(jids), run, gw
+
+def benchSELFJOIN(occupants):
+    """ircCommandSELFJOIN NAMES burst of a large room, one op per occupant"""
+    gw = Gateway()
+    session = gw.session('alice')
+    gw.join(session, occupants)
+    def run():
+        for _ in xrange(5):
+            session.ircCommandSELFJOIN(ROOM)
+        gw.drain()
+    return 5 * (occupants + 1), run, gw
+
+BENCHMARKS = [('privmsg', benchPRIVMSG),
+              ('privmsg_delayed', benchPRIVMSGDELAYED),
+              ('message_delayed', benchDELAYED),
+              ('groupchat', benchGROUPCHAT),
+              ('groupchat_fanout', benchGROUPCHATFANOUT),
+              ('presence_join_burst', benchJOINBURST),
+              ('presence_joins', benchJOINS),
+              ('presence_role_changes', benchROLECHANGES),
+              ('command_privmsg', benchCOMMANDPRIVMSG),
+              ('command_join', benchCOMMANDJOIN),
+              ('command_mode', benchCOMMANDMODE),
+              ('nick_from_jid', benchNICKFROMJID),
+              ('host_from_jid', benchHOSTFROMJID),
+              ('selfjoin', benchSELFJOIN)]
+
+def measure(setup, occupants, rounds):
+    """Run a benchmark a few times, every round on a fresh setup
+
+    @rtype: dict
+    @return: best ops/sec and the allocations per op of that round
+    """
+    best = None
+    for _ in xrange(rounds):
+        ops, run, gw = setup(occupants)
+        gc.collect()
+        gc.disable()
+        # generation 0 counts tracked allocations minus deallocations, it
+        # only goes back to zero on a collection
+        allocated = gc.get_count()[0]
+        started = time.time()
+        run()
+        elapsed = time.time() - started
+        allocated = gc.get_count()[0] - allocated
+        gc.enable()
+        gw.close()
+        result = {'ops': ops,
+                  'ops_per_sec': ops / max(elapsed, 1e-9),
+                  'allocs_per_op': float(allocated) / ops}
+        if best is None or result['ops_per_sec'] > best['ops_per_sec']:
+            best = result
+    return best
+
+def usage():
+    print "Usage: bench.py [OPTION]... [BENCHMARK]..."
+    print "OPTIONS"
+    print "-h, --help\t help"
+    print "    --occupants\t size of the large room (default 5000)"
+    print "    --rounds\t rounds per benchmark, the best is reported (default 5)"
+    print "    --save-baseline\t write the results to a JSON file"
+    print "    --baseline\t compare the results with a saved JSON file"
+    print "    --tolerance\t allowed throughput loss against the baseline in percent (default 10)"
+    print "BENCHMARKS"
+    for name, setup in BENCHMARKS:
+        print "    %s\t %s" % (name, setup.__doc__)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help", "occupants=", "rounds=",
+                                                       "save-baseline=", "baseline=", "tolerance="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    occupants = 5000
+    rounds = 5
+    save = None
+    baseline = None
+    tolerance = 10.0
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o == "--occupants":
+            occupants = int(a)
+        if o == "--rounds":
+            rounds = int(a)
+        if o == "--save-baseline":
+            save = a
+        if o == "--baseline":
+            baseline = json.load(open(a))
+        if o == "--tolerance":
+            tolerance = float(a)
+
+    known = dict(BENCHMARKS)
+    for name in args:
+        if name not in known:
+            print "unknown benchmark %s" % name
+            sys.exit(2)
+
+    results = {}
+    regressed = list()
+    print "%-24s %12s %12s %10s" % ('benchmark', 'ops/sec', 'allocs/op', 'vs base')
+    for name, setup in BENCHMARKS:
+        if args and name not in args:
+            continue
+        result = results[name] = measure(setup, occupants, rounds)
+        change = ''
+        if baseline is not None and name in baseline['results']:
+            before = baseline['results'][name]['ops_per_sec']
+            delta = (result['ops_per_sec'] - before) * 100.0 / before
+            change = '%+.1f%%' % delta
+            if delta < -tolerance:
+                regressed.append(name)
+                change += ' !'
+        print "%-24s %12.0f %12.1f %10s" % (name, result['ops_per_sec'], result['allocs_per_op'], change)
+
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump({'occupants': occupants,
+                       'python': platform.python_version(),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline is not None and baseline.get('occupants') != occupants:
+        print "baseline was recorded with --occupants=%s" % baseline.get('occupants')
+    if regressed:
+        print "regressed by more than %.0f%%: %s" % (tolerance, ', '.join(regressed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
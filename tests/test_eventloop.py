@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""EventLoop wakeups from other threads and handler registration"""
+
+import imp
+import logging
+import os
+import socket
+import sys
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+
+class RacingOs(object):
+    """os for the loop, another thread calls callSoon right before the
+    wakeup pipe is drained the first time"""
+
+    def __init__(self, loop, callback):
+        self.loop = loop
+        self.callback = callback
+        self.raced = False
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def read(self, fd, size):
+        if not self.raced:
+            self.raced = True
+            thread = threading.Thread(target=self.loop.callSoon, args=(self.callback,))
+            thread.start()
+            thread.join()
+        return os.read(fd, size)
+
+class WakeupTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('test')
+        if not logger.handlers:
+            logger.addHandler(logging.NullHandler())
+        self.loop = xmppircd.EventLoop(logger, 'test')
+        self.loop.start()
+
+    def tearDown(self):
+        xmppircd.os = os
+        self.loop.stop()
+        self.loop.join(1)
+
+    def callFromThread(self, callback):
+        thread = threading.Thread(target=self.loop.callSoon, args=(callback,))
+        thread.start()
+        thread.join()
+
+    def testWakeupDuringDrain(self):
+        done = [threading.Event() for _ in xrange(3)]
+        xmppircd.os = RacingOs(self.loop, done[1].set)
+        self.callFromThread(done[0].set)
+        self.assertTrue(done[0].wait(2))
+        self.assertTrue(done[1].wait(2))
+        # the byte of the racing callSoon was drained, the flag must not
+        # keep later ones from waking the loop
+        self.callFromThread(done[2].set)
+        self.assertTrue(done[2].wait(2))
+
+class Handler(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class RegisterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = xmppircd.EventLoop(logging.getLogger('test'), 'test')
+
+    def testUnregisterClosed(self):
+        handlers = [Handler(socket.socket()) for _ in xrange(3)]
+        for handler in handlers:
+            self.loop.register(handler)
+        fd = handlers[1].fileno()
+        # handlers are unregistered after their socket is closed
+        handlers[1].sock.close()
+        self.loop.unregister(handlers[1])
+        self.assertFalse(fd in self.loop.handlers)
+        self.assertEqual(len(self.loop.handlers), 2)
+        self.loop.unregister(handlers[1])
+        self.assertEqual(len(self.loop.handlers), 2)
+
+    def testUnregisterReusedFd(self):
+        old = Handler(socket.socket())
+        self.loop.register(old)
+        fd = old.fileno()
+        old.sock.close()
+        self.loop.poller.unregister(fd)
+        new = Handler(socket.socket())
+        self.assertEqual(new.fileno(), fd)
+        self.loop.register(new)
+        # a stale handler doesn't take the fd of its successor along
+        self.loop.unregister(old)
+        self.assertTrue(self.loop.handlers[fd] is new)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Groupchat relayed with --fanout matches the per copy relay"""
+
+import imp
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+bench = imp.load_source('bench', os.path.join(HERE, os.pardir, 'benchmarks', 'bench.py'))
+
+class FanoutTest(unittest.TestCase):
+
+    def relay(self, fanout, messages):
+        """What three IRC users in a room get for the given messages, one of
+        them shows channels by their full room JID"""
+        gw = bench.Gateway(fanout)
+        sessions = [gw.session('irc%d' % i) for i in xrange(3)]
+        for session in sessions:
+            gw.join(session, 3)
+        sessions[1].fullRoomJid = True
+        for session in sessions:
+            del session.outbuf[:]
+        for nick, text in messages:
+            for session in sessions:
+                gw.component.messageHandler(None, gw.groupchat(session, nick, text))
+        received = [bytes(session.outbuf) for session in sessions]
+        gw.close()
+        return received
+
+    def testSameLines(self):
+        messages = [('user1', u'hello'),
+                    ('user2', u'two\n/me lines'),
+                    ('irc2', u'own message'),
+                    ('user1', u'\xe4\xf6 unicode')]
+        received = self.relay(True, messages)
+        self.assertEqual(received, self.relay(False, messages))
+        self.assertTrue(' PRIVMSG #bench@chat.example.com :hello\r\n' in received[1])
+        self.assertFalse('own message' in received[2])
+        self.assertEqual(received[0].count('\r\n'), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""HistoryStore round trips and reopening its files"""
+
+import imp
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+
+ROOM = u'Lobby@chat.example.com'
+
+class HistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.logger = logging.getLogger('test')
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.NullHandler())
+        self.store = xmppircd.HistoryStore(self.directory, self.logger)
+
+    def tearDown(self):
+        for name in self.store.files.keys():
+            self.store.close(name)
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.store.close(ROOM)
+        self.store = xmppircd.HistoryStore(self.directory, self.logger)
+
+    def fill(self, count=10):
+        for i in xrange(count):
+            self.assertTrue(self.store.append(ROOM, 1000.0 + i, u'nick%d' % i, u'message %d' % i))
+
+    def texts(self, records):
+        return [text for when, nick, text in records]
+
+    def testRoundTrip(self):
+        text = u'tab\there, back\\slash \\n not a newline\nsecond line\r\xe4€'
+        self.assertTrue(self.store.append(ROOM, 1000.5, u'n\xefck', text))
+        self.assertEqual(self.store.latest(ROOM, 10), [(1000.5, u'n\xefck', text)])
+        self.reopen()
+        self.assertEqual(self.store.latest(ROOM, 10), [(1000.5, u'n\xefck', text)])
+
+    def testQueries(self):
+        self.fill()
+        self.assertEqual(self.texts(self.store.latest(ROOM, 3)), [u'message 7', u'message 8', u'message 9'])
+        self.assertEqual(self.texts(self.store.latest(ROOM, 5, 1007.0)), [u'message 8', u'message 9'])
+        self.assertEqual(self.texts(self.store.before(ROOM, 1003.0, 2)), [u'message 1', u'message 2'])
+        self.assertEqual(self.texts(self.store.after(ROOM, 1003.0, 2)), [u'message 4', u'message 5'])
+        self.assertEqual(self.texts(self.store.around(ROOM, 1005.0, 4)),
+                         [u'message 3', u'message 4', u'message 5', u'message 6'])
+        self.assertEqual(self.texts(self.store.between(ROOM, 1002.0, 1006.0, 10)),
+                         [u'message 3', u'message 4', u'message 5'])
+        self.assertEqual(self.texts(self.store.between(ROOM, 1002.0, 1006.0, 2)), [u'message 3', u'message 4'])
+        self.assertEqual(self.texts(self.store.between(ROOM, 1006.0, 1002.0, 2)), [u'message 4', u'message 5'])
+        self.assertEqual(self.store.before(ROOM, 1000.0, 5), [])
+        self.assertEqual(self.store.after(ROOM, 1009.0, 5), [])
+        self.assertEqual(self.store.latest(u'empty@chat.example.com', 5), [])
+
+    def testReopen(self):
+        self.fill()
+        self.reopen()
+        self.assertEqual(self.store.lastTime(ROOM), 1009.0)
+        self.assertTrue(self.store.append(ROOM, 1010.0, u'nick', u'after reopen'))
+        self.assertEqual(self.texts(self.store.after(ROOM, 1008.0, 5)), [u'message 9', u'after reopen'])
+        self.assertEqual(len(self.store.latest(ROOM, 100)), 11)
+
+    def testTruncatedIndex(self):
+        self.fill(3)
+        self.store.close(ROOM)
+        path = os.path.join(self.directory, 'lobby@chat.example.com.idx')
+        with open(path, 'r+b') as index:
+            index.truncate(os.path.getsize(path) - 5)
+        self.store = xmppircd.HistoryStore(self.directory, self.logger)
+        self.assertEqual(self.texts(self.store.latest(ROOM, 10)), [u'message 0', u'message 1'])
+        self.assertEqual(self.store.lastTime(ROOM), 1001.0)
+
+    def testDelayedDedupe(self):
+        self.fill(3)
+        # MUC history since the last stored time repeats that message
+        self.assertFalse(self.store.append(ROOM, 1002.0, u'nick2', u'message 2', True))
+        self.assertFalse(self.store.append(ROOM, 1001.0, u'nick1', u'message 1', True))
+        self.assertTrue(self.store.append(ROOM, 1002.0, u'nick', u'same time', True))
+        self.reopen()
+        self.assertFalse(self.store.append(ROOM, 1002.0, u'nick2', u'message 2', True))
+        self.assertFalse(self.store.append(ROOM, 1002.0, u'nick', u'same time', True))
+        self.assertTrue(self.store.append(ROOM, 1003.0, u'nick3', u'message 3', True))
+        self.assertEqual(len(self.store.latest(ROOM, 100)), 5)
+
+    def testClockStepBack(self):
+        self.fill(3)
+        self.assertTrue(self.store.append(ROOM, 900.0, u'nick', u'late'))
+        self.assertEqual(self.store.latest(ROOM, 1), [(1002.0, u'nick', u'late')])
+        self.assertEqual(self.texts(self.store.after(ROOM, 1001.0, 5)), [u'message 2', u'late'])
+
+if __name__ == '__main__':
+    unittest.main()
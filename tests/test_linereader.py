@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Line framing of IRCLineReader"""
+
+import imp
+import os
+import socket
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+
+class LineReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.peer = socket.socketpair()
+        self.reader = xmppircd.IRCLineReader(maxlength=32, chunksize=16)
+
+    def tearDown(self):
+        self.ours.close()
+        self.peer.close()
+
+    def feed(self, data):
+        """Send data and read it all, in chunks of the reader's size
+
+        @rtype: list
+        @return: the lines complete after reading
+        """
+        self.peer.sendall(data)
+        left = len(data)
+        while left:
+            left -= self.reader.readFrom(self.ours)
+        return self.reader.lines()
+
+    def testPartialReads(self):
+        self.assertEqual(self.feed('NICK al'), [])
+        self.assertEqual(self.feed('ice\r'), ['NICK alice'])
+        # the LF of a CRLF split over two reads is no empty line
+        self.assertEqual(self.feed('\nUSER a 0 * :a'), [])
+        self.assertEqual(self.feed('\r\n'), ['USER a 0 * :a'])
+        self.assertEqual(bytes(self.reader.buffer), '')
+
+    def testLinesInOneRead(self):
+        self.assertEqual(self.feed('PING :1\r\nPING :2\nPING :3\rPING :4\r\n\r\nPI'),
+                         ['PING :1', 'PING :2', 'PING :3', 'PING :4'])
+        self.assertEqual(self.feed('NG :5\n'), ['PING :5'])
+        self.assertEqual(self.reader.overflows, 0)
+
+    def testOverlongLine(self):
+        self.assertEqual(self.feed('PRIVMSG #a :%s\r\nPING :1\r\n' % ('x' * 40)), ['PING :1'])
+        self.assertEqual(self.reader.overflows, 1)
+
+    def testOverlongLineOverReads(self):
+        # no terminator within maxlength, the rest of the line is dropped
+        # as it arrives and counts as one overflow
+        self.assertEqual(self.feed('x' * 40), [])
+        self.assertEqual(self.feed('x' * 40), [])
+        self.assertEqual(self.feed('xxx\r\nPING :1\r\n'), ['PING :1'])
+        self.assertEqual(self.reader.overflows, 1)
+
+    def testLongestLine(self):
+        line = 'PRIVMSG #a :' + 'x' * 20
+        self.assertEqual(len(line), 32)
+        self.assertEqual(self.feed(line + '\r\n'), [line])
+
+    def testEndOfStream(self):
+        self.peer.close()
+        self.assertEqual(self.reader.readFrom(self.ours), 0)
+        self.assertEqual(self.reader.lines(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Excess SendQ handling of ClientSession"""
+
+import imp
+import logging
+import os
+import socket
+import sys
+import unittest
+
+from xmpp import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+
+class NullConnection(object):
+    def send(self, data):
+        pass
+
+class NullDispatcher(object):
+    def __init__(self):
+        self._metastream = Node('stream:stream')
+
+class NullClient(object):
+    """Just enough of xmpp.Component for XmppComponent to run without a
+    server"""
+
+    Namespace = 'jabber:component:accept'
+    Server = 'irc.example.com'
+
+    def __init__(self):
+        self.Connection = NullConnection()
+        self.Dispatcher = NullDispatcher()
+
+    def RegisterHandler(self, name, handler, *args, **kwargs):
+        pass
+
+class SendqTest(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('test')
+        if not logger.handlers:
+            logger.addHandler(logging.NullHandler())
+        options = dict(xmppircd.DEFAULTOPTIONS)
+        options['sendq'] = 4096
+        self.component = xmppircd.XmppComponent(NullClient(), logger, options)
+        self.component.writer.stop()
+        self.loop = xmppircd.EventLoop(logger, 'test')
+        self.component.loop = self.loop
+        ours, self.peer = socket.socketpair()
+        self.peer.setblocking(0)
+        self.session = xmppircd.ClientSession(ours, 6667, 'irc.example.com',
+                                              'chat.example.com', self.component)
+        self.session.start(self.loop)
+        self.session.handleLine('NICK alice')
+        self.loop.runCallbacks()
+        self.read()
+
+    def tearDown(self):
+        self.peer.close()
+
+    def read(self):
+        data = ''
+        while True:
+            try:
+                chunk = self.peer.recv(65536)
+            except socket.error:
+                return data
+            if not chunk:
+                return data
+            data += chunk
+
+    def testExcessSendq(self):
+        # the client doesn't read, the lines pile up in the send queue
+        for i in xrange(100):
+            self.session.sendToIRC(':irc.example.com NOTICE alice :%s' % ('x' * 100))
+        self.assertTrue(self.session.excessSendq)
+        self.loop.runCallbacks()
+        self.assertTrue(self.session.closed)
+        self.assertEqual(self.component.excessSendqCount, 1)
+        self.assertEqual(self.read(), 'ERROR :Closing Link: alice (Excess SendQ)\r\n')
+        self.assertFalse(self.session.bare_jid in self.component.clients)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Timestamp parsing of XEP-0082, legacy XEP-0091 and CHATHISTORY stamps"""
+
+import calendar
+import imp
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.dont_write_bytecode = True
+xmppircd = imp.load_source('xmppircd', os.path.join(HERE, os.pardir, 'xmpp-ircd.py'))
+bench = imp.load_source('bench', os.path.join(HERE, os.pardir, 'benchmarks', 'bench.py'))
+
+BASE = calendar.timegm((2020, 1, 2, 3, 4, 5))
+
+ACCEPTED = [
+    # XEP-0082 DateTime
+    ('2020-01-02T03:04:05Z', BASE),
+    ('2020-01-02T03:04:05', BASE),
+    ('2020-01-02T03:04:05.250Z', BASE + 0.25),
+    ('2020-01-02T03:04:05.123456Z', BASE + 0.123456),
+    ('2020-01-02T03:04:05.5', BASE + 0.5),
+    ('2020-01-02T05:04:05+02:00', BASE),
+    ('2020-01-01T22:04:05-05:00', BASE),
+    ('2020-01-02T05:34:05.750+02:30', BASE + 0.75),
+    ('2020-01-02T03:04:05+00:00', BASE),
+    # legacy XEP-0091
+    ('20200102T03:04:05', BASE),
+    # leap day and year boundary
+    ('2020-02-29T00:00:00Z', calendar.timegm((2020, 2, 29, 0, 0, 0))),
+    ('1999-12-31T23:59:59Z', calendar.timegm((1999, 12, 31, 23, 59, 59))),
+    ]
+
+REJECTED = [
+    '',
+    'bogus',
+    '2020-01-02',
+    '2020-01-02T03:04',
+    '2020-01-02T03:04:05+0200',
+    '2020-01-02T03:04:05 UTC',
+    '2020-01-02T03:04:05ZZ',
+    '2020-01-02T03:04:05+02',
+    'xxxx-01-02T03:04:05Z',
+    '2020-0a-02T03:04:05Z',
+    '2020-01-02T03:04:xxZ',
+    '2020-13-02T03:04:05Z',
+    '2020-01-32T03:04:05Z',
+    '2020-01-02T24:04:05Z',
+    '2020-01-02T03:60:05Z',
+    '2020-01-02 03:04:05Z',
+    '20200102T03:04',
+    '20200102 03:04:05',
+    '20201302T03:04:05',
+    None,
+    ]
+
+class ParseStampTest(unittest.TestCase):
+
+    def testAccepted(self):
+        for stamp, expected in ACCEPTED:
+            self.assertAlmostEqual(xmppircd.parseStamp(stamp), expected, places=6, msg=stamp)
+
+    def testRejected(self):
+        for stamp in REJECTED:
+            self.assertEqual(xmppircd.parseStamp(stamp), None, stamp)
+
+    def testUnicode(self):
+        self.assertEqual(xmppircd.parseStamp(u'2020-01-02T03:04:05Z'), BASE)
+
+    def testFormatRoundTrip(self):
+        for when in (BASE, BASE + 0.5, BASE + 0.999):
+            self.assertAlmostEqual(xmppircd.parseStamp(xmppircd.formatStamp(when)), when, places=3)
+
+class ChatHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.gw = bench.Gateway()
+        self.gw.component.history = xmppircd.HistoryStore(self.directory, logging.getLogger('test'))
+        self.session = self.gw.session('alice')
+        self.gw.join(self.session, 3)
+        self.session.caps.add('server-time')
+        for i in xrange(5):
+            self.gw.component.history.append(bench.ROOM.getStripped(), BASE + i, u'user1', u'message %d' % i)
+        del self.session.outbuf[:]
+
+    def tearDown(self):
+        self.gw.close()
+        shutil.rmtree(self.directory)
+
+    def request(self, arguments):
+        self.session.ircCommandCHATHISTORY(arguments)
+        lines = bytes(self.session.outbuf).splitlines()
+        del self.session.outbuf[:]
+        return lines
+
+    def testTimestamps(self):
+        for stamp in ('2020-01-02T03:04:07.000Z', '2020-01-02T03:04:07Z', '2020-01-02T05:04:07+02:00'):
+            lines = self.request('BEFORE #bench timestamp=%s 10' % stamp)
+            self.assertEqual([line.rsplit(':', 1)[1] for line in lines], ['message 0', 'message 1'], stamp)
+            self.assertTrue(lines[0].startswith('@time=2020-01-02T03:04:05.000Z '))
+        lines = self.request('AFTER #bench timestamp=2020-01-02T03:04:07.500Z 10')
+        self.assertEqual([line.rsplit(':', 1)[1] for line in lines], ['message 3', 'message 4'])
+
+    def testMalformed(self):
+        for stamp in ('2020-01-02', 'yesterday', '2020-01-02T03:04:99Z', ''):
+            self.assertEqual(self.request('BEFORE #bench timestamp=%s 10' % stamp),
+                             ['FAIL CHATHISTORY INVALID_PARAMS BEFORE :Invalid parameters'], stamp)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,11 @@ import socket
 import ssl
 import time, datetime
 import exceptions
+import errno
+import os
+import select
+import fcntl
+import collections
 from threading import *
 from xmpp import *
 import getopt, sys
@@ -35,36 +40,833 @@ import logging.handlers
 import urllib
 import string
 import random
+import bisect
+import heapq
+import itertools
+import signal
+import BaseHTTPServer
+import struct
+import calendar
+import json
+import subprocess
+from multiprocessing.reduction import send_handle, recv_handle
 
 STATUSSTATES = ['AVAILABLE','CHAT', 'AWAY', 'XA', 'DND', 'INVISIBLE']
 XMPPIRCDVERSION = 3.0
+# tuning knobs settable from the command line
+DEFAULTOPTIONS = {
+    'irc_loops': 1,
+    'sendq': 1048576,
+    'oper': None,
+    'metrics_port': None,
+    'iq_timeout': 30,
+    'fanout': False,
+    'workers': 1,
+    'room_probe_interval': 60,
+    'disco_ttl': 60,
+    'disco_stale': 600,
+    'history_dir': None,
+    'join_backlog': 50,
+    'mode_delay': 0.25,
+    'tls_timeout': 10,
+    'backlog': 128,
+    # new IRC connections accepted per second and burst, a rate of 0 is unlimited
+    'accept_rate': (20.0, 50),
+    # connections still registering before accepting pauses, 0 is unlimited
+    'max_pending': 100,
+    # MUC joins awaiting the MUC's answer before further joins wait, 0 is unlimited
+    'max_joining': 20,
+    # unix socket a restarted gateway takes over the connections through
+    'handoff': None,
+    # command class to (lines per second, burst), a rate of 0 is unlimited
+    'flood': {'message': (2.0, 10), 'join': (1.0, 10), 'nick': (0.2, 3),
+              'mode': (1.0, 5), 'query': (0.5, 5)},
+    'global_flood': {'message': (200.0, 400), 'join': (50.0, 100), 'nick': (10.0, 20),
+                     'mode': (50.0, 100), 'query': (20.0, 50)},
+    }
+# commands counted by name in the IRC line metrics, anything else is OTHER
+IRCCOMMANDS = frozenset(['NICK', 'PASS', 'USER', 'JOIN', 'PART', 'PRIVMSG', 'NOTICE',
+                         'TOPIC', 'MODE', 'WHO', 'WHOIS', 'AWAY', 'LIST', 'PING',
+                         'PONG', 'QUIT', 'OPER', 'STATS', 'CHATHISTORY', 'CAP'])
+# IRCv3 capabilities offered to clients
+CAPABILITIES = frozenset(['server-time', 'batch', 'message-tags'])
+# seconds after a join MUC history may still arrive in the join's batch
+HISTORYWINDOW = 5
+# user modes per MODE line, advertised as MODES in ISUPPORT
+MAXMODES = 12
+# IRC channel user modes of the MUC roles
+ROLEMODES = {'moderator': 'o', 'participant': 'v'}
+# flood control class of the IRC commands relayed to XMPP
+COMMANDCLASSES = {'PRIVMSG': 'message', 'NOTICE': 'message', 'JOIN': 'join', 'PART': 'join',
+                  'NICK': 'nick', 'MODE': 'mode', 'TOPIC': 'mode', 'AWAY': 'mode',
+                  'WHO': 'query', 'WHOIS': 'query', 'LIST': 'query', 'CHATHISTORY': 'query'}
+# lines a throttled client may have waiting before it is dropped
+MAXHELDLINES = 256
+# seconds a new IRC connection has to complete registration
+REGISTERTIMEOUT = 60
+# seconds before a listener paused for too many registering connections looks again
+ADMISSIONRETRY = 0.1
+# how to start the gateway again for a handoff, taken before daemonizing
+# changes the working directory
+RESTARTCOMMAND = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+# seconds a handoff waits for threads of the old process to finish
+HANDOFFTIMEOUT = 5
+# seconds between component reconnect attempts, doubling up to the maximum
+RECONNECTDELAY = 1
+RECONNECTMAXDELAY = 60
+# 512 bytes of rfc1459 line plus room for IRCv3 message tags
+MAXLINELENGTH = 8191 + 512
+# private message peers remembered per session for nick lookups
+PRIVATEPEERS = 256
+# MUC status codes announcing a room configuration change
+CONFIGSTATUSCODES = frozenset(['104', '170', '171', '172', '173', '174'])
+# most messages returned by a single CHATHISTORY request
+CHATHISTORYLIMIT = 500
+NS_URN_DELAY = 'urn:xmpp:delay'
+
+# midnight of recently seen timestamp dates, history spans few days
+STAMPDAYS = {}
+
+def stampDay(year, month, day):
+    key = (year, month, day)
+    midnight = STAMPDAYS.get(key)
+    if midnight is None:
+        if len(STAMPDAYS) > 1024:
+            STAMPDAYS.clear()
+        if not 1 <= day <= calendar.monthrange(year, month)[1]:
+            raise ValueError('no day %d in %d-%d' % (day, year, month))
+        midnight = STAMPDAYS[key] = calendar.timegm((year, month, day, 0, 0, 0))
+    return midnight
+
+def stampSeconds(hour, minute, second):
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second <= 60):
+        raise ValueError('no time %d:%d:%d' % (hour, minute, second))
+    return hour * 3600 + minute * 60 + second
+
+def parseStamp(stamp):
+    """Parse a XEP-0082 CCYY-MM-DDThh:mm:ss[.sss](Z|+hh:mm) or legacy
+    XEP-0091 CCYYMMDDThh:mm:ss timestamp. Both are fixed format so fields
+    are sliced out directly, time.strptime is far slower.
+
+    @type stamp: string
+    @param stamp: the timestamp
+    @rtype: float
+    @return: seconds since the epoch, None if the stamp is malformed
+    """
+    try:
+        if stamp[4:5] == '-' and stamp[10:11] == 'T':
+            when = stampDay(int(stamp[0:4]), int(stamp[5:7]), int(stamp[8:10])) + \
+                stampSeconds(int(stamp[11:13]), int(stamp[14:16]), int(stamp[17:19]))
+            rest = stamp[19:]
+            if rest.startswith('.'):
+                end = 1
+                while end < len(rest) and rest[end].isdigit():
+                    end += 1
+                if end > 1:
+                    when += float(rest[:end])
+                rest = rest[end:]
+            if rest[:1] in ('+', '-') and len(rest) == 6:
+                offset = int(rest[1:3]) * 3600 + int(rest[4:6]) * 60
+                if rest[0] == '+':
+                    offset = -offset
+                when += offset
+            elif rest not in ('', 'Z'):
+                return None
+            return when
+        if len(stamp) == 17 and stamp[8] == 'T':
+            return stampDay(int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8])) + \
+                stampSeconds(int(stamp[9:11]), int(stamp[12:14]), int(stamp[15:17]))
+    except (ValueError, TypeError):
+        pass
+    return None
+
+def formatStamp(when):
+    """Returns an IRCv3 server-time timestamp
+
+    @type when: float
+    @param when: seconds since the epoch
+    @rtype: string
+    """
+    return '%s.%03dZ' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when)),
+                         int(when * 1000) % 1000)
+
+def delayStamp(mess):
+    """Returns the unparsed timestamp of a delayed message, from either a
+    XEP-0203 delay or a legacy XEP-0091 x element
+
+    @type mess: Message
+    @param mess: XMPP Message
+    @rtype: string
+    @return: the stamp, None if the message is not delayed
+    """
+    delay = mess.getTag('delay', namespace=NS_URN_DELAY)
+    if delay is None:
+        delay = mess.getTag('x', namespace=NS_DELAY)
+        if delay is None:
+            return None
+    return delay.getAttr('stamp') or ''
+
+def delayTime(mess):
+    """Returns the time a delayed message was originally sent
+
+    @type mess: Message
+    @param mess: XMPP Message
+    @rtype: float
+    @return: seconds since the epoch, None if the message is not delayed or
+    the stamp is malformed
+    """
+    stamp = delayStamp(mess)
+    if stamp is None:
+        return None
+    return parseStamp(stamp)
 
-class JabberThread(Thread):
-    """Class for Jabber connection thread"""
+def fixNick(nick):
+    """Fixes strange character nicknames that don't work nicely with
+    IRC. This function may cause conflicts and thus unfinished.
+
+    @type nick: string
+    @param nick: nickname to fix
+    @rtype: string
+    @return: fixed nick
+    """
+
+    fixednick = unicode(nick)
+    fixednick = fixednick.replace(' ', '_')
+    fixednick = fixednick.replace('!', '_')
+    fixednick = fixednick.replace(':', '_')
+    fixednick = fixednick.replace('@', '_')
+    return fixednick
+
+def makeHostFromJID(jid):
+    """ builds the host part from a given jid
+
+    @type jid: JID
+    @param jid: The JID from which to make the host part
+    @rtype string
+    @return valid Host part
+    """
 
-    def __init__(self, client):
-        """Constructor for JabberThread Class
+    return "%s@%s/%s" % (urllib.quote(jid.getNode()), urllib.quote(jid.getDomain()), urllib.quote(jid.getResource()))
 
-        @type client: Client
-        @param client: instace of xmpp.Client class
+class TokenBucket(object):
+    """Rate limit of rate tokens per second with bursts of up to burst"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def wait(self, now):
+        """Seconds until a token is available, 0 if one is now
+
+        @type now: float
+        @param now: current time
+        @rtype: float
         """
-        Thread.__init__(self)
-        self.client = client
-        self.connected = True
+        if self.tokens < self.burst:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def makeBuckets(limits):
+    """Token buckets for the command classes that have a limit
+
+    @type limits: dict
+    @param limits: command class to (rate, burst)
+    @rtype: dict
+    """
+    return dict((name, TokenBucket(rate, burst))
+                for name, (rate, burst) in limits.iteritems() if rate > 0)
+
+class LoopTimer(object):
+    """A callback scheduled on an EventLoop with callLater"""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Keep the callback from running, safe to call from any thread"""
+        self.cancelled = True
+
+class EventLoop(Thread):
+    """Readiness based event loop serving many sockets from a single thread"""
+
+    READ = select.POLLIN | select.POLLPRI
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+    def __init__(self, logger, name='EventLoop'):
+        """Constructor for EventLoop class
+
+        @type logger: Logger
+        @type name: string
+        @param logger: logger to report handler failures to
+        @param name: name of the thread running this loop
+        """
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.logger = logger
+        self.handlers = {}
+        # fd of every handler, its socket may be closed when unregistered
+        self.fds = {}
+        self.callbacks = collections.deque()
+        self.timers = []
+        self.timerSeq = itertools.count()
+        self.running = False
+        self.ownerThread = None
+
+        # epoll scales with the number of ready sockets instead of the
+        # number of registered ones, fall back to poll where it is missing
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.pollScale = 1.0
+        else:
+            self.poller = select.poll()
+            self.pollScale = 1000.0
+
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.wakeupPending = False
+        self.poller.register(self.wakeupRead, self.READ)
+
+    def register(self, handler, events=READ):
+        """Start watching a handler for readiness
+
+        @type handler: object
+        @type events: integer
+        @param handler: object with fileno(), handleRead(), handleWrite()
+        and handleClose() methods
+        @param events: poll event mask to watch for
+        """
+        fd = handler.fileno()
+        self.handlers[fd] = handler
+        self.fds[handler] = fd
+        self.poller.register(fd, events)
+
+    def modify(self, handler, events):
+        """Change the events watched for an already registered handler
+
+        @type handler: object
+        @type events: integer
+        @param handler: registered handler
+        @param events: new poll event mask
+        """
+        self.poller.modify(handler.fileno(), events)
+
+    def unregister(self, handler):
+        """Stop watching a handler
+
+        @type handler: object
+        @param handler: registered handler
+        """
+        fd = self.fds.pop(handler, None)
+        if fd is None or self.handlers.get(fd) is not handler:
+            return
+        del (self.handlers[fd])
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, ValueError):
+            pass
+
+    def callSoon(self, callback, *args):
+        """Run a callback on the loop thread, safe to call from any thread
+
+        @type callback: function
+        @param callback: function to call with args
+        """
+        self.callbacks.append((callback, args))
+        if not self.wakeupPending and currentThread() is not self.ownerThread:
+            self.wakeupPending = True
+            try:
+                os.write(self.wakeupWrite, 'x')
+            except OSError:
+                pass
+
+    def callLater(self, delay, callback, *args):
+        """Run a callback on the loop thread after a delay, safe to call from
+        any thread
+
+        @type delay: float
+        @type callback: function
+        @param delay: seconds to wait
+        @param callback: function to call with args
+        @rtype: LoopTimer
+        @return: timer that can be cancelled
+        """
+        timer = LoopTimer(time.time() + delay, callback, args)
+        if currentThread() is self.ownerThread:
+            self.addTimer(timer)
+        else:
+            self.callSoon(self.addTimer, timer)
+        return timer
+
+    def addTimer(self, timer):
+        heapq.heappush(self.timers, (timer.when, next(self.timerSeq), timer))
+
+    def runTimers(self):
+        """Run the timers that are due"""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except:
+                self.logger.exception('Unexpected error in loop timer %s' % timer.callback)
+
+    def runCallbacks(self):
+        """Run the callbacks queued so far, callbacks queued while running
+        are left for the next iteration"""
+        for _ in xrange(len(self.callbacks)):
+            callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except:
+                self.logger.exception('Unexpected error in loop callback %s' % callback)
+
+    def dispatch(self, fd, events):
+        """Hand readiness events to the handler registered for fd"""
+        handler = self.handlers.get(fd)
+        if handler is None:
+            return
+        try:
+            if events & (self.READ | self.ERROR):
+                handler.handleRead()
+            if events & self.WRITE and fd in self.handlers:
+                handler.handleWrite()
+        except:
+            self.logger.exception('Unexpected error in handler %s' % handler)
+            if fd in self.handlers:
+                self.unregister(handler)
+                handler.handleClose()
 
     def run(self):
-        """When xmpp client is connected runs the client process """
-        #return
-        time.sleep(5)
-        while self.client.Process(1) and self.connected:
+        """Poll registered sockets and dispatch readiness until stopped"""
+        self.ownerThread = currentThread()
+        self.running = True
+        while self.running:
+            timeout = -1
+            if self.callbacks:
+                timeout = 0
+            elif self.timers:
+                # epoll takes seconds, poll milliseconds
+                timeout = max(0.0, self.timers[0][0] - time.time()) * self.pollScale
+                if self.pollScale != 1.0:
+                    timeout = int(timeout) + 1
+            elif self.pollScale != 1.0:
+                timeout = None
+            try:
+                events = self.poller.poll(timeout)
+            except (IOError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.wakeupRead:
+                    try:
+                        while os.read(self.wakeupRead, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    # only once drained, a callSoon seeing the flag still
+                    # set queued its callback before this and it runs below
+                    self.wakeupPending = False
+                    continue
+                self.dispatch(fd, event)
+            self.runTimers()
+            self.runCallbacks()
+
+    def stop(self):
+        """Stop the loop after the current iteration"""
+        self.running = False
+        self.callSoon(lambda: None)
+
+class Metrics(object):
+    """Counters and latency histograms for the gateway hot paths, rendered
+    for IRC STATS and in the Prometheus text format"""
+
+    # seconds
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, label=None, value=1):
+        """Add to a counter
+
+        @type name: string
+        @type label: tuple
+        @param name: metric name
+        @param label: (label name, label value) pair or None
+        @param value: amount to add
+        """
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds):
+        """Record a latency in a histogram
+
+        @type name: string
+        @type seconds: float
+        @param name: metric name
+        @param seconds: observed latency
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def addCollector(self, collector):
+        """Register a function sampled at render time, it returns a list of
+        (name, label, value) gauges
+
+        @type collector: function
+        @param collector: gauge sampling function
+        """
+        self.collectors.append(collector)
+
+    def counter(self, name, label=None):
+        """Return the current value of a counter"""
+        return self.counters.get((name, label), 0)
+
+    def formatName(self, name, label, extra=None):
+        labels = list()
+        if label is not None:
+            labels.append('%s="%s"' % (label[0], unicode(label[1]).replace('\\', '\\\\').replace('"', '\\"')))
+        if extra is not None:
+            labels.append('%s="%s"' % extra)
+        if labels:
+            return '%s{%s}' % (name, ','.join(labels))
+        return name
+
+    def samples(self):
+        """Return every sample as a (name, value) pair, histograms expanded
+        into cumulative buckets, sum and count
+
+        @rtype: list
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((name, list(h)) for name, h in self.histograms.items())
+        samples = list()
+        for (name, label), value in counters:
+            samples.append((self.formatName(name, label), value))
+        for name, histogram in histograms:
+            total = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), histogram):
+                total += count
+                samples.append((self.formatName('%s_bucket' % name, None, ('le', bound)), total))
+            samples.append(('%s_sum' % name, histogram[-1]))
+            samples.append(('%s_count' % name, total))
+        for collector in self.collectors:
+            for name, label, value in collector():
+                samples.append((self.formatName(name, label), value))
+        return samples
+
+    def prometheus(self):
+        """Render all metrics in the Prometheus text exposition format
+
+        @rtype: string
+        """
+        return ''.join(['%s %s\n' % (name, value) for name, value in self.samples()]).encode('utf-8')
+
+class IRCMessage(object):
+    """A single parsed line sent by an IRC client"""
+
+    __slots__ = ('line', 'tags', 'prefix', 'command', 'params', 'arguments')
+
+    TAGUNESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+    def __init__(self, line):
+        """Parse an IRC line into tags, prefix, command and params
+
+        @type line: unicode
+        @param line: the line without its terminator
+        """
+        self.line = line
+        self.tags = {}
+        self.prefix = None
+        self.params = []
+
+        rest = line.lstrip(' ')
+        if rest.startswith('@'):
+            tags, _, rest = rest[1:].partition(' ')
+            self.tags = self.parseTags(tags)
+            rest = rest.lstrip(' ')
+        if rest.startswith(':'):
+            self.prefix, _, rest = rest[1:].partition(' ')
+            rest = rest.lstrip(' ')
+        command, _, rest = rest.partition(' ')
+        self.command = command.upper()
+        # commandHandler still splits the raw argument string itself
+        self.arguments = rest
+
+        while rest:
+            rest = rest.lstrip(' ')
+            if rest.startswith(':'):
+                self.params.append(rest[1:])
+                break
+            param, _, rest = rest.partition(' ')
+            if param:
+                self.params.append(param)
+
+    def parseTags(self, tags):
+        """Parse the IRCv3 message-tags part of a line
+
+        @type tags: unicode
+        @param tags: tags without the leading @
+        @rtype: dict
+        @return: tag name to unescaped value, valueless tags map to ''
+        """
+        parsed = {}
+        for tag in tags.split(';'):
+            if not tag:
+                continue
+            key, _, value = tag.partition('=')
+            if '\\' in value:
+                unescaped = []
+                chars = iter(value)
+                for c in chars:
+                    if c == '\\':
+                        c = next(chars, '')
+                        c = self.TAGUNESCAPES.get(c, c)
+                    unescaped.append(c)
+                value = ''.join(unescaped)
+            parsed[key] = value
+        return parsed
+
+class IRCLineReader(object):
+    """Frames the byte stream of an IRC connection into lines. Partial lines
+    are carried over to the next read and reads go into one reusable buffer."""
+
+    def __init__(self, maxlength=MAXLINELENGTH, chunksize=4096):
+        """Constructor for IRCLineReader class
+
+        @type maxlength: integer
+        @type chunksize: integer
+        @param maxlength: longest line accepted, longer ones are dropped
+        @param chunksize: bytes read from the socket at once
+        """
+        self.maxlength = maxlength
+        self.chunk = bytearray(chunksize)
+        self.view = memoryview(self.chunk)
+        self.buffer = bytearray()
+        self.discarding = False
+        self.overflows = 0
+
+    def readFrom(self, sock):
+        """Read whatever the socket has into the line buffer
+
+        @type sock: socket
+        @param sock: socket to read from
+        @rtype: integer
+        @return: number of bytes read, 0 on end of stream
+        """
+        total = n = sock.recv_into(self.chunk)
+        self.buffer += self.view[:n]
+        # ssl may hold decrypted data the poller can't see
+        while n and getattr(sock, 'pending', None) and sock.pending():
+            n = sock.recv_into(self.chunk)
+            self.buffer += self.view[:n]
+            total += n
+        return total
+
+    def lines(self):
+        """Return the complete lines read so far, without terminators. Lines
+        longer than maxlength are dropped and counted in overflows.
+
+        @rtype: list
+        @return: list of byte strings
+        """
+        buf = self.buffer
+        size = len(buf)
+        lines = []
+        start = 0
+        while start < size:
+            end = buf.find('\n', start)
+            cr = buf.find('\r', start, size if end == -1 else end)
+            if cr != -1:
+                end = cr
+            elif end == -1:
+                break
+            if self.discarding:
+                self.discarding = False
+            elif end - start > self.maxlength:
+                self.overflows += 1
+            elif end > start:
+                lines.append(bytes(buf[start:end]))
+            start = end + 1
+            if end == cr and start < size and buf[start] == 10: # \r\n
+                start += 1
+        if start:
+            del buf[:start]
+        if len(buf) > self.maxlength:
+            # no terminator in sight, drop what we have and the rest of it
+            del buf[:]
+            if not self.discarding:
+                self.overflows += 1
+            self.discarding = True
+        return lines
+
+class JabberConnection(object):
+    """Drives the component connection from an event loop, incoming stanzas
+    are parsed and dispatched as soon as the socket turns readable"""
+
+    def __init__(self, component, client):
+        """Constructor for JabberConnection Class
+
+        @type component: XmppComponent
+        @type client: Component
+        @param component: gateway told when the connection is lost, its lock
+        is held while dispatching
+        @param client: connected and authenticated xmpp component, None
+        before the first one is connected
+        """
+        self.component = component
+        self.client = client
+        self.logger = component.logger
+        self.lock = component.lock
+        self.connected = client is not None
+
+    def fileno(self):
+        return self.client.Connection._sock.fileno()
+
+    def handleRead(self):
+        with self.lock:
+            alive = self.client.Process(0)
+        if not alive:
+            self.logger.error('XMPP component connection lost')
+            self.component.loop.unregister(self)
+            self.handleClose()
+
+    def handleWrite(self):
+        pass
+
+    def handleClose(self):
+        """The connection is gone, close it and let the component reconnect"""
+        if not self.connected:
+            return
+        self.connected = False
+        try:
+            self.client.Connection._sock.close()
+        except:
             pass
-        self.client.disconnect()
+        self.component.connectionLost()
+
+    def closeStream(self):
+        """End the stream and close the connection right away, unlike
+        disconnect this doesn't wait for the server to end its stream and
+        handle what arrives meanwhile"""
         self.connected = False
+        if self.client is None:
+            return
+        try:
+            self.client.Connection.send('</stream:stream>')
+        except:
+            pass
+        self.client.Connection._sock.close()
+
+class XmppWriter(Thread):
+    """Thread writing outgoing stanzas to the component connection. Any
+    thread can queue stanzas without locking, everything queued since the
+    last write is serialized and sent in a single socket write."""
+
+    def __init__(self, client, logger, metrics):
+        """Constructor for XmppWriter class
+
+        @type client: Component
+        @type metrics: Metrics
+        @param client: connected xmpp component
+        @param metrics: where stanza counts and flush latency go
+        """
+        Thread.__init__(self, name='XmppWriter')
+        self.daemon = True
+        self.client = client
+        self.logger = logger
+        self.metrics = metrics
+        self.queue = collections.deque()
+        self.wakeup = Event()
+        self.running = True
+        self.stanzaId = 0
+
+    def put(self, stanza):
+        """Queue a stanza for sending, safe to call from any thread
+
+        @type stanza: Protocol
+        @param stanza: stanza to send
+        """
+        self.queue.append((stanza, time.time()))
+        self.wakeup.set()
+
+    def serialize(self, stanza):
+        """Render a stanza the way Dispatcher.send would before writing it
+
+        @type stanza: Protocol
+        @param stanza: stanza to render
+        @rtype: string
+        @return: utf-8 encoded stanza
+        """
+        if isinstance(stanza, Protocol) and not stanza.getID():
+            self.stanzaId += 1
+            stanza.setID('xmppircd%d' % self.stanzaId)
+        stanza.setNamespace(self.client.Namespace)
+        stanza.setParent(self.client.Dispatcher._metastream)
+        return ustr(stanza).encode('utf-8')
+
+    def flush(self):
+        """Write out everything queued so far"""
+        batch = list()
+        oldest = None
+        while self.queue:
+            stanza, queued = self.queue.popleft()
+            if oldest is None:
+                oldest = queued
+            try:
+                batch.append(self.serialize(stanza))
+            except:
+                self.logger.exception('Failed to serialize stanza')
+                continue
+            self.metrics.inc('xmppircd_stanzas_out_total', ('type', stanza.getName()))
+        if not batch:
+            return
+        self.client.Connection.send(''.join(batch))
+        self.metrics.observe('xmppircd_xmpp_flush_seconds', time.time() - oldest)
 
-class ClientThread(Thread):
-    """ ClientThread class for handling IRC and Jabber connections."""
+    def run(self):
+        while self.running:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+
+class ClientSession(object):
+    """ ClientSession class for handling IRC and Jabber connections."""
     def __init__(self,socket, port, server, muc_server, component):
-        """Constructor for ClientThread class
+        """Constructor for ClientSession class
 
         @type socket: socket
         @type port: integer
@@ -72,7 +874,39 @@ class ClientThread(Thread):
         @param socket: socket on which the connection is made
         @param port: port of the connection
         """
-        Thread.__init__(self)
+        self.loop = None
+        self.reader = IRCLineReader()
+
+        self.sendLock = Lock()
+        self.outbuf = bytearray()
+        self.flushScheduled = False
+        self.wantingWrite = False
+        self.retryLength = 0
+        self.closed = False
+        self.sendqLimit = component.options['sendq']
+        self.sendqPeak = 0
+        self.excessSendq = False
+        self.queuedBytes = 0
+        self.writtenBytes = 0
+        self.deliveries = collections.deque()
+
+        self.oper = False
+
+        # counted in the component's registering connections until welcomed
+        self.registering = False
+        self.registerTimer = None
+
+        # flood control, lines over the limits wait in held
+        self.buckets = makeBuckets(component.options['flood'])
+        self.held = collections.deque()
+        self.releaseTimer = None
+
+        # IRCv3 capabilities enabled by the client
+        self.caps = set()
+        self.capNegotiating = False
+        # rooms joined moments ago to [open chathistory batch or None, timer]
+        self.historyBatches = {}
+        self.batchIds = itertools.count(1)
 
         self.fullRoomJid = False
 
@@ -93,15 +927,11 @@ class ClientThread(Thread):
 
         self.connected = True
 
-        self.UIDtoJID = {}
+        self.privatePeers = collections.OrderedDict()
 
         self.nickChangeInMucs = {}
 
         self.joinQueue = {}
-        self.roomPingQueue = {}
-        self.disconnectedMucs = {}
-        self.changingNick = {}
-        self.pingCounter = 0
 
     def printError(self, msg):
         """Error message printing for std out
@@ -129,20 +959,14 @@ class ClientThread(Thread):
 
     def fixNick(self, nick):
         """Fixes strange character nicknames that don't work nicely with
-        IRC. This function may cause conflicts and thus unfinished.
+        IRC, see the module level fixNick
 
         @type nick: string
         @param nick: nickname to fix
         @rtype: string
         @return: fixed nick
         """
-        
-        fixednick = unicode(nick)
-        fixednick = fixednick.replace(' ', '_')
-        fixednick = fixednick.replace('!', '_')
-        fixednick = fixednick.replace(':', '_')
-        fixednick = fixednick.replace('@', '_')
-        return fixednick
+        return fixNick(nick)
 
     def fixChannel(self, channel):
         # fix roomname
@@ -161,15 +985,52 @@ class ClientThread(Thread):
             return "%s@%s" % (arguments[1:], self.muc_server)
 
     def makeHostFromJID(self, jid):
-        """ builds the host part from a given jid
+        """ builds the host part from a given jid, see the module level
+        makeHostFromJID
 
         @type jid: JID
         @param jid: The JID from which to make the host part
         @rtype string
         @return valid Host part
         """
+        return makeHostFromJID(jid)
+
+    def makePrefixFromJID(self, jid, room=None):
+        """Returns the nick!user@host prefix of a MUC occupant, rendered once
+        per occupant by its MucRoom
+
+        @type jid: JID
+        @type room: MucRoom
+        @param jid: occupant JID
+        @param room: the occupant's room if already known
+        @rtype: string
+        @return: message prefix without the leading colon
+        """
+        if room is None:
+            room = self.component.getRoom(jid.getStripped())
+        if room is not None:
+            prefix = room.prefixes.get(unicode(jid))
+            if prefix is not None:
+                return prefix
+        return '%s!%s' % (self.makeNickFromJID(jid, True), makeHostFromJID(jid))
+
+    def channelName(self, room_jid, room=None):
+        """Returns the IRC channel name of a room without the #, like
+        fixChannel but cached by the MucRoom
 
-        return "%s@%s/%s" % (urllib.quote(jid.getNode()), urllib.quote(jid.getDomain()), urllib.quote(jid.getResource()))
+        @type room_jid: JID
+        @type room: MucRoom
+        @param room_jid: JID of the room
+        @param room: the room if already known
+        @rtype: string
+        """
+        if room is None:
+            room = self.component.getRoom(room_jid)
+        if room is None:
+            return self.fixChannel(room_jid)
+        if self.fullRoomJid:
+            return room.name
+        return room.channel
 
         
     def makeNickFromJID(self, jid, is_muc_jid):
@@ -183,40 +1044,77 @@ class ClientThread(Thread):
         @return: valid IRC nick
         """
 
-        if is_muc_jid and not jid.getResource():
-            return self.fixNick(jid.getNode())
-
-        jid_string = u''
-        if not is_muc_jid:
-            jid_string = jid.getStripped()
-        else:
-            jid_string = unicode(jid)
-
-        if not is_muc_jid:
-            nick = self.fixNick(jid.getNode())
-        else:
-            nick = self.fixNick(jid.getResource())
-
-        self.UIDtoJID[nick] = JID(jid_string)
-
-        return nick
+        if not is_muc_jid or not jid.getResource():
+            return fixNick(jid.getNode())
+        return fixNick(jid.getResource())
 
     def getJIDFromNick(self, nick):
-        """Reverses obtains a JID corresponding to a nick generated by makeNickFromJID
+        """Reverses obtains a JID corresponding to a nick generated by makeNickFromJID.
+        Recent private message peers are looked up first, then the occupants
+        of the rooms we are in.
 
         @type nick: string
         @param nick: nickname from which to recover a JID
         @rtype: JID
         @return: JID corresponding to nick
         """
-
-        if self.UIDtoJID.has_key(nick):
-            return self.UIDtoJID[nick]
+        jid = self.privatePeers.get(nick)
+        if jid is not None:
+            del (self.privatePeers[nick])
+            self.privatePeers[nick] = jid
+            return jid
+        for room in self.mucs:
+            mucroom = self.component.getRoom(room)
+            if mucroom is not None and nick in mucroom.nicks:
+                return mucroom.nicks[nick]
         if nick.find('@') != -1:
             return JID(nick)
 
         return None
 
+    def rememberPeer(self, nick, jid):
+        """Remember who sent us a private message so replies to the nick
+        reach them, the least recently used peers are forgotten first
+
+        @type nick: string
+        @type jid: JID
+        @param nick: IRC nick of the peer
+        @param jid: JID of the peer
+        """
+        self.privatePeers.pop(nick, None)
+        self.privatePeers[nick] = jid
+        while len(self.privatePeers) > PRIVATEPEERS:
+            self.privatePeers.popitem(last=False)
+
+    def forgetPeer(self, jid):
+        """Forget a private message peer that left its room
+
+        @type jid: JID
+        @param jid: occupant JID of the peer
+        """
+        nick = fixNick(jid.getResource())
+        if self.privatePeers.get(nick) == jid:
+            del (self.privatePeers[nick])
+
+    def messageTags(self, timestamp=None, batch=None):
+        """Returns the IRCv3 tags of a line for the capabilities the client
+        enabled, with the separating space
+
+        @type timestamp: float
+        @type batch: string
+        @param timestamp: time the message was sent
+        @param batch: id of the batch the line belongs to
+        @rtype: string
+        """
+        tags = list()
+        if timestamp is not None and 'server-time' in self.caps:
+            tags.append('time=%s' % formatStamp(timestamp))
+        if batch is not None:
+            tags.append('batch=%s' % batch)
+        if not tags:
+            return ''
+        return '@%s ' % ';'.join(tags)
+
     def makeIRCACTION(self, msg):
         """Makes IRC action message
 
@@ -229,19 +1127,137 @@ class ClientThread(Thread):
         return msg
 
     def sendToIRC(self, msg):
-        """Sends message IRC client
+        """Queues message for the IRC client, the queue is written out by the
+        event loop once the current burst of messages is done
 
         @type msg: string
         @param msg: message to send
         """
+        parts = msg.split(' ', 2)
+        if msg.startswith(':') and len(parts) > 1:
+            self.component.metrics.inc('xmppircd_irc_lines_out_total', ('command', parts[1]))
+        else:
+            self.component.metrics.inc('xmppircd_irc_lines_out_total', ('command', parts[0]))
         msg = msg.encode('utf-8')
-        msg = "%s\r\n" % msg
         self.printDebug(msg)
-        try:
-            self.socket.send(msg)
-        except:
-            self.connected = False
-            self.printError('Fatal error while trying to write irc message to socket, disconnecting [%s - %s]' % (sys.exc_info()[0], sys.exc_info()[1]))
+        self.queueToIRC(msg + '\r\n')
+
+    def queueToIRC(self, data):
+        """Queue encoded lines for the IRC client as they are, sendToIRC
+        without the per line work
+
+        @type data: string
+        @param data: utf-8 encoded lines, each ending with CRLF
+        """
+        with self.sendLock:
+            if self.closed or self.excessSendq:
+                return
+            if len(self.outbuf) + len(data) > self.sendqLimit:
+                # the client isn't reading, drop it rather than buffering
+                # without bounds
+                self.excessSendq = True
+                del self.outbuf[:]
+                self.deliveries.clear()
+                self.outbuf += 'ERROR :Closing Link: %s (Excess SendQ)\r\n' % (self.nickname or '*').encode('utf-8')
+                self.loop.callSoon(self.closeExcessSendq)
+                return
+            self.outbuf += data
+            self.queuedBytes += len(data)
+            if len(self.outbuf) > self.sendqPeak:
+                self.sendqPeak = len(self.outbuf)
+            if self.flushScheduled or self.wantingWrite:
+                return
+            self.flushScheduled = True
+        self.loop.callSoon(self.flushToIRC)
+
+    def closeExcessSendq(self):
+        """Disconnect a client that let its send queue grow past the limit"""
+        if self.closed:
+            return
+        self.printError('Excess SendQ (%d bytes), disconnecting %s' % (self.sendqLimit, self.nickname))
+        self.component.excessSendqCount += 1
+        self.loop.unregister(self)
+        self.handleClose()
+
+    def sendqDepth(self):
+        """Return the number of bytes queued for the IRC client"""
+        return len(self.outbuf)
+
+    def flushToIRC(self):
+        """Write out the queued messages, runs on the loop thread"""
+        self.flushScheduled = False
+        if not self.closed and not self.writeToIRC():
+            self.loop.unregister(self)
+            self.handleClose()
+
+    def writeToIRC(self):
+        """Write as much of the output buffer as the socket accepts without
+        blocking, waiting for writability when something is left over
+
+        @rtype: boolean
+        @return: False if the connection failed
+        """
+        with self.sendLock:
+            while self.outbuf:
+                # ssl wants a retried write to repeat the same length
+                size = self.retryLength or min(len(self.outbuf), 65536)
+                try:
+                    if size < len(self.outbuf):
+                        sent = self.socket.send(self.outbuf[:size])
+                    else:
+                        sent = self.socket.send(self.outbuf)
+                except ssl.SSLError, e:
+                    if e.args[0] not in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                        break
+                    self.retryLength = size
+                    self.setWantWrite(True)
+                    return True
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        break
+                    self.setWantWrite(True)
+                    return True
+                self.retryLength = 0
+                del self.outbuf[:sent]
+                self.writtenBytes += sent
+                if self.deliveries and self.deliveries[0][0] <= self.writtenBytes:
+                    self.observeDeliveries()
+            else:
+                self.setWantWrite(False)
+                return True
+        self.connected = False
+        self.printError('Fatal error while trying to write irc message to socket, disconnecting [%s - %s]' % (sys.exc_info()[0], sys.exc_info()[1]))
+        return False
+
+    def markDelivery(self, received):
+        """Remember that everything queued so far relays a stanza received at
+        the given time, the latency is recorded once it is written out
+
+        @type received: float
+        @param received: time the stanza was read from the XMPP stream
+        """
+        with self.sendLock:
+            self.deliveries.append((self.queuedBytes, received))
+
+    def observeDeliveries(self):
+        """Record the latency of the relayed stanzas that are fully written"""
+        now = time.time()
+        while self.deliveries and self.deliveries[0][0] <= self.writtenBytes:
+            offset, received = self.deliveries.popleft()
+            self.component.metrics.observe('xmppircd_groupchat_delivery_seconds', now - received)
+
+    def setWantWrite(self, want):
+        """Watch or stop watching the IRC socket for writability
+
+        @type want: boolean
+        @param want: whether we have output the socket didn't take yet
+        """
+        if want != self.wantingWrite and not self.closed:
+            self.wantingWrite = want
+            events = EventLoop.READ
+            if want:
+                events |= EventLoop.WRITE
+            self.loop.modify(self, events)
 
     def sendToXMPP(self, msg):
         """Sends message XMPP server
@@ -265,9 +1281,12 @@ class ClientThread(Thread):
         sta = 'H'
         show = ''
         role = ''
-        if self.mucs.has_key(room_jid):
-            show = self.mucs[room_jid][jid]['show']
-            role = self.mucs[room_jid][jid]['role']
+        occupant = None
+        if room_jid in self.mucs:
+            occupant = self.mucs[room_jid].get(unicode(jid))
+        if occupant is not None:
+            show = occupant.show
+            role = occupant.role
         if show in ['away','xa', 'dnd']:
             sta = 'G'
         if role == 'moderator':
@@ -282,22 +1301,14 @@ class ClientThread(Thread):
         @type jid: JID
         @param jid: The MUC JID for which to generate a JOIN message
         """
-        nick = self.makeNickFromJID(jid, True)
         channel = jid.getStripped()
-        msg = ':%s!%s JOIN :#%s' % (
-            nick,
-            self.makeHostFromJID(jid),
-            self.fixChannel(channel))
+        room = self.component.getRoom(channel)
+        msg = ':%s JOIN :#%s' % (
+            self.makePrefixFromJID(jid, room),
+            self.channelName(channel, room))
         self.sendToIRC(msg)
-
-        role = self.mucs[channel][jid]['role']
-        args = ''
-        if role == 'moderator':
-            args = '+o'
-        elif role == 'participant':
-            args = '+v'
-        if args:
-            self.ircCommandMODEMUCUSER(JID(channel), jid, args)
+        # the +o or +v of the new occupant follows with the room's next
+        # batch of mode changes, see XmppComponent.flushModes
 
     def ircCommandSELFJOIN(self, room_jid):
         """IRC command join channel
@@ -307,22 +1318,32 @@ class ClientThread(Thread):
         """
         snick = self.nickname
         lines = list()
-        channel = self.fixChannel(room_jid)
+        channel = self.channelName(room_jid)
         lines.append(':%s JOIN :#%s'% (snick, channel))
         lines.append(':%s MODE #%s +n' % (self.server, channel))
         
-        for jid in self.mucs[room_jid].iterkeys():
-            nick = snick
-            if (jid.getResource() != nick):
-                nick = self.makeNickFromJID(jid, True)
-            if self.mucs[room_jid][jid]['role'] == 'moderator':
+        # as many nicks per 353 line as fit in the 512 byte line limit
+        prefix = ':%s 353 %s = #%s :' % (self.server, snick, channel)
+        space = 510 - len(prefix.encode('utf-8'))
+        names = list()
+        size = -1
+        for occupant in self.mucs[room_jid].itervalues():
+            nick = occupant.nick
+            if occupant.role == 'moderator':
                 nick = "@%s" % nick
-            elif self.mucs[room_jid][jid]['role'] == 'participant':
+            elif occupant.role == 'participant':
                 nick = "+%s" % nick
-            lines.append(':%s 353 %s = #%s :%s' % (self.server, snick, channel, nick))
+            length = len(nick.encode('utf-8')) + 1
+            if names and size + length > space:
+                lines.append(prefix + ' '.join(names))
+                names = list()
+                size = -1
+            names.append(nick)
+            size += length
+        if names:
+            lines.append(prefix + ' '.join(names))
         lines.append(':%s 366 %s #%s :End of /NAMES list.'% (self.server, snick, channel))
-        while lines:
-            msg = lines.pop(0)
+        for msg in lines:
             self.sendToIRC(msg)
 
     def ircCommandPART(self, jid, text):
@@ -333,11 +1354,10 @@ class ClientThread(Thread):
         @param jid: The MUC JID for which to generate a PART message
         @param text: the part message
         """
-        nick = self.makeNickFromJID(jid, True)
-        msg = ':%s!%s PART #%s :%s' % (
-            nick,
-            self.makeHostFromJID(jid),
-            self.fixChannel(jid.getStripped()),
+        room = self.component.getRoom(jid.getStripped())
+        msg = ':%s PART #%s :%s' % (
+            self.makePrefixFromJID(jid, room),
+            self.channelName(jid.getStripped(), room),
             text)
         self.sendToIRC(msg)
         
@@ -350,44 +1370,66 @@ class ClientThread(Thread):
         @param new_jid: JID after the nick change
         """
         
-        msg = ':%s!%s NICK :%s' % (
-            self.makeNickFromJID(old_jid, True),
-            self.makeHostFromJID(old_jid),
+        msg = ':%s NICK :%s' % (
+            self.makePrefixFromJID(old_jid),
             self.makeNickFromJID(new_jid, True))
         self.sendToIRC(msg)
 
-    def ircCommandPRIVMSG(self, jid, is_muc, is_private, text, timestamp=''):
+    def ircCommandPRIVMSG(self, jid, is_muc, is_private, text, timestamp=None, batch=None):
         """Converts private messages to IRC client
 
         @type jid: JID
         @type is_muc: boolean
         @type text: string
-        @type timestamp: string
+        @type timestamp: float
+        @type batch: string
         @param jid: the JID from which the mesage was sent
         @param is_muc: whether the message was sent in a muc
         @param text: the message
-        @param timestamp: timestamp of the message
+        @param timestamp: time a delayed message was sent, a server-time tag
+        or inlined into the text for clients without server-time
+        @param batch: id of the batch the message belongs to
+        """
+        room = None
+        if is_muc:
+            room = self.component.getRoom(jid.getStripped())
+        if is_muc and jid.getResource():
+            prefix = self.makePrefixFromJID(jid, room)
+        else:
+            prefix = '%s!%s' % (self.makeNickFromJID(jid, is_muc), makeHostFromJID(jid))
+        if is_muc and not is_private:
+            target = '#%s' % self.channelName(jid.getStripped(), room)
+        else:
+            target = self.nickname
+        tags = self.messageTags(timestamp, batch)
+        inline = None
+        if timestamp is not None and 'server-time' not in self.caps:
+            inline = datetime.datetime.utcfromtimestamp(int(timestamp))
+        for line in self.privmsgLines(text, inline):
+            self.sendToIRC('%s:%s PRIVMSG %s :%s' % (tags, prefix, target, line))
+
+    def privmsgLines(self, text, inline=None):
+        """Split a message into the texts of its PRIVMSG lines, /me lines
+        become actions
+
+        @type text: string
+        @type inline: datetime
+        @param text: the message
+        @param inline: time to put in front of every line
+        @rtype: list
         """
-        nick = self.makeNickFromJID(jid, is_muc)
-        lines = text.splitlines()
-        messages = list()
-        for line in lines:
+        lines = list()
+        for line in text.splitlines():
             action = False
             if line.upper().startswith('/ME '):
                 line = line[4:]
                 action = True
-            if timestamp:
-                line = "[%s] %s " % (timestamp, line)
+            if inline is not None:
+                line = "[%s] %s " % (inline, line)
             if action:
                 line = self.makeIRCACTION(line)
-
-            if is_muc and not is_private:
-                msg = ':%s!%s PRIVMSG #%s :%s' % (nick, self.makeHostFromJID(jid), self.fixChannel(jid.getStripped()), line)
-            else:
-                msg = ':%s!%s PRIVMSG %s :%s' % (nick, self.makeHostFromJID(jid), self.nickname,line)
-            messages.append(msg)
-        for msg in messages:
-            self.sendToIRC(msg)
+            lines.append(line)
+        return lines
 
     def ircCommandTOPIC(self, jid, topic):
         """Converts MUC topic to IRC channel topic
@@ -397,8 +1439,8 @@ class ClientThread(Thread):
         @param jid: The jid who initiated the topic change
         @param topic: the topic
         """
-        nick = self.makeNickFromJID(jid, True)
-        msg =':%s!%s TOPIC #%s :%s' % (nick, self.makeHostFromJID(jid), self.fixChannel(jid.getStripped()), topic)
+        room = self.component.getRoom(jid.getStripped())
+        msg =':%s TOPIC #%s :%s' % (self.makePrefixFromJID(jid, room), self.channelName(jid.getStripped(), room), topic)
         self.sendToIRC(msg)
 
     def ircCommandMODEMUC(self, room_jid, args):
@@ -426,23 +1468,66 @@ class ClientThread(Thread):
         msg = ':%s 368 %s #%s :End of Channel Ban List' % (self.server, nick, self.fixChannel(room_jid))
         self.sendToIRC(msg)
 
-    def ircCommandMODEMUCUSER(self, giver, taker, args):
-        """Convers MUC user mode to IRC channel user mode. Example use cases
-        are when someone is granted a voice or admin rights on a MUC.
+    def ircCommandMODEROLES(self, room, changes):
+        """Converts a batch of MUC role changes to IRC channel user modes,
+        up to MAXMODES per MODE line
 
-        @type giver: JID
-        @type taker: JID
-        @type args: string
-        @param giver: The user initiating the mode change
-        @param taker: The user affected by the mode change
-        @param args: arguments of the mode
+        @type room: MucRoom
+        @type changes: list
+        @param room: the room the roles changed in
+        @param changes: (sign, mode, nick, jid, joined) tuples from
+        MucRoom.takeModes
         """
-        msg = ':%s!%s MODE #%s %s %s' % (self.makeNickFromJID(giver, True),
-                                         self.makeHostFromJID(giver),
-                                         self.fixChannel(taker.getStripped()),
-                                         args,
-                                         self.makeNickFromJID(taker, True))
-        self.sendToIRC(msg)
+        prefix = self.makePrefixFromJID(JID('%s/telepaatti' % room.name), room)
+        head = ':%s MODE #%s ' % (prefix, self.channelName(room.jid, room))
+        space = 510 - len(head.encode('utf-8'))
+        modes = list()
+        nicks = list()
+        size = 0
+        for sign, mode, nick, jid, joined in changes:
+            if joined and self.ownsOccupant(jid):
+                # our own join shows the roles in NAMES
+                continue
+            length = len(nick.encode('utf-8')) + 3
+            if nicks and (len(nicks) == MAXMODES or size + length > space):
+                self.sendToIRC(head + self.joinModes(modes, nicks))
+                modes = list()
+                nicks = list()
+                size = 0
+            modes.append((sign, mode))
+            nicks.append(nick)
+            size += length
+        if nicks:
+            self.sendToIRC(head + self.joinModes(modes, nicks))
+
+    def joinModes(self, modes, nicks):
+        """Render MODE arguments like +oo-v a b c
+
+        @type modes: list
+        @type nicks: list
+        @param modes: (sign, mode) tuples
+        @param nicks: the nick each mode applies to
+        @rtype: string
+        """
+        chars = list()
+        last = None
+        for sign, mode in modes:
+            if sign != last:
+                chars.append(sign)
+                last = sign
+            chars.append(mode)
+        return '%s %s' % (''.join(chars), ' '.join(nicks))
+
+    def ownsOccupant(self, jid):
+        """Tell if an occupant JID is this session's own presence in a MUC,
+        also while a nick change is in progress
+
+        @type jid: JID
+        @param jid: occupant JID
+        @rtype: boolean
+        """
+        resource = jid.getResource()
+        return resource == self.nickname or (self.newnick and resource == self.newnick)
 
     def ircCommandMODE(self, args):
         """Converts XMPP mode to IRC mode. Unfinished
@@ -488,6 +1573,8 @@ class ClientThread(Thread):
             text = 'No such channel'
         elif number == 404:
             text = 'Cannot send to channel'
+        elif number == 437:
+            text = 'Nick/channel is temporarily unavailable'
         elif number == 467:
             text = 'Channel key already set'
         elif number == 471:
@@ -526,7 +1613,7 @@ class ClientThread(Thread):
         """
         channel = self.fixChannel(room_jid)
         for user in users:
-            nick = self.makeNickFromJID(user, True),
+            nick = self.makeNickFromJID(user, True)
             msg = ':%s 352 %s #%s %s %s %s %s %s :0 %s' % (
                 self.server,
                 self.nickname,
@@ -582,6 +1669,29 @@ class ClientThread(Thread):
         msg = ':%s 323 %s :End of /LIST' % (self.server, self.nickname)
         self.sendToIRC(msg)
 
+    def ircCommandMUCLOST(self, room_jid):
+        """Tell the IRC client a MUC it is in stopped answering
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        self.ircCommandERRORMUC(404, 'MUC DISCONNECTED', room_jid)
+        self.ircCommandPRIVMSG(JID("%s/%s" % (room_jid, 'telepaatti')),
+                               True,
+                               False,
+                               'MUC IS DISCONNECTED YOUR TEXT WILL NOT SHOW ON CHANNEL. YOU CAN WAIT UNTIL MUC CONNECTS AGAIN OR USE /PART TO LEAVE THIS MUC!')
+
+    def ircCommandMUCBACK(self, room_jid):
+        """Tell the IRC client a lost MUC answers again
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        self.ircCommandPRIVMSG(JID("%s/%s" % (room_jid, 'telepaatti')),
+                               True,
+                               False,
+                               'MUC IS CONNECTED AGAIN.')
+
     def ircCommandUNAWAY(self):
         """Convert XMPP status to IRC away"""
         nick = self.nickname
@@ -616,11 +1726,7 @@ class ClientThread(Thread):
         @type jid: string
         @param jid: Jabber id of the MUC
         """
-        iq = protocol.Iq(to=jid,
-                         queryNS=NS_DISCO_INFO,
-                         typ = 'get')
-        iq.setID('disco3')
-        self.sendToXMPP(iq)
+        self.component.disco.query(self, jid, NS_DISCO_INFO, self.iqHandlerInfo, self.iqHandlerError)
 
     def xmppCommandMUCUSERS(self, jid):
         """Send XMPP MUC users query
@@ -628,20 +1734,14 @@ class ClientThread(Thread):
         @type jid: string
         @param jid: Jabber id of the MUC
         """
-        iq = protocol.Iq(to=jid,
-                         queryNS=NS_DISCO_ITEMS,
-                         typ = 'get')
-        iq.setID('disco_muc_users')
-        self.sendToXMPP(iq)
+        self.component.disco.query(self, jid, NS_DISCO_ITEMS, self.iqHandlerMucUsers, self.iqHandlerError,
+                                   lambda: self.ircCommandWHO([], jid))
 
     def xmppCommandMUCROOMS(self):
         """Send XMPP MUC rooms query
         """
-        iq = protocol.Iq(to=self.muc_server,
-                         queryNS=NS_DISCO_ITEMS,
-                         typ = 'get')
-        iq.setID('disco_muc_rooms')
-        self.sendToXMPP(iq)
+        self.component.disco.query(self, self.muc_server, NS_DISCO_ITEMS, self.iqHandlerMucRooms, self.iqHandlerError,
+                                   lambda: self.ircCommandLIST([]))
 
     def xmppCommandSTATUS(self, show, status):
         """Send XMPP status change
@@ -651,7 +1751,7 @@ class ClientThread(Thread):
         @param show: status
         @param status: status
         """
-        for muc in self.mucs.keys():
+        for muc in self.mucs:
             p=Presence(to='%s/%s' % (
                        muc,
                        self.nickname))
@@ -709,14 +1809,13 @@ class ClientThread(Thread):
         iq = protocol.Iq(to=jid,
                          typ = 'get')
         iq.setTag(NS_VCARD + ' vCard')
-        iq.setID('v3')
-        self.sendToXMPP(iq)
+        self.component.tracker.request(self, iq, self.iqHandlerVcard, self.iqHandlerVcardError)
 
         # last activity
         iq = protocol.Iq(to=jid,
                          typ = 'get',
                          queryNS=NS_LAST)
-        self.sendToXMPP(iq)
+        self.component.tracker.request(self, iq, self.iqHandlerLast, self.iqHandlerLastError)
 
         # software version
         # todo: looks at roster which doesn't exist, fix this
@@ -731,7 +1830,7 @@ class ClientThread(Thread):
         iq = protocol.Iq(to=jid,
                          typ = 'get',
                          queryNS=NS_VERSION)
-        self.sendToXMPP(iq)
+        self.component.tracker.request(self, iq, self.iqHandlerVersion, self.iqHandlerVersionError)
 
     def xmppCommandINFOGET(self, jid):
         """Not finished """
@@ -745,102 +1844,357 @@ class ClientThread(Thread):
         """Send last activity XMPP. Not finished """
         pass
 
-    def run(self):
+    def fileno(self):
+        """Return the file descriptor of the IRC socket, used by EventLoop"""
+        return self.socket.fileno()
+
+    def start(self, loop):
+        """Attach this session to an event loop and start serving the IRC
+        client on it
+
+        @type loop: EventLoop
+        @param loop: the loop that will poll this session's socket
+        """
+        self.loop = loop
+        self.socket.setblocking(0)
         self.component.registerJid(self)
+        self.registerTimer = loop.callLater(REGISTERTIMEOUT, self.registrationExpired)
+        loop.register(self, EventLoop.READ)
 
-        while self.connected and self.nickname is None:
-            try:
-                data = self.socket.recv(4096)
-            except:
-                self.printError('Not receiving enough data from socket')
-                self.connected = False
-            if data:
-                for line in data.splitlines():
-                    self.commandHandler(line)
-            else:
-                self.connected = False
+    def xmppLost(self):
+        """The component connection is down, joins in progress fail"""
+        if self.nickname is None:
+            return
+        self.ircCommandNOTICE('XMPP server disconnected, messages are not relayed until it is back')
+        for room in self.joinQueue.keys():
+            self.ircCommandERRORMUC(437, 'XMPP server disconnected, try again later', room)
+            # in case the MUC let us in before the connection went
+            self.sendToXMPP(Presence(to='%s/%s' % (room, self.nickname), typ='unavailable'))
+            self.component.leaveRoom(room, self)
+        self.joinQueue.clear()
+
+    def xmppBack(self):
+        """The component connection is back, the rooms are joined again"""
+        if self.nickname is None:
+            return
+        self.ircCommandNOTICE('XMPP server reconnected, rejoining %d rooms' % (len(self.mucs)))
 
-        if self.connected:
-            nick = self.nickname
-            lines = ["NOTICE AUTH :*** Looking up your hostname...",
-                     "NOTICE AUTH :*** Found your hostname, welcome back",
-                     "NOTICE AUTH :*** Checking ident",
-                     "NOTICE AUTH :*** No identd (auth) response",
-                     ":%s 001 %s :Welcome to xmpp-ircd, IRC to XMPP gateway %s!%s" %
-                         (self.server, nick, nick, self.makeHostFromJID(self.JID)),
-                     ":%s 002 %s :Your host is %s [%s port %s] running version xmpp-ircd-%s" % (
-                         self.server,
-                         nick,
-                         self.server,
-                         self.server,
-                         self.port,
-                         XMPPIRCDVERSION),
-                     ":%s 003 %s :This server was created %s" % (self.server, nick, self.component.startup_time),
-                     ":%s 004 %s :%s xmpp-ircd%s spmAFkPBaTuUovbn q" % (self.server, nick, self.server, XMPPIRCDVERSION)
-                     ]
-            while lines:
-                self.sendToIRC(lines.pop(0))
-
-        """Here is this threads main functionality. Jabber-thread is started
-        and polling of socket for IRC-messages is in here."""
-        jt = self.component.jt
-
-        while self.connected and jt.connected:
-            try:
-                data = self.socket.recv(4096)
-            except:
-                self.printError('Not receiving enough data from socket')
-                self.connected = False
-            if data.find ( 'PING' ) != -1:
-                # check that our rooms are still alive
-                if self.pingCounter == 5:
-                    self.pingCounter = 0
-                    for muc in self.mucs.keys():
-                        if self.disconnectedMucs.has_key(muc):
-                            if self.disconnectedMucs[muc] < 5:
-                                self.disconnectedMucs[muc] = self.disconnectedMucs[muc] + 1
-                            else:
-                                self.disconnectedMucs[muc] = 0
-                                self.roomPingQueue[muc] = ''
-                                self.xmppCommandMUCMODE(muc)
-                        else:
-                            self.roomPingQueue[muc] = ''
-                            self.xmppCommandMUCMODE(muc)
-                else:
-                    self.pingCounter += 1
-                self.sendToIRC('PONG %s' % (self.server))
-            if data:
-                for line in data.splitlines():
-                    self.commandHandler(line)
-            else:
-                self.connected = False
-        if jt.connected:
-            # leave all rooms
-            for room in self.mucs.keys():
-                self.sendToXMPP(Presence(to='%s/%s' % (room, self.nickname),
-                                     typ='unavailable',
-                                     status=''))
+    def rejoinFailed(self, room_jid):
+        """A room couldn't be joined again after a reconnect, the IRC client
+        leaves it
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        if room_jid not in self.mucs:
+            return
+        self.endHistoryBatch(room_jid)
+        self.ircCommandPART(JID('%s/%s' % (room_jid, self.nickname)), 'rejoin failed')
+        del (self.mucs[room_jid])
+        self.component.leaveRoom(room_jid, self)
+
+    def exportState(self):
+        """The state of this session in a form json can carry to the
+        gateway process taking over its socket. Lines waiting for the flood
+        limits go back in front of the unread input.
+
+        @rtype: dict
+        """
+        held = ''.join(msg.line.encode('utf-8') + '\r\n' for msg in self.held)
+        return {'jid': self.bare_jid,
+                'nick': self.nickname,
+                'rooms': [unicode(room) for room in self.mucs],
+                'joining': [(unicode(room), join['password']) for room, join in self.joinQueue.iteritems()],
+                'caps': sorted(self.caps),
+                'capNegotiating': self.capNegotiating,
+                'fullRoomJid': self.fullRoomJid,
+                'oper': self.oper,
+                'peers': [(nick, unicode(jid)) for nick, jid in self.privatePeers.iteritems()],
+                # bytes, latin-1 maps them to code points one to one
+                'input': (held + bytes(self.reader.buffer)).decode('latin-1'),
+                'output': bytes(self.outbuf).decode('latin-1')}
+
+    def restoreState(self, state):
+        """Take over the state of a session from the previous gateway
+        process, the rooms it is in must be restored already. The session
+        is served once resume runs on its loop.
+
+        @type state: dict
+        @param state: what exportState returned there
+        """
+        if state['nick'] is None:
+            self.component.registerJid(self)
         else:
-            self.ircCommandNOTICE('XMPP server disconnected, shutting down xmpp-ircd.')
-        self.component.unregisterJid(self)
-        try:
-            self.socket.shutdown(socket.SHUT_RDWR)
-        except socket.error:
-            self.printError('Socket shutdown client')
-        self.socket.close()
+            self.bare_jid = state['jid']
+            self.JID = JID(self.bare_jid)
+            self.component.clients[self.bare_jid] = self
+        self.nickname = state['nick']
+        self.caps = set(state['caps'])
+        self.capNegotiating = state['capNegotiating']
+        self.fullRoomJid = state['fullRoomJid']
+        self.oper = state['oper']
+        for nick, jid in state['peers']:
+            self.privatePeers[nick] = JID(jid)
+        self.reader.buffer += state['input'].encode('latin-1')
+        self.outbuf += state['output'].encode('latin-1')
+        for name in state['rooms']:
+            room = self.component.getRoom(name)
+            if room is not None:
+                self.mucs[room.jid] = room.occupants
+                self.component.attachRoom(room.jid, self)
+        # the answer to a join may have reached the previous process or
+        # nobody, the join is sent again
+        for name, password in state['joining']:
+            self.joinQueue[JID(name)] = {'started': time.time(), 'password': password}
+            self.component.requestJoin(JID(name), self, self.joinPresence(name, password))
+
+    def resume(self, loop):
+        """Attach a session taken over from the previous gateway process
+        to an event loop, runs on the loop thread
+
+        @type loop: EventLoop
+        @param loop: the loop that will poll this session's socket
+        """
+        self.loop = loop
+        self.socket.setblocking(0)
+        if self.nickname is None:
+            self.registerTimer = loop.callLater(REGISTERTIMEOUT, self.registrationExpired)
+        loop.register(self, EventLoop.READ)
+        if self.outbuf:
+            self.flushToIRC()
+        if not self.component.isConnected():
+            self.xmppLost()
+        if self.reader.buffer and not self.closed:
+            self.handleInput()
+            if not self.connected:
+                self.loop.unregister(self)
+                self.handleClose()
+
+    def endRegistration(self):
+        """Stop the registration timeout and give back the admission slot
+        of the connection"""
+        if self.registerTimer is not None:
+            self.registerTimer.cancel()
+            self.registerTimer = None
+        if self.registering:
+            self.registering = False
+            with self.component.lock:
+                self.component.registering -= 1
+
+    def registrationExpired(self):
+        """Drop a connection that didn't register in time"""
+        with self.component.lock:
+            if self.registerTimer is None:
+                return
+            self.registerTimer = None
+            self.component.metrics.inc('xmppircd_registration_timeouts_total')
+            self.sendToIRC('ERROR :Closing Link: %s (Registration timed out)' % (self.nickname or '*'))
+            self.connected = False
+        if not self.closed:
+            self.loop.unregister(self)
+            self.handleClose()
 
-    def messageHandlerError(self, sess, mess):
-        """Handle incoming error messages from XMPP
+    def sendWelcome(self):
+        """Send the registration burst once the IRC client has picked a nick"""
+        self.endRegistration()
+        nick = self.nickname
+        lines = ["NOTICE AUTH :*** Looking up your hostname...",
+                 "NOTICE AUTH :*** Found your hostname, welcome back",
+                 "NOTICE AUTH :*** Checking ident",
+                 "NOTICE AUTH :*** No identd (auth) response",
+                 ":%s 001 %s :Welcome to xmpp-ircd, IRC to XMPP gateway %s!%s" %
+                     (self.server, nick, nick, self.makeHostFromJID(self.JID)),
+                 ":%s 002 %s :Your host is %s [%s port %s] running version xmpp-ircd-%s" % (
+                     self.server,
+                     nick,
+                     self.server,
+                     self.server,
+                     self.port,
+                     XMPPIRCDVERSION),
+                 ":%s 003 %s :This server was created %s" % (self.server, nick, self.component.startup_time),
+                 ":%s 004 %s :%s xmpp-ircd%s spmAFkPBaTuUovbn q" % (self.server, nick, self.server, XMPPIRCDVERSION)
+                 ]
+        support = ['MODES=%d' % MAXMODES]
+        if self.component.history is not None:
+            support.append('CHATHISTORY=%d' % CHATHISTORYLIMIT)
+        lines.append(":%s 005 %s %s :are supported by this server" % (self.server, nick, ' '.join(support)))
+        while lines:
+            self.sendToIRC(lines.pop(0))
 
-        @type sess: string
-        @type mess: Message
-        @param sess: session
-        @param mess: error message
+    def handleLine(self, line):
+        """Decode and parse a line read from the IRC client
 
+        @type line: string
+        @param line: raw line without its terminator
         """
-        text = ''
         try:
-            text = mess.getTag('error').getTag('text').getData()
+            line = line.decode('utf-8')
+        except exceptions.UnicodeDecodeError:
+            self.printError('Unicode decode error. Your IRC client is (probably) not writing utf-8')
+            self.ircCommandERROR('Input form IRC client was not in utf-8. Turn utf-8 support on from your IRC client or input only pure ascii',-1)
+            return
+        msg = IRCMessage(line)
+        if self.held or self.throttled(msg):
+            # fakelag, the line and everything after it waits its turn
+            self.component.metrics.inc('xmppircd_irc_throttled_total',
+                                       ('class', COMMANDCLASSES.get(msg.command, 'other')))
+            self.held.append(msg)
+            if len(self.held) > MAXHELDLINES:
+                self.component.metrics.inc('xmppircd_irc_excess_flood_total')
+                self.sendToIRC('ERROR :Closing Link: %s (Excess Flood)' % (self.nickname or '*'))
+                self.connected = False
+            return
+        self.handleMessage(msg)
+
+    def throttled(self, msg):
+        """Tell if a line is over the flood limits, a release of the held
+        lines is then scheduled for when it is within them. Lines within the
+        limits use up their tokens.
+
+        @type msg: IRCMessage
+        @param msg: parsed line
+        @rtype: boolean
+        """
+        name = COMMANDCLASSES.get(msg.command)
+        if name is None or self.nickname is None:
+            return False
+        bucket = self.buckets.get(name)
+        shared = self.component.floodBuckets.get(name)
+        now = time.time()
+        wait = 0
+        if bucket is not None:
+            wait = bucket.wait(now)
+        if shared is not None:
+            wait = max(wait, shared.wait(now))
+        if wait > 0:
+            if self.releaseTimer is None:
+                self.releaseTimer = self.loop.callLater(wait, self.releaseHeld)
+            return True
+        if bucket is not None:
+            bucket.take()
+        if shared is not None:
+            shared.take()
+        return False
+
+    def releaseHeld(self):
+        """Handle the held lines that are within the flood limits now"""
+        with self.component.lock:
+            self.releaseTimer = None
+            while self.held and self.connected and not self.closed:
+                if self.throttled(self.held[0]):
+                    return
+                self.handleMessage(self.held.popleft())
+        if not self.connected and not self.closed:
+            self.loop.unregister(self)
+            self.handleClose()
+
+    def handleMessage(self, msg):
+        """Handle a parsed line from the IRC client
+
+        @type msg: IRCMessage
+        @param msg: parsed line
+        """
+        registered = self.nickname is not None
+        if msg.command in IRCCOMMANDS:
+            self.component.metrics.inc('xmppircd_irc_lines_in_total', ('command', msg.command))
+        else:
+            self.component.metrics.inc('xmppircd_irc_lines_in_total', ('command', 'OTHER'))
+        self.commandHandler(msg)
+        if not registered and self.connected and self.nickname is not None \
+                and not self.capNegotiating:
+            self.sendWelcome()
+
+    def handleRead(self):
+        """Called by the event loop when the IRC socket is readable"""
+        try:
+            read = self.reader.readFrom(self.socket)
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            self.printError('Not receiving enough data from socket')
+            read = 0
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.printError('Not receiving enough data from socket')
+            read = 0
+        if read:
+            self.handleInput()
+        else:
+            self.connected = False
+
+        if not self.connected:
+            self.loop.unregister(self)
+            self.handleClose()
+
+    def handleInput(self):
+        """Handle the complete lines read so far"""
+        overflows = self.reader.overflows
+        with self.component.lock:
+            for line in self.reader.lines():
+                self.handleLine(line)
+                if not self.connected:
+                    break
+        if self.reader.overflows != overflows:
+            self.sendToIRC(':%s 417 %s :Input line was too long' % (self.server, self.nickname or '*'))
+
+    def handleWrite(self):
+        """Called by the event loop when the IRC socket is writable"""
+        if not self.writeToIRC():
+            self.loop.unregister(self)
+            self.handleClose()
+
+    def handleClose(self):
+        """Leave the XMPP side and close the IRC connection"""
+        if self.closed:
+            return
+        self.endRegistration()
+        with self.component.lock:
+            self.leaveXMPP()
+        with self.sendLock:
+            self.closed = True
+        # last chance for what is still queued, without waiting for it
+        self.writeToIRC()
+        del self.outbuf[:]
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            self.printError('Socket shutdown client')
+        self.socket.close()
+
+    def leaveXMPP(self):
+        """Leave all rooms and give up the component JID of this session"""
+        self.connected = False
+        # leave all rooms, while the component is disconnected the
+        # presences wait for it to be back
+        for room in self.mucs:
+            self.sendToXMPP(Presence(to='%s/%s' % (room, self.nickname),
+                                 typ='unavailable',
+                                 status=''))
+        for room in self.mucs.keys() + self.joinQueue.keys():
+            self.component.leaveRoom(room, self)
+        for pending in self.historyBatches.values():
+            pending[1].cancel()
+        self.historyBatches.clear()
+        if self.releaseTimer is not None:
+            self.releaseTimer.cancel()
+            self.releaseTimer = None
+        self.held.clear()
+        self.component.tracker.cancelSession(self)
+        self.component.unregisterJid(self)
+
+    def messageHandlerError(self, sess, mess):
+        """Handle incoming error messages from XMPP
+
+        @type sess: string
+        @type mess: Message
+        @param sess: session
+        @param mess: error message
+
+        """
+        text = ''
+        try:
+            text = mess.getTag('error').getTag('text').getData()
         except:
             pass
         erc = mess.getErrorCode()
@@ -867,29 +2221,38 @@ class ClientThread(Thread):
         text = mess.getBody()
         topic = mess.getSubject()
         
-        ts = ''
-        if mess.getTag('x',namespace=NS_DELAY):
-            ts=mess.getTimestamp()
-            if not ts:
-                ts=mess.setTimestamp()
-                ts=mess.getTimestamp()
-            ts = time.strptime(ts,'%Y%m%dT%H:%M:%S')
-            ts = datetime.datetime(*ts[:-3])
-        if not text and not topic:
-            return
+        ts = delayTime(mess)
 
         private = True
         if mess.getType() == 'groupchat':
             private = False
-        
+
+        batch = None
+        if not private and self.historyBatches:
+            # MUC history ends with the subject, or with live traffic when
+            # the room has none
+            room = jid.getStripped()
+            if ts is None or mess.getTag('subject') is not None:
+                self.endHistoryBatch(room)
+            elif unicode(room) in self.historyBatches:
+                batch = self.historyBatch(room)
+
+        if not text and not topic:
+            return
+
         MUC = self.mucs.has_key(jid.getStripped())
 
         if private:
+            if MUC:
+                self.rememberPeer(self.makeNickFromJID(jid, True), jid)
+            else:
+                self.rememberPeer(self.makeNickFromJID(jid, False), JID(jid.getStripped()))
             self.ircCommandPRIVMSG(jid, MUC, True, text, ts)
         elif topic:
             self.ircCommandTOPIC(jid, topic)
-        elif not jid.getResource() == self.nickname or ts:
-            self.ircCommandPRIVMSG(jid, True, False, text, ts)
+        elif not jid.getResource() == self.nickname or ts is not None:
+            self.ircCommandPRIVMSG(jid, True, False, text, ts, batch)
+            self.markDelivery(self.component.stanzaReceived)
 
 
     def iqHandler(self, con, iq):
@@ -900,36 +2263,22 @@ class ClientThread(Thread):
         @param con: XMPP Connection
         @param iq: XMPP Iq
         """
+        # replies to our own requests are routed by the component's
+        # IqTracker, only requests addressed to us end up here
+        if iq.getType() in ['result', 'error']:
+            self.printDebug('IQ reply %s from %s matches no request' % (iq.getID(), iq.getFrom()))
+            return
+
         ns = iq.getQueryNS()
         if ns is None:
             ns = iq.getProperties()[0]
 
-        if ns == NS_DISCO and iq.getType() in ['get', 'error']:
-            self.iqHandlerInfo(con, iq)
-        elif ns == NS_DISCO_ITEMS and iq.getType() == 'result':
-            self.iqHandlerItems(con, iq)
-        elif ns == NS_DISCO_INFO and iq.getType() == 'result':
+        if ns == NS_DISCO and iq.getType() == 'get':
             self.iqHandlerInfo(con, iq)
         elif ns == NS_DISCO_INFO and iq.getType() == 'get':
             self.xmppCommandINFOGET(iq.getFrom())
-        elif ns == NS_DISCO_ITEMS and iq.getType() == 'error':
-            self.iqHandlerError(con, iq)
-        elif ns == NS_DISCO_INFO and iq.getType() == 'error':
-            self.iqHandlerError(con, iq)
-        elif ns == NS_VCARD and iq.getType() == 'result':
-            self.iqHandlerVcard(con, iq)
-        elif ns == NS_VCARD and iq.getType() == 'error':
-            self.iqHandlerVcardError(con, iq)
-        elif ns == NS_LAST and iq.getType() == 'result':
-            self.iqHandlerLast(con, iq)
         elif ns == NS_LAST and iq.getType() == 'get':
             self.xmppCommandLASTACTIVITY(iq.getFrom())
-        elif ns == NS_LAST and iq.getType() == 'error':
-            self.iqHandlerLastError(con, iq)
-        elif ns == NS_VERSION and iq.getType() == 'result':
-            self.iqHandlerVersion(con, iq)
-        elif ns == NS_VERSION and iq.getType() == 'error':
-            self.iqHandlerVersionError(con, iq)
         elif ns == NS_VERSION and iq.getType() == 'get':
             self.xmppCommandSOFTWAREVERSION(iq.getFrom())
         else:
@@ -1024,62 +2373,48 @@ class ClientThread(Thread):
         @param iq: XMPP Iq
         """
         jid = iq.getFrom()
-        # this can mess things up, fix later
-        if self.roomPingQueue.has_key(jid):
-            del (self.roomPingQueue[jid])
         # room errors
         errornum = iq.getErrorCode()
-        if jid in self.mucs.keys():
-            if errornum == '404' and jid not in self.disconnectedMucs.keys():
-                self.ircCommandERRORMUC(404, 'MUC DISCONNECTED', jid)
-                self.ircCommandPRIVMSG(JID("%s/%s" % (jid, 'telepaatti')),
-                                       True,
-                                       False,
-                                       'MUC IS DISCONNECTED YOUR TEXT WILL NOT SHOW ON CHANNEL. YOU CAN WAIT UNTIL MUC CONNECTS AGAIN OR USE /PART TO LEAVE THIS MUC!',
-                                       timestamp='')
-                self.disconnectedMucs[jid] = 0
-                return
-            else:
-                return
+        if jid in self.mucs:
+            if errornum == '404':
+                self.component.roomLost(jid)
+            return
         else:
             self.ircCommandERROR('iq error num %s jid not room! jid %s' % (errornum, jid))
 
 
-    def iqHandlerItems(self, con, iq):
-        """Handle incoming XMPP with type Iq and items
+    def iqHandlerMucUsers(self, con, iq):
+        """Handle incoming XMPP with type Iq and the items of a MUC
 
         @type con: Connection
         @type iq: Iq
         @param con: XMPP Connection
         @param iq: XMPP Iq
         """
-
         jid = iq.getFrom()
-        if iq.getType() == 'error':
-            # some fixing is needed
-            self.ircCommandERROR('%s %s ' % (iq.getErrorCode(), iq.getErrorCode()))
-        elif iq.getID() == 'disco_muc_users':
-            ch = iq.getQueryChildren()
-            mucusers = list()
-            for c in ch:
-                name = c.getName()
-                if name == 'item':
-                    mucusers.append(JID(c.getAttrs()['jid']))
-            if self.mucs.has_key(jid):
-                pass # we keep track of users else where
-            self.ircCommandWHO(mucusers, jid)
-            return
-        elif iq.getID() == 'disco_muc_rooms':
-            ch = iq.getQueryChildren()
-            channels = list()
-            for c in ch:
-                name = c.getName()
-                if name == 'item':
-                    channels.append(self.fixChannel(c.getAttrs()['jid']))
-            self.ircCommandLIST(channels)
-            return
-        else:
-            self.printDebug('UNKNOWN DISCO ITEM %s ' % jid)
+        ch = iq.getQueryChildren()
+        mucusers = list()
+        for c in ch:
+            name = c.getName()
+            if name == 'item':
+                mucusers.append(JID(c.getAttrs()['jid']))
+        self.ircCommandWHO(mucusers, jid)
+
+    def iqHandlerMucRooms(self, con, iq):
+        """Handle incoming XMPP with type Iq and the items of the MUC server
+
+        @type con: Connection
+        @type iq: Iq
+        @param con: XMPP Connection
+        @param iq: XMPP Iq
+        """
+        ch = iq.getQueryChildren()
+        channels = list()
+        for c in ch:
+            name = c.getName()
+            if name == 'item':
+                channels.append(self.fixChannel(c.getAttrs()['jid']))
+        self.ircCommandLIST(channels)
 
     def iqHandlerInfo(self, con, iq):
         """Handle incoming XMPP with type Iq and info
@@ -1090,10 +2425,6 @@ class ClientThread(Thread):
         @param iq: XMPP Iq
         """
         roomname = iq.getFrom()
-        # this can mess things up, fix
-        if self.roomPingQueue.has_key(roomname):
-            del (self.roomPingQueue[roomname])
-            return
 
         MUC = False
         roomfeats = list()
@@ -1177,26 +2508,13 @@ class ClientThread(Thread):
 
         room = JID(pres.getFrom().getStripped())
 
-        # for affiliation and role changes
-        if self.mucs.has_key(room) and \
-                nick in self.mucs[room].keys():
-            xrole = self.mucs[room][nick]['role']
-            xaffiliation = self.mucs[room][nick]['affiliation']
-            if role != xrole: # role has changed
-                giver = JID('%s/telepaatti' % room)
-                if role.upper() == 'MODERATOR':
-                    self.ircCommandMODEMUCUSER(giver, nick, '+o')
-                    self.ircCommandMODEMUCUSER(giver, nick, '-v')
-                if role.upper() == 'PARTICIPANT':
-                    self.ircCommandMODEMUCUSER(giver, nick, '-o')
-                    self.ircCommandMODEMUCUSER(giver, nick, '+v')
-                if role.upper() == 'VISITOR':
-                    self.ircCommandMODEMUCUSER(giver, nick, '-o')
-                    self.ircCommandMODEMUCUSER(giver, nick, '-v')
-                else:
-                    self.printDebug('MODE NONE')
-            if xaffiliation != affiliation: # affiliation has changed
-                pass
+        # occupant state is shared by every session in the room, the first
+        # copy of a presence updates it and reports changes to all of them
+        mucroom = self.component.getRoom(room)
+        if mucroom is not None and ptype != 'error':
+            if mucroom.updateOccupant(nick, ptype, role, affiliation, show, status,
+                                      pres.getStatusCode(), pres.getNick()):
+                self.component.scheduleModes(mucroom)
 
         # for nick changes
         if (pres.getNick() == self.newnick or pres.getNick() == self.nickname)\
@@ -1229,16 +2547,19 @@ class ClientThread(Thread):
             self.sendToIRC(':%s NICK :%s' %
                            (self.nickname,
                             self.newnick))
-            for muc in self.getMucs():
-                del (self.mucs[muc][JID("%s/%s" % (muc, self.nickname))]) # remove the old
-                # add the new
-                self.mucs[muc][JID("%s/%s" % (muc, self.newnick))] = { 'role': role,
-                                                                       'affiliation': affiliation }
+            # the shared rosters follow the nick change through the
+            # presences the MUCs send for it
             self.nickname = self.newnick
             self.newnick = ''
             return
 
+        joining = self.joinQueue.has_key(room)
+        inroom = self.mucs.has_key(room)
+
         if ptype == 'error':
+            if joining:
+                del (self.joinQueue[room])
+                self.component.leaveRoom(room, self)
             er = pres.getError()
             erc = pres.getErrorCode()
             if erc == '401':
@@ -1258,108 +2579,269 @@ class ClientThread(Thread):
             elif erc == '503':
                 self.ircCommandERRORMUC(471, 'MUC is full', room)
             else:
-                self.ircCommandERROR('MUC error not yet implemented (%d %s)' % (erc, er))
+                self.ircCommandERROR('MUC error not yet implemented (%s %s)' % (erc, er))
+        elif ptype == 'unavailable':
+            self.printDebug('unavailable')
+            if nick.getResource() == self.nickname:
+                self.printDebug('our self')
+                if joining:
+                    del (self.joinQueue[room])
+                    self.component.leaveRoom(room, self)
+                elif self.nickChangeInMucs.has_key(room):
+                    # between nick change
+                    self.printDebug('we are between nick change')
+                    return
+                elif inroom:
+                    self.endHistoryBatch(room)
+                    self.ircCommandPART(nick, ' left')
+                    del (self.mucs[room])
+                    self.component.leaveRoom(room, self)
+                else:
+                    line = "%s is doing something" % nick
+                    self.printDebug(line.encode('utf-8'))
+            elif joining:
+                self.printDebug("%s left while we are joining room %s" % (
+                    nick, room))
+            elif not inroom:
+                line = "%s is doing something" % nick
+                self.printDebug(line.encode('utf-8'))
+        else: # not unavailable type
+            self.printDebug('not unavailable')
+            if nick.getResource() == self.nickname:
+                if joining:
+                    self.mucs[room] = mucroom.occupants
+                    self.component.metrics.observe('xmppircd_join_seconds',
+                                                   time.time() - self.joinQueue[room]['started'])
+                    del(self.joinQueue[room])
+                    self.component.attachRoom(room, self)
+                    self.ircCommandSELFJOIN(room)
+                    self.startHistory(room)
+                    history = self.component.history
+                    if history is not None:
+                        records = history.latest(mucroom.name, self.component.options['join_backlog'])
+                        if records:
+                            self.replayHistory(room, records, self.historyBatch(room))
+                elif not inroom:
+                    line = "%s is doing something" % nick
+                    self.printDebug(line.encode('utf-8'))
+            elif not joining and not inroom and nick.getResource() != self.newnick:
+                self.printDebug('TROUBLE LINE')
+
+    def joinPresence(self, room, password):
+        """The presence joining a MUC as this session
+
+        @type room: string
+        @type password: string
+        @param room: bare JID of the room
+        @param password: password of the room, may be empty
+        @rtype: Presence
+        """
+        p=Presence(to='%s/%s' % (
+                room,
+                self.nickname))
+        p.setTag('x',namespace=NS_MUC).setTagData('password', password)
+        p.getTag('x').addChild('history', self.historyRequest(room))
+        return p
+
+    def historyRequest(self, room):
+        """Attributes of the history element of a MUC join. With a local
+        history store the backlog is replayed from disk, the MUC only sends
+        what the store does not have yet, and nothing at all if another
+        session is already in the room and storing its messages.
+
+        @type room: string
+        @param room: bare JID of the room
+        @rtype: dict
+        """
+        history = self.component.history
+        if history is None:
+            return {'maxchars': '10000', 'maxstanzas': '100'}
+        mucroom = self.component.getRoom(room)
+        if mucroom is not None and mucroom.sessions:
+            return {'maxstanzas': '0'}
+        last = history.lastTime(JID(room).getStripped())
+        if last:
+            return {'since': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last))}
+        return {'maxstanzas': str(self.component.options['join_backlog'])}
+
+    def replayHistory(self, room_jid, records, batch=None):
+        """Send stored groupchat messages to the IRC client
+
+        @type room_jid: JID
+        @type records: list
+        @type batch: string
+        @param room_jid: JID of the room
+        @param records: (time, nick, text) tuples from the HistoryStore
+        @param batch: id of the batch the messages belong to
+        """
+        for when, nick, text in records:
+            self.ircCommandPRIVMSG(JID('%s/%s' % (room_jid, nick)), True, False, text, when, batch)
+
+    def startHistory(self, room_jid):
+        """Open the window after a join in which history is expected, the
+        history of the join is sent in a single chathistory batch
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        self.endHistoryBatch(room_jid)
+        timer = self.loop.callLater(HISTORYWINDOW, self.historyWindowEnded, room_jid)
+        self.historyBatches[unicode(room_jid)] = [None, timer]
+
+    def historyBatch(self, room_jid):
+        """Id of the batch history of a room joined moments ago goes in, the
+        batch is started by its first message
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        @rtype: string
+        @return: batch id, None if the client did not enable batches
+        """
+        if 'batch' not in self.caps:
+            return None
+        pending = self.historyBatches[unicode(room_jid)]
+        if pending[0] is None:
+            pending[0] = 'h%d' % next(self.batchIds)
+            self.sendToIRC('BATCH +%s chathistory #%s' % (pending[0], self.channelName(room_jid)))
+        return pending[0]
+
+    def endHistoryBatch(self, room_jid):
+        """Close the history window of a room and its batch if one was sent
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        pending = self.historyBatches.pop(unicode(room_jid), None)
+        if pending is None:
+            return
+        pending[1].cancel()
+        if pending[0] is not None:
+            self.sendToIRC('BATCH -%s' % pending[0])
+
+    def historyWindowEnded(self, room_jid):
+        with self.component.lock:
+            self.endHistoryBatch(room_jid)
+
+    def ircCommandCAP(self, params):
+        """IRCv3 capability negotiation, registration waits for CAP END once
+        a client started negotiating
+
+        @type params: list
+        @param params: the CAP subcommand and its parameters
+        """
+        sub = ''
+        if params:
+            sub = params[0].upper()
+        nick = self.nickname or '*'
+        if sub in ('LS', 'REQ') and self.nickname is None:
+            self.capNegotiating = True
+        if sub == 'LS':
+            self.sendToIRC(':%s CAP %s LS :%s' % (self.server, nick, ' '.join(sorted(CAPABILITIES))))
+        elif sub == 'LIST':
+            self.sendToIRC(':%s CAP %s LIST :%s' % (self.server, nick, ' '.join(sorted(self.caps))))
+        elif sub == 'REQ':
+            requested = u''
+            if len(params) > 1:
+                requested = params[1]
+            names = requested.split()
+            if not names or [name for name in names if name.lstrip('-') not in CAPABILITIES]:
+                self.sendToIRC(':%s CAP %s NAK :%s' % (self.server, nick, requested))
+                return
+            for name in names:
+                if name.startswith('-'):
+                    self.caps.discard(name[1:])
+                else:
+                    self.caps.add(name)
+            self.sendToIRC(':%s CAP %s ACK :%s' % (self.server, nick, requested))
+        elif sub == 'END':
+            if self.capNegotiating:
+                self.capNegotiating = False
+                if self.nickname is not None:
+                    self.sendWelcome()
         else:
-            joining = self.joinQueue.has_key(room)
-            inroom = self.mucs.has_key(room)
-            if ptype == 'unavailable':
-                self.printDebug('unavailable')
-                if nick.getResource() == self.nickname:
-                    self.printDebug('our self')
-                    if joining:
-                        del (self.joinQueue[room])
-                    elif self.nickChangeInMucs.has_key(room):
-                        # between nick change
-                        self.printDebug('we are between nick change')
-                        return
-                    elif inroom:
-                        self.ircCommandPART(nick, ' left')
-                        if nick in self.mucs[room].keys():
-                            del (self.mucs[room])
-                    else:
-                        line = "%s is doing something" % nick
-                        self.printDebug(line.encode('utf-8'))
-                else: # someonerin else
-                    if joining:
-                        self.printDebug("%s left while we are joining room %s" % (
-                            nick, room))
-                    elif inroom:
-                        if pres.getStatusCode() == '303':
-                            self.changingNick[JID("%s/%s" % (nick.getStripped(), pres.getNick()))] = nick
-                        else:
-                            self.ircCommandPART(nick, 'left')
-
-                        del (self.mucs[room][nick])
-                    else:
-                        line = "%s is doing something" % nick
-                        self.printDebug(line.encode('utf-8'))
-            else: # not unavailable type
-                self.printDebug('not unavailable')
-                if nick.getResource() == self.nickname:
-                    if joining:
-                        # fix this also later
-                        self.mucs[room] = self.joinQueue[room]['users']
-                        self.mucs[room][JID("%s/%s" % (room, self.nickname))] = { 'role': role,
-                                                                                  'affiliation': affiliation,
-                                                                                  'show' : show,
-                                                                                  'status': status}
-                        del(self.joinQueue[room])
-                        self.ircCommandSELFJOIN(room)
-                    elif inroom:
-                        self.mucs[room][JID("%s/%s" % (room, self.nickname))] = { 'role': role,
-                                                                                  'affiliation': affiliation,
-                                                                                  'show' : show,
-                                                                                  'status': status}
-                    else:
-                        line = "%s is doing something" % nick
-                        self.printDebug(line.encode('utf-8'))
-                elif nick.getResource() == self.newnick:
-                    pass
-                else: # someone else
-                    if joining:
-                        if nick not in self.joinQueue[room]['users'].keys():
-                            self.joinQueue[room]['users'][nick] = { 'role': role,
-                                                                    'affiliation': affiliation,
-                                                                    'show' : show,
-                                                                    'status': status}
-                    elif inroom:
-                        new_user = nick not in self.mucs[room].keys()
-                        self.mucs[room][nick] = { 'role': role,
-                                      'affiliation': affiliation,
-                                      'show' : show,
-                                      'status': status }
-                        if nick in self.changingNick.keys():
-                            self.ircCommandNICK(self.changingNick[nick], nick)
-                        elif new_user:
-                            self.ircCommandJOIN(nick)
-                    else:
-                        self.printDebug('TROUBLE LINE')
+            self.sendToIRC(':%s 410 %s %s :Invalid CAP command' % (self.server, nick, sub))
 
-    def commandHandler(self, data):
-        """Command handler for commands and text coming in from IRC-client
+    def ircCommandCHATHISTORY(self, arguments):
+        """IRCv3 CHATHISTORY from the local history store, only timestamp
+        message references are supported
 
-        @type data: string
-        @param data: IRC data coming from IRC-client
+        @type arguments: string
+        @param arguments: the command arguments
         """
-        self.printDebug('got ircline: %s' % data)
-        # utf-8 test
+        history = self.component.history
+        args = arguments.split()
+        if history is None or len(args) < 3:
+            self.sendToIRC('FAIL CHATHISTORY INVALID_PARAMS %s :Invalid parameters' % (args[:1] or ['*'])[0])
+            return
+        sub = args[0].upper()
+        target = args[1]
+        if sub not in ('LATEST', 'BEFORE', 'AFTER', 'AROUND', 'BETWEEN'):
+            self.sendToIRC('FAIL CHATHISTORY INVALID_PARAMS %s :Unknown subcommand' % sub)
+            return
+        room = None
+        if target.startswith('#'):
+            room = self.fixChannelCommand(target).lower()
+        if room is None or room not in self.mucs:
+            self.sendToIRC('FAIL CHATHISTORY INVALID_TARGET %s %s :Messages could not be retrieved' % (sub, target))
+            return
+        times = list()
         try:
-            unicode(data, 'utf-8')
-        except exceptions.UnicodeDecodeError:
-            self.printError('Unicode decode error. Your IRC client is (probably) not writing utf-8')
-            self.ircCommandERROR('Input form IRC client was not in utf-8. Turn utf-8 support on from your IRC client or input only pure ascii',-1)
+            limit = min(int(args[-1]), CHATHISTORYLIMIT)
+            for ref in args[2:-1]:
+                if sub == 'LATEST' and ref == '*':
+                    times.append(None)
+                elif ref.startswith('timestamp='):
+                    when = parseStamp(ref[10:])
+                    if when is None:
+                        raise ValueError(ref)
+                    times.append(when)
+                else:
+                    self.sendToIRC('FAIL CHATHISTORY INVALID_MSGREFTYPE %s %s :Only timestamp references are supported' % (sub, target))
+                    return
+        except ValueError:
+            self.sendToIRC('FAIL CHATHISTORY INVALID_PARAMS %s :Invalid parameters' % sub)
             return
+        if len(times) != (sub == 'BETWEEN' and 2 or 1):
+            self.sendToIRC('FAIL CHATHISTORY INVALID_PARAMS %s :Invalid parameters' % sub)
+            return
+        name = JID(room).getStripped()
+        if sub == 'LATEST':
+            records = history.latest(name, limit, times[0])
+        elif sub == 'BEFORE':
+            records = history.before(name, times[0], limit)
+        elif sub == 'AFTER':
+            records = history.after(name, times[0], limit)
+        elif sub == 'AROUND':
+            records = history.around(name, times[0], limit)
+        else:
+            records = history.between(name, times[0], times[1], limit)
+        batch = None
+        if 'batch' in self.caps:
+            batch = 'h%d' % next(self.batchIds)
+            self.sendToIRC('BATCH +%s chathistory %s' % (batch, target))
+        self.replayHistory(JID(room), records, batch)
+        if batch is not None:
+            self.sendToIRC('BATCH -%s' % batch)
+
+    def commandHandler(self, msg):
+        """Command handler for commands and text coming in from IRC-client
+
+        @type msg: IRCMessage
+        @param msg: parsed IRC line coming from IRC-client
+        """
+        data = msg.line
+        self.printDebug('got ircline: %s' % data)
 
-        args = data.split(' ', 1)
-        arguments = u''
-        command = args[0].upper()
-        if len(args) == 2:
-            arguments = args[1]
-        arguments = arguments.strip()
+        command = msg.command
+        arguments = msg.arguments.strip()
         MUC = arguments.startswith('#')
         if MUC:
             arguments = self.fixChannelCommand(arguments)
             
+        if command == 'CAP':
+            self.ircCommandCAP(msg.params)
+            return
+
         if self.nickname is None:
             if command == 'NICK':
                 nick = ''
@@ -1390,17 +2872,14 @@ class ClientThread(Thread):
                 room = "%s@%s" % (room, self.muc_server)
 
             room = room.lower() # todo: is this valid?
-            if room in self.mucs.keys(): # already in MUC
+            if room in self.mucs: # already in MUC
+                return
+            if not self.component.isConnected():
+                self.ircCommandERRORMUC(437, 'XMPP server disconnected, try again later', JID(room))
                 return
             self.printDebug("Joining room: %s" % JID(room))
-            self.joinQueue[JID(room)] = {'messages': list(),
-                            'users': {}}
-            p=Presence(to='%s/%s' % (
-                    room,
-                    self.nickname))
-            p.setTag('x',namespace=NS_MUC).setTagData('password', password)
-            p.getTag('x').addChild('history',{'maxchars':'10000','maxstanzas':'100'})
-            self.sendToXMPP(p)
+            self.joinQueue[JID(room)] = {'started': time.time(), 'password': password}
+            self.component.requestJoin(JID(room), self, self.joinPresence(room, password))
 
         elif command == 'PART':
             x = arguments.find(' :')
@@ -1413,11 +2892,19 @@ class ClientThread(Thread):
                 room = JID(room.strip())
             else:
                 room = JID(arguments.strip())
-            if room not in self.mucs.keys(): # not in room
+            if room not in self.mucs: # not in room
                 return
             self.sendToXMPP(Presence(to='%s/%s' % (room, self.nickname),
                                      typ='unavailable',
                                      status=text))
+            self.component.partingRoom(room, self)
+            if not self.component.jc.connected:
+                # the leave waits for the reconnect and the MUC won't
+                # answer it, leave here so the room isn't joined again
+                self.endHistoryBatch(room)
+                self.ircCommandPART(JID('%s/%s' % (room, self.nickname)), text or 'left')
+                del (self.mucs[room])
+                self.component.leaveRoom(room, self)
 
         elif command == 'PRIVMSG':
             x = arguments.find(' :')
@@ -1475,7 +2962,7 @@ class ClientThread(Thread):
                 text = arguments[x+2:]
                 text = text.strip()
                 jid = JID(arguments[:x].strip())
-            if jid not in self.mucs.keys():
+            if jid not in self.mucs:
                 self.ircCommandERROR('', 403)
                 return
 
@@ -1551,6 +3038,43 @@ class ClientThread(Thread):
             # todo: handle list,of,channel,args?
             self.xmppCommandMUCROOMS()
             
+        elif command == 'OPER':
+            args = arguments.split(' ', 1)
+            oper = self.component.options['oper']
+            if oper is None:
+                self.sendToIRC(':%s 491 %s :No O-lines for your host' % (self.server, self.nickname))
+            elif len(args) == 2 and (args[0], args[1].lstrip(':')) == oper:
+                self.oper = True
+                self.sendToIRC(':%s 381 %s :You are now an IRC operator' % (self.server, self.nickname))
+            else:
+                self.sendToIRC(':%s 464 %s :Password incorrect' % (self.server, self.nickname))
+
+        elif command == 'STATS':
+            query = arguments[:1] or '*'
+            if not self.oper:
+                self.sendToIRC(':%s 481 %s :Permission Denied- You\'re not an IRC operator' % (self.server, self.nickname))
+                return
+            metrics = self.component.metrics
+            if query == 'm':
+                for name in sorted(IRCCOMMANDS):
+                    count = metrics.counter('xmppircd_irc_lines_in_total', ('command', name))
+                    if count:
+                        self.sendToIRC(':%s 212 %s %s %d' % (self.server, self.nickname, name, count))
+            else:
+                for name, value in metrics.samples():
+                    self.sendToIRC(':%s 249 %s :%s %s' % (self.server, self.nickname, name, value))
+            self.sendToIRC(':%s 219 %s %s :End of /STATS report' % (self.server, self.nickname, query))
+
+        elif command == 'CHATHISTORY':
+            self.ircCommandCHATHISTORY(arguments)
+
+        elif command == 'PING':
+            # room liveness is checked by the component, see probeRoom
+            self.sendToIRC('PONG %s' % (self.server))
+
+        elif command == 'PONG':
+            pass
+
         elif command == 'QUIT':
             self.connected = False
 
@@ -1571,6 +3095,30 @@ def usage():
     print "    --ssl\t SSL certificate. Enables ssl when provided"
     print "    --dh\t Diffie Hellman parameter file for SSL."
     print "    --log\t log file"
+    print "    --irc-loops\t number of event loop threads serving IRC sockets (default 1)"
+    print "    --sendq\t bytes queued for an IRC client before it is disconnected (default 1048576)"
+    print "    --oper\t name:password for the IRC OPER command, opers may use STATS"
+    print "    --metrics-port\t serve Prometheus metrics on http://127.0.0.1:PORT/metrics"
+    print "    --iq-timeout\t seconds to wait for the reply to an XMPP request (default 30)"
+    print "    --room-probe-interval\t seconds between checks that a joined MUC is alive (default 60)"
+    print "    --disco-ttl\t seconds MUC disco results for MODE, WHO and LIST are reused (default 60)"
+    print "    --disco-stale\t seconds expired disco results are still served while refetched (default 600)"
+    print "    --history-dir\t keep groupchat history in this directory and serve it with CHATHISTORY"
+    print "    --join-backlog\t messages of stored history replayed on join (default 50)"
+    print "    --mode-delay\t seconds MUC role changes are collected into combined MODE lines (default 0.25)"
+    print "    --tls-timeout\t seconds an IRC client has to finish the TLS handshake (default 10)"
+    print "    --flood\t per client limit of a command class as class:rate:burst, classes are"
+    print "    \t\t message, join, nick, mode and query, a rate of 0 is unlimited"
+    print "    --global-flood\t limit of a command class for all clients together as class:rate:burst"
+    print "    --backlog\t length of the listen queue of the IRC port (default 128)"
+    print "    --accept-rate\t new IRC connections accepted per second as rate:burst (default 20:50)"
+    print "    --max-pending\t IRC connections still registering before accepting pauses (default 100)"
+    print "    --max-joining\t MUC joins awaiting an answer before further joins wait (default 20)"
+    print "    --handoff\t unix socket a restarted gateway takes over the IRC connections through,"
+    print "             \t SIGUSR2 restarts the gateway this way"
+    print "    --fanout\t relay groupchat messages to all IRC users in a room from a single copy"
+    print "    --workers\t number of gateway processes sharing the IRC port, worker N connects as"
+    print "             \t component wN.<component-name> and serves metrics on metrics-port + N - 1"
 
 def main():
     port = 6667
@@ -1583,9 +3131,10 @@ def main():
     dh_param = None
     daemonize = False
     log_file = '/var/log/xmpp-ircd'
+    options = dict(DEFAULTOPTIONS)
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "s:P:m:p:h:d:c:C:", ["server=","server-port=","muc-server=","port=","help","daemonize","ssl=","dh=","component-name=","component-pass="])
+        opts, args = getopt.getopt(sys.argv[1:], "s:P:m:p:h:d:c:C:", ["server=","server-port=","muc-server=","port=","help","daemonize","ssl=","dh=","component-name=","component-pass=","irc-loops=","sendq=","oper=","metrics-port=","iq-timeout=","fanout","workers=","room-probe-interval=","disco-ttl=","disco-stale=","history-dir=","join-backlog=","mode-delay=","flood=","global-flood=","tls-timeout=","backlog=","accept-rate=","max-pending=","max-joining=","handoff="])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -1623,30 +3172,951 @@ def main():
             ssl_cert = a
         if o == "--dh":
             dh_param = a
+        if o == "--irc-loops":
+            try:
+                options['irc_loops'] = max(1, int(a))
+            except:
+                print "irc-loops should be an integer"
+                sys.exit()
+        if o == "--sendq":
+            try:
+                options['sendq'] = int(a)
+            except:
+                print "sendq should be an integer"
+                sys.exit()
+        if o == "--oper":
+            if ':' not in a:
+                print "oper should be name:password"
+                sys.exit()
+            options['oper'] = tuple(a.split(':', 1))
+        if o == "--metrics-port":
+            try:
+                options['metrics_port'] = int(a)
+            except:
+                print "metrics-port should be an integer"
+                sys.exit()
+        if o in ("--flood", "--global-flood"):
+            limits = options[o[2:].replace('-', '_')] = dict(options[o[2:].replace('-', '_')])
+            try:
+                name, rate, burst = a.split(':')
+                if name not in limits:
+                    raise ValueError(name)
+                limits[name] = (float(rate), max(1, int(burst)))
+            except ValueError:
+                print "%s should be class:rate:burst with class one of %s" % (o[2:], ', '.join(sorted(limits)))
+                sys.exit()
+        if o == "--history-dir":
+            if not os.path.isdir(a):
+                print "history-dir %s is not a directory" % a
+                sys.exit()
+            options['history_dir'] = os.path.abspath(a)
+        if o == "--join-backlog":
+            try:
+                options['join_backlog'] = int(a)
+            except:
+                print "join-backlog should be a number"
+                sys.exit()
+        if o in ("--disco-ttl", "--disco-stale", "--mode-delay", "--tls-timeout"):
+            try:
+                options[o[2:].replace('-', '_')] = float(a)
+            except:
+                print "%s should be a number" % o[2:]
+                sys.exit()
+        if o == "--room-probe-interval":
+            try:
+                options['room_probe_interval'] = float(a)
+            except:
+                print "room-probe-interval should be a number"
+                sys.exit()
+        if o == "--workers":
+            try:
+                options['workers'] = max(1, int(a))
+            except:
+                print "workers should be an integer"
+                sys.exit()
+        if o == "--fanout":
+            options['fanout'] = True
+        if o in ("--backlog", "--max-pending", "--max-joining"):
+            try:
+                options[o[2:].replace('-', '_')] = max(0, int(a))
+            except:
+                print "%s should be an integer" % o[2:]
+                sys.exit()
+        if o == "--handoff":
+            options['handoff'] = os.path.abspath(a)
+        if o == "--accept-rate":
+            try:
+                rate, burst = a.split(':')
+                options['accept_rate'] = (float(rate), max(1, int(burst)))
+            except ValueError:
+                print "accept-rate should be rate:burst"
+                sys.exit()
+        if o == "--iq-timeout":
+            try:
+                options['iq_timeout'] = float(a)
+            except:
+                print "iq-timeout should be a number"
+                sys.exit()
+    if options['handoff'] is not None and options['workers'] > 1:
+        print "handoff can't be used with workers"
+        sys.exit()
+    if options['history_dir'] is not None and options['workers'] > 1:
+        print "history-dir can't be used with workers"
+        sys.exit()
     if daemonize:
         with daemon.DaemonContext():
-            daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param)
+            daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param, options)
     else:
-        daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param)
+        daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param, options)
+
+class MucOccupant(object):
+    """A MUC room occupant, one per occupant in the room's roster"""
+
+    __slots__ = ('jid', 'nick', 'role', 'affiliation', 'show', 'status')
+
+    def __init__(self, jid, nick, role, affiliation, show, status):
+        self.jid = jid
+        self.nick = nick
+        self.role = role
+        self.affiliation = affiliation
+        self.show = show
+        self.status = status
+
+class MucRoom(object):
+    """Occupant state of a MUC room, kept once per gateway and shared by
+    every session joined to the room"""
+
+    def __init__(self, jid):
+        """Constructor for MucRoom class
+
+        @type jid: JID
+        @param jid: bare JID of the room
+        """
+        self.jid = jid
+        self.name = unicode(jid)
+        self.channel = self.name[0:self.name.find('@')]
+        # MucOccupant by full JID, keyed by the string as hashing and
+        # comparing JID objects parses them again
+        self.occupants = {}
+        # IRC nick to occupant JID, the reverse of occupants
+        self.nicks = {}
+        # rendered nick!user@host of every occupant, by full JID
+        self.prefixes = {}
+        self.sessions = []
+        # bare JIDs of the sessions, to tell if one is joined without a scan
+        self.sessionJids = set()
+        self.joining = []
+        self.changingNick = {}
+        # occupants whose roles changed since the last flush, by full JID,
+        # to (JID, role before the first change, joined since)
+        self.pendingModes = collections.OrderedDict()
+        self.modeTimer = None
+        # liveness as seen by the component's probes
+        self.alive = True
+        self.probe = None
+        # sessions joining again after a component reconnect, and until the
+        # first of them is back the occupants the MUC hasn't listed again
+        self.rejoining = []
+        self.stale = None
+
+    def isEmpty(self):
+        """Tell if no session is joined to or joining this room"""
+        return not self.sessions and not self.joining
+
+    def unchanged(self, pres):
+        """Tell if a presence repeats what the roster already has for a
+        present occupant, like the copies of a change sent to the other
+        sessions in the room or a show or status the occupant sent again
+
+        @type pres: Presence
+        @param pres: presence from the room
+        @rtype: boolean
+        """
+        if pres.getType() is not None:
+            return False
+        occupant = self.occupants.get(unicode(pres.getFrom()))
+        if occupant is None or pres.getStatusCode() is not None:
+            return False
+        return occupant.role == pres.getRole() and occupant.affiliation == pres.getAffiliation() \
+            and occupant.show == pres.getShow() and occupant.status == pres.getStatus()
+
+    def addOccupant(self, jid, role, affiliation, show, status):
+        """Add an occupant to the roster without telling the sessions
+
+        @type jid: JID
+        @param jid: occupant JID
+        """
+        key = unicode(jid)
+        nick = fixNick(jid.getResource())
+        self.occupants[key] = MucOccupant(jid, nick, role, affiliation, show, status)
+        self.nicks[nick] = jid
+        self.prefixes[key] = '%s!%s' % (nick, makeHostFromJID(jid))
+
+    def exportState(self):
+        """The roster in a form json can carry to another process
+
+        @rtype: dict
+        """
+        return {'jid': self.name,
+                'alive': self.alive,
+                'occupants': [(unicode(o.jid), o.role, o.affiliation, o.show, o.status)
+                              for o in self.occupants.itervalues()]}
+
+    def takeModes(self):
+        """Collect the net user mode changes of the roles changed since the
+        last call, an occupant whose role went back and forth has none
+
+        @rtype: list
+        @return: (sign, mode, nick, jid, joined) tuples
+        """
+        changes = list()
+        for key, (jid, before, joined) in self.pendingModes.iteritems():
+            occupant = self.occupants.get(key)
+            if occupant is None:
+                continue
+            old = ROLEMODES.get(before, '')
+            new = ROLEMODES.get(occupant.role, '')
+            for mode in new:
+                if mode not in old:
+                    changes.append(('+', mode, occupant.nick, occupant.jid, joined))
+            for mode in old:
+                if mode not in new:
+                    changes.append(('-', mode, occupant.nick, occupant.jid, joined))
+        self.pendingModes.clear()
+        return changes
+
+    def updateOccupant(self, jid, ptype, role, affiliation, show, status, statuscode, newnick):
+        """Apply an occupant presence to the roster and report what changed to
+        the joined sessions. Every session in the room receives its own copy of
+        the presence, only the first one finds something to change.
+
+        @type jid: JID
+        @type ptype: string
+        @param jid: occupant JID the presence is from
+        @param ptype: presence type
+        @rtype: boolean
+        @return: whether user mode changes were queued for flushModes
+        """
+        key = unicode(jid)
+        if ptype == 'unavailable':
+            occupant = self.occupants.pop(key, None)
+            if occupant is None:
+                return False
+            self.pendingModes.pop(key, None)
+            nick = occupant.nick
+            if self.nicks.get(nick) is occupant.jid:
+                del (self.nicks[nick])
+            for session in self.sessions:
+                session.forgetPeer(jid)
+            if statuscode == '303':
+                # the old prefix is still needed for the NICK line
+                self.changingNick[u'%s/%s' % (self.name, newnick)] = jid
+                return False
+            for session in self.sessions:
+                if not session.ownsOccupant(jid):
+                    session.ircCommandPART(jid, 'left')
+            self.prefixes.pop(key, None)
+            return False
+
+        occupant = self.occupants.get(key)
+        if occupant is None:
+            self.addOccupant(jid, role, affiliation, show, status)
+            old_jid = self.changingNick.pop(key, None)
+            for session in self.sessions:
+                if session.ownsOccupant(jid) or (old_jid is not None and session.ownsOccupant(old_jid)):
+                    continue
+                if old_jid is not None:
+                    session.ircCommandNICK(old_jid, jid)
+                else:
+                    session.ircCommandJOIN(jid)
+            if old_jid is not None:
+                self.prefixes.pop(unicode(old_jid), None)
+            elif self.sessions and role in ROLEMODES:
+                self.pendingModes[key] = (jid, 'none', True)
+                return True
+            return False
+        old_role = occupant.role
+        occupant.role = role
+        occupant.affiliation = affiliation
+        occupant.show = show
+        occupant.status = status
+        if old_role != role and self.sessions: # role has changed
+            if key not in self.pendingModes:
+                self.pendingModes[key] = (jid, old_role, False)
+            return True
+        return False
+
+class PendingIq(object):
+    """An IQ request waiting for its reply"""
+
+    __slots__ = ('session', 'to', 'onResult', 'onError', 'onTimeout', 'onCancel', 'metric', 'sent', 'timer')
+
+    def __init__(self, session, to, onResult, onError, onTimeout, onCancel, metric):
+        self.session = session
+        self.to = to
+        self.onResult = onResult
+        self.onError = onError
+        self.onTimeout = onTimeout
+        self.onCancel = onCancel
+        self.metric = metric
+        self.sent = time.time()
+        self.timer = None
+
+class IqTracker(object):
+    """Outgoing IQ requests of all sessions, keyed by a generated id so a
+    reply finds its request with a single lookup. Requests that get no reply
+    expire after a timeout."""
+
+    def __init__(self, component, timeout):
+        """Constructor for IqTracker class
+
+        @type component: XmppComponent
+        @type timeout: float
+        @param component: component the requests are sent through
+        @param timeout: seconds to wait for a reply
+        """
+        self.component = component
+        self.timeout = timeout
+        self.prefix = 'iq%s-' % component.randomLocalpart(8)
+        self.counter = 0
+        self.pending = {}
+        self.sessions = {}
+
+    def request(self, session, iq, onResult, onError=None, onTimeout=None, metric=None, onCancel=None):
+        """Send an IQ request for a session and route the reply to a callback
+
+        @type session: ClientSession
+        @type iq: Iq
+        @type onResult: function
+        @type onError: function
+        @type onTimeout: function
+        @type metric: string
+        @type onCancel: function
+        @param session: session sending the request
+        @param iq: the request, its id is replaced
+        @param onResult: called with (con, iq) for a result
+        @param onError: called with (con, iq) for an error, onResult if None
+        @param onTimeout: called without arguments when no reply came in time
+        @param metric: histogram to record the round trip time in
+        @param onCancel: called without arguments when the session goes away
+                         before the reply came
+        @rtype: string
+        @return: id of the request
+        """
+        self.counter += 1
+        iqid = '%s%d' % (self.prefix, self.counter)
+        iq.setID(iqid)
+        pending = PendingIq(session, unicode(iq.getTo()).lower(), onResult,
+                            onError or onResult, onTimeout, onCancel, metric)
+        pending.timer = self.component.loop.callLater(self.timeout, self.expire, iqid)
+        self.pending[iqid] = pending
+        self.sessions.setdefault(session, set()).add(iqid)
+        session.sendToXMPP(iq)
+        return iqid
+
+    def forget(self, iqid, pending):
+        del (self.pending[iqid])
+        pending.timer.cancel()
+        ids = self.sessions.get(pending.session)
+        if ids is not None:
+            ids.discard(iqid)
+            if not ids:
+                del (self.sessions[pending.session])
+
+    def dispatch(self, con, iq):
+        """Hand a result or error to the request it answers
+
+        @type con: Connection
+        @type iq: Iq
+        @param con: XMPP Connection
+        @param iq: XMPP Iq
+        @rtype: boolean
+        @return: False if the iq answers no pending request
+        """
+        iqid = iq.getID()
+        pending = self.pending.get(iqid)
+        # a reply has to come from where the request went
+        if pending is None or unicode(iq.getFrom()).lower() != pending.to:
+            return False
+        self.forget(iqid, pending)
+        if pending.metric is not None:
+            self.component.metrics.observe(pending.metric, time.time() - pending.sent)
+        if iq.getType() == 'error':
+            pending.onError(con, iq)
+        else:
+            pending.onResult(con, iq)
+        return True
+
+    def expire(self, iqid):
+        """Give up on a request, runs on the component's loop"""
+        with self.component.lock:
+            pending = self.pending.get(iqid)
+            if pending is None:
+                return
+            self.forget(iqid, pending)
+            self.component.metrics.inc('xmppircd_iq_timeouts_total')
+            pending.session.printDebug('IQ %s to %s timed out' % (iqid, pending.to))
+            if pending.onTimeout is not None:
+                pending.onTimeout()
+
+    def cancelSession(self, session):
+        """Drop the pending requests of a session that goes away
+
+        @type session: ClientSession
+        @param session: the session
+        """
+        cancelled = list()
+        for iqid in self.sessions.pop(session, ()):
+            pending = self.pending.pop(iqid)
+            pending.timer.cancel()
+            if pending.onCancel is not None:
+                cancelled.append(pending.onCancel)
+        for onCancel in cancelled:
+            onCancel()
+
+class HistoryStore(object):
+    """Groupchat history kept on disk, one append only log per room and
+    next to it an index of fixed size (time, offset) records in time order,
+    so any point in time is found with a binary search over the index"""
+
+    RECORD = struct.Struct('!dQ')
+
+    def __init__(self, directory, logger):
+        """Constructor for HistoryStore class
+
+        @type directory: string
+        @type logger: Logger
+        @param directory: directory the room logs are kept in
+        @param logger: logger for file errors
+        """
+        self.directory = directory
+        self.logger = logger
+        # room name to [log, index, records, last time, (nick, text) at last time]
+        self.files = {}
+
+    def open(self, name):
+        files = self.files.get(name)
+        if files is None:
+            path = os.path.join(self.directory, urllib.quote(name.lower().encode('utf-8'), safe='@.-_'))
+            log = open(path + '.log', 'a+b')
+            index = open(path + '.idx', 'a+b')
+            index.seek(0, os.SEEK_END)
+            size = index.tell()
+            count = size // self.RECORD.size
+            if size % self.RECORD.size:
+                # a record cut short by a crash
+                index.truncate(count * self.RECORD.size)
+            last = 0.0
+            if count:
+                index.seek((count - 1) * self.RECORD.size)
+                last = self.RECORD.unpack(index.read(self.RECORD.size))[0]
+            files = self.files[name] = [log, index, count, last, set()]
+            if count:
+                # what was stored at the last time, MUC history since then
+                # repeats it
+                for when, nick, text in self.read(files, self.find(files, last), count):
+                    files[4].add((nick, text))
+        return files
+
+    def close(self, name):
+        """Close the files of a room nobody is in anymore
+
+        @type name: unicode
+        @param name: bare JID of the room
+        """
+        files = self.files.pop(name, None)
+        if files is not None:
+            files[0].close()
+            files[1].close()
+
+    def append(self, name, when, nick, text, delayed=False):
+        """Store a groupchat message
+
+        @type name: unicode
+        @type when: float
+        @type nick: unicode
+        @type text: unicode
+        @type delayed: boolean
+        @param name: bare JID of the room
+        @param when: time the message was sent
+        @param nick: nick of the sender
+        @param text: the message
+        @param delayed: the message is MUC history, stored only if newer than
+        what is already there
+        @rtype: boolean
+        @return: whether the message was stored
+        """
+        files = self.open(name)
+        log, index, count, last, seen = files
+        if delayed and (when < last or (when == last and (nick, text) in seen)):
+            return False
+        if when > last:
+            seen.clear()
+            files[3] = when
+        else:
+            # keep the index sorted if the clock stepped back
+            when = last
+        seen.add((nick, text))
+        text = text.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+        log.seek(0, os.SEEK_END)
+        offset = log.tell()
+        try:
+            log.write((u'%.3f\t%s\t%s\n' % (when, nick, text)).encode('utf-8'))
+            log.flush()
+            index.write(self.RECORD.pack(when, offset))
+            index.flush()
+        except (IOError, OSError), e:
+            self.logger.error('Failed to store history of %s: %s' % (name, e))
+            return False
+        files[2] = count + 1
+        return True
+
+    def find(self, files, when, after=False):
+        """Position of the first record sent at or, with after, past a time"""
+        index = files[1]
+        lo, hi = 0, files[2]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            index.seek(mid * self.RECORD.size)
+            stamp = self.RECORD.unpack(index.read(self.RECORD.size))[0]
+            if stamp < when or (after and stamp == when):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read(self, files, first, last):
+        """Records first up to last as (time, nick, text), oldest first"""
+        if first >= last:
+            return []
+        index = files[1]
+        index.seek(first * self.RECORD.size)
+        offset = self.RECORD.unpack(index.read(self.RECORD.size))[1]
+        log = files[0]
+        log.seek(offset)
+        records = list()
+        for n in xrange(last - first):
+            line = log.readline()
+            if not line:
+                break
+            when, nick, text = line.decode('utf-8').rstrip(u'\n').split(u'\t', 2)
+            text = text.replace(u'\\\\', u'\0').replace(u'\\n', u'\n').replace(u'\\r', u'\r').replace(u'\0', u'\\')
+            records.append((float(when), nick, text))
+        return records
+
+    def latest(self, name, limit, when=None):
+        """The last messages of a room, or the last sent after a time
+
+        @type name: unicode
+        @type limit: int
+        @type when: float
+        @rtype: list
+        @return: (time, nick, text) tuples, oldest first
+        """
+        files = self.open(name)
+        first = max(0, files[2] - limit)
+        if when is not None:
+            first = max(first, self.find(files, when, True))
+        return self.read(files, first, files[2])
+
+    def before(self, name, when, limit):
+        files = self.open(name)
+        last = self.find(files, when)
+        return self.read(files, max(0, last - limit), last)
+
+    def after(self, name, when, limit):
+        files = self.open(name)
+        first = self.find(files, when, True)
+        return self.read(files, first, min(files[2], first + limit))
+
+    def around(self, name, when, limit):
+        files = self.open(name)
+        first = max(0, self.find(files, when) - limit // 2)
+        return self.read(files, first, min(files[2], first + limit))
+
+    def between(self, name, start, end, limit):
+        """Messages between two times, the ones closest to start when
+        there are more than limit
+
+        @rtype: list
+        @return: (time, nick, text) tuples, oldest first
+        """
+        files = self.open(name)
+        if start <= end:
+            first = self.find(files, start, True)
+            return self.read(files, first, min(self.find(files, end), first + limit))
+        last = self.find(files, start)
+        return self.read(files, max(self.find(files, end, True), last - limit), last)
+
+    def lastTime(self, name):
+        """Time of the newest stored message of a room, 0 if there is none"""
+        return self.open(name)[3]
+
+class DiscoCache(object):
+    """Component wide cache of disco#info and disco#items results. Fresh
+    results are served for disco_ttl seconds, after that they are served
+    while being refetched for up to disco_stale seconds more. Concurrent
+    queries for the same thing share a single request."""
+
+    # results kept at most, the oldest fetched go first
+    SIZE = 1024
+
+    def __init__(self, component, ttl, stale):
+        """Constructor for DiscoCache class
+
+        @type component: XmppComponent
+        @type ttl: float
+        @type stale: float
+        @param component: component the queries are sent through
+        @param ttl: seconds a result is fresh
+        @param stale: seconds a result may be served while refetching it
+        """
+        self.component = component
+        self.ttl = ttl
+        self.stale = stale
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+
+    def key(self, jid, ns):
+        return (unicode(jid).lower(), ns)
+
+    def query(self, session, jid, ns, onResult, onError=None, onTimeout=None):
+        """Answer a disco query from the cache or from the entity
+
+        @type session: ClientSession
+        @type jid: JID
+        @type ns: string
+        @param session: session asking, a request is sent as this session
+        @param jid: entity to query
+        @param ns: NS_DISCO_INFO or NS_DISCO_ITEMS
+        @param onResult: called with (con, iq) for the result
+        @param onError: called with (con, iq) for an error, onResult if None
+        @param onTimeout: called without arguments when no reply came in time
+        """
+        key = self.key(jid, ns)
+        entry = self.entries.get(key)
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.ttl:
+                self.component.metrics.inc('xmppircd_disco_cache_total', ('result', 'hit'))
+                onResult(None, entry[1])
+                return
+            if age < self.ttl + self.stale:
+                self.component.metrics.inc('xmppircd_disco_cache_total', ('result', 'stale'))
+                onResult(None, entry[1])
+                self.fetch(session, jid, ns, key, None)
+                return
+            del (self.entries[key])
+        self.fetch(session, jid, ns, key, (session, onResult, onError or onResult, onTimeout))
+
+    def fetch(self, session, jid, ns, key, waiter):
+        """Send a query unless the same one is already waiting for a reply"""
+        inflight = self.inflight.get(key)
+        if inflight is not None and time.time() - inflight[0] < self.component.tracker.timeout:
+            if waiter is not None:
+                self.component.metrics.inc('xmppircd_disco_cache_total', ('result', 'coalesced'))
+                inflight[1].append(waiter)
+            return
+        if waiter is not None:
+            self.component.metrics.inc('xmppircd_disco_cache_total', ('result', 'miss'))
+        waiters = list()
+        if waiter is not None:
+            waiters.append(waiter)
+        self.send(session, jid, ns, key, waiters)
+
+    def send(self, session, jid, ns, key, waiters):
+        inflight = (time.time(), waiters)
+        self.inflight[key] = inflight
+        iq = protocol.Iq(to=jid,
+                         queryNS=ns,
+                         typ = 'get')
+        self.component.tracker.request(session, iq,
+                                       lambda con, iq: self.fetched(key, con, iq),
+                                       lambda con, iq: self.failed(key, con, iq),
+                                       lambda: self.expired(key),
+                                       metric='xmppircd_disco_rtt_seconds',
+                                       onCancel=lambda: self.cancelled(session, jid, ns, key, inflight))
+
+    def fetched(self, key, con, iq):
+        self.store(key, iq)
+        for session, onResult, onError, onTimeout in self.inflight.pop(key, (0, ()))[1]:
+            onResult(con, iq)
+
+    def failed(self, key, con, iq):
+        self.entries.pop(key, None)
+        for session, onResult, onError, onTimeout in self.inflight.pop(key, (0, ()))[1]:
+            onError(con, iq)
+
+    def expired(self, key):
+        for session, onResult, onError, onTimeout in self.inflight.pop(key, (0, ()))[1]:
+            if onTimeout is not None:
+                onTimeout()
+
+    def cancelled(self, session, jid, ns, key, inflight):
+        """The session a query was sent as went away, send it again as one
+        of the sessions still waiting for it"""
+        if self.inflight.get(key) is not inflight:
+            return
+        del (self.inflight[key])
+        waiters = [waiter for waiter in inflight[1] if waiter[0] is not session and waiter[0].connected]
+        if waiters:
+            self.send(waiters[0][0], jid, ns, key, waiters)
+
+    def store(self, key, iq):
+        """Remember a result
+
+        @type key: tuple
+        @type iq: Iq
+        @param key: key() of the query
+        @param iq: the result
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), iq)
+        while len(self.entries) > self.SIZE:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, jid, ns):
+        """Forget a result
+
+        @type jid: JID
+        @type ns: string
+        @param jid: the entity
+        @param ns: NS_DISCO_INFO or NS_DISCO_ITEMS
+        """
+        self.entries.pop(self.key(jid, ns), None)
+
+    def presenceSeen(self, pres, room):
+        """Forget what a MUC presence makes outdated, the occupant list when
+        someone joins or leaves and everything about a newly created room
+
+        @type pres: Presence
+        @type room: MucRoom
+        @param pres: presence from a room occupant
+        @param room: the room, None when no session is in it
+        """
+        x = pres.getTag('x', namespace=NS_MUC_USER)
+        if x is None:
+            return
+        jid = pres.getFrom()
+        room_jid = jid.getStripped()
+        for status in x.getTags('status'):
+            if status.getAttr('code') == '201':
+                self.invalidate(room_jid, NS_DISCO_INFO)
+                self.invalidate(jid.getDomain(), NS_DISCO_ITEMS)
+        if pres.getType() == 'unavailable' or room is None or unicode(jid) not in room.prefixes:
+            self.invalidate(room_jid, NS_DISCO_ITEMS)
+
+    def messageSeen(self, mess):
+        """Forget the info of a room that announces a configuration change
+
+        @type mess: Message
+        @param mess: groupchat message
+        """
+        x = mess.getTag('x', namespace=NS_MUC_USER)
+        if x is None:
+            return
+        for status in x.getTags('status'):
+            if status.getAttr('code') in CONFIGSTATUSCODES:
+                self.invalidate(mess.getFrom().getStripped(), NS_DISCO_INFO)
+                return
 
 class XmppComponent():
     """Class for Jabber connection thread"""
 
-    def __init__(self, client, logger):
+    def __init__(self, client, logger, options, domain=None):
         self.client = client
         self.logger = logger
+        self.options = options
+        # domain of the session JIDs, the component name
+        self.domain = domain or client.Server
         self.clients = {}
-
-        self.xmppSem = BoundedSemaphore(value=1)
+        self.excessSendqCount = 0
+        self.stanzaReceived = 0.0
+        self.metrics = Metrics()
+        self.metrics.addCollector(self.collectMetrics)
+        # MucRoom by bare room JID string, comparing JID keys is costly
+        self.rooms = {}
+        self.loop = None
+        self.tracker = IqTracker(self, options['iq_timeout'])
+        self.disco = DiscoCache(self, options['disco_ttl'], options['disco_stale'])
+        self.floodBuckets = makeBuckets(options['global_flood'])
+        # IRC connections accepted and not registered yet
+        self.registering = 0
+        # (session, room JID string) to the timeout of a join sent to a MUC
+        self.joinsInFlight = {}
+        # (room JID, session, presence) of joins waiting for one to finish
+        self.joinsWaiting = collections.deque()
+        self.history = None
+        if options['history_dir']:
+            self.history = HistoryStore(options['history_dir'], logger)
+
+        self.writer = XmppWriter(client, logger, self.metrics)
+        self.writer.start()
 
         self.startup_time = datetime.datetime.now().strftime("%c")
 
+        # function returning a new connected and authenticated component
+        # connection or None, used to reconnect when the connection is lost
+        self.connector = None
+        self.reconnectDelay = 0
+        self.lostAt = None
+        # unavailable presences of rooms left while disconnected
+        self.heldLeaves = list()
+
+        # sessions on other IRC loops and stanza dispatch share the room
+        # registry, only one of them may touch it at a time
+        self.lock = RLock()
+        self.attachClient(client)
+
+    def attachClient(self, client):
+        """Use a connected and authenticated component connection for the
+        stanzas of the gateway
+
+        @type client: Component
+        @param client: the component connection, None while there is none
+        """
+        self.client = client
+        self.writer.client = client
+        self.jc = JabberConnection(self, client)
+        if client is None:
+            return
         client.RegisterHandler('message', self.messageHandler)
         client.RegisterHandler('presence', self.presenceHandler)
         client.RegisterHandler('iq', self.iqHandler)
 
-        self.jt = JabberThread(client)
-        self.jt.start()
+    def start(self, loop):
+        """Start dispatching stanzas from the given event loop
+
+        @type loop: EventLoop
+        @param loop: loop that will read the component connection
+        """
+        self.loop = loop
+        if self.jc.connected:
+            loop.register(self.jc)
+
+    def isConnected(self):
+        """Tell if the component connection is still up"""
+        return self.jc.connected
+
+    def connectionLost(self):
+        """Keep the IRC sessions while the component connection is down and
+        connect it again, runs on the component's loop"""
+        with self.lock:
+            self.lostAt = time.time()
+            self.metrics.inc('xmppircd_xmpp_disconnects_total')
+            for session in self.clients.values():
+                session.xmppLost()
+        if self.connector is not None:
+            self.scheduleReconnect()
+
+    def scheduleReconnect(self):
+        """Try to reconnect after a delay doubling with every failed try"""
+        self.reconnectDelay = min(RECONNECTMAXDELAY, max(RECONNECTDELAY, self.reconnectDelay * 2))
+        # with jitter, so the workers of a gateway don't retry in lockstep
+        delay = self.reconnectDelay * random.uniform(0.5, 1.0)
+        self.logger.info('reconnecting the component in %.1f seconds' % (delay))
+        self.loop.callLater(delay, self.startReconnect)
+
+    def startReconnect(self):
+        thread = Thread(target=self.reconnect, name='XmppReconnect')
+        thread.daemon = True
+        thread.start()
+
+    def reconnect(self):
+        """Connect the component again, runs in a thread of its own as
+        connecting blocks"""
+        try:
+            client = self.connector()
+        except:
+            self.logger.exception('Component reconnect failed')
+            client = None
+        if client is None:
+            self.loop.callSoon(self.scheduleReconnect)
+        else:
+            self.loop.callSoon(self.reconnected, client)
+
+    def reconnected(self, client):
+        """Serve the new component connection, leave the rooms left
+        meanwhile and join the others again
+
+        @type client: Component
+        @param client: the new component connection
+        """
+        with self.lock:
+            self.attachClient(client)
+            self.loop.register(self.jc)
+            self.reconnectDelay = 0
+            self.metrics.inc('xmppircd_xmpp_reconnects_total')
+            self.logger.info('component reconnected after %.1f seconds' % (time.time() - self.lostAt))
+            for presence in self.heldLeaves:
+                self.writer.put(presence)
+            del self.heldLeaves[:]
+            for session in self.clients.values():
+                session.xmppBack()
+            self.rejoinRooms()
+
+    def rejoinRooms(self):
+        """Join every room again for every session in it after a reconnect,
+        through the join slots so the MUC service isn't flooded. The
+        occupants the MUC lists on the rejoins are compared with the roster
+        kept meanwhile, only what changed reaches the IRC clients."""
+        since = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.lostAt))
+        for room in self.rooms.values():
+            if not room.sessions:
+                continue
+            room.stale = set(room.occupants)
+            for session in room.sessions:
+                room.rejoining.append(session)
+                presence = Presence(to='%s/%s' % (room.name, session.nickname))
+                # what was said while the connection was down
+                presence.setTag('x', namespace=NS_MUC).addChild('history', {'since': since})
+                self.metrics.inc('xmppircd_rejoins_total')
+                self.joinsWaiting.append((room.jid, session, presence))
+        self.admitJoins()
+
+    def rejoinPresence(self, room, session, pres):
+        """Follow the rejoin of a room after a reconnect. The MUC lists the
+        occupants before the session's own presence, so once the first
+        session is back in the room the occupants not listed left while the
+        connection was down.
+
+        @type room: MucRoom
+        @type session: ClientSession
+        @type pres: Presence
+        @param room: the room being rejoined
+        @param session: session the presence is for
+        @param pres: presence from the room
+        """
+        occupant = pres.getFrom()
+        if room.stale is not None and pres.getType() is None:
+            room.stale.discard(unicode(occupant))
+        if session not in room.rejoining or not session.ownsOccupant(occupant):
+            return
+        room.rejoining.remove(session)
+        self.joinDone(room.jid, session)
+        if pres.getType() == 'error':
+            session.rejoinFailed(room.jid)
+        elif pres.getType() is None:
+            self.roomAlive(room.jid)
+            if room.stale is not None:
+                self.dropStale(room)
+
+    def dropStale(self, room):
+        """Remove the occupants a rejoin didn't list, except those of
+        sessions still rejoining the room
+
+        @type room: MucRoom
+        @param room: the rejoined room
+        """
+        stale = room.stale
+        room.stale = None
+        for key in stale:
+            occupant = room.occupants.get(key)
+            if occupant is None:
+                continue
+            if [s for s in room.rejoining if s.ownsOccupant(occupant.jid)]:
+                continue
+            room.updateOccupant(occupant.jid, 'unavailable', None, None, None, None, None, None)
 
     # https://tools.ietf.org/html/rfc6122#section-2.3
     def randomLocalpart(self, size=20, chars=string.ascii_lowercase + string.digits):
@@ -1654,12 +4124,12 @@ class XmppComponent():
 
     def registerJid(self, irc_client):
         nick = self.randomLocalpart()
-        bare_jid = "%s@%s" %(nick, irc_client.server)
-        #full_jid = "%s@%s/%s" %(nick, irc_client.server, 'telepaatti')
+        bare_jid = "%s@%s" %(nick, self.domain)
+        #full_jid = "%s@%s/%s" %(nick, self.domain, 'telepaatti')
         while bare_jid in self.clients:
             # generate new random until we come across an unused one
             nick = self.randomLocalpart()
-            bare_jid = "%s@%s" %(nick, irc_client.server)
+            bare_jid = "%s@%s" %(nick, self.domain)
 
         irc_client.bare_jid = bare_jid
         irc_client.JID = JID(bare_jid)
@@ -1672,19 +4142,305 @@ class XmppComponent():
         if irc_client.bare_jid in self.clients:
             del (self.clients[irc_client.bare_jid])
 
+    def sendqStats(self):
+        """Summarize the IRC send queues of all sessions
+
+        @rtype: dict
+        @return: session count, total and largest queued bytes, largest
+        queue seen and the number of Excess SendQ disconnects
+        """
+        depths = [c.sendqDepth() for c in self.clients.values()]
+        return {'sessions': len(depths),
+                'queued': sum(depths),
+                'largest': max(depths or [0]),
+                'peak': max([c.sendqPeak for c in self.clients.values()] or [0]),
+                'excess': self.excessSendqCount}
+
+    def collectMetrics(self):
+        """Sample the gauges exported with the metrics
+
+        @rtype: list
+        @return: list of (name, label, value)
+        """
+        sessions = self.clients.values()
+        stats = self.sendqStats()
+        gauges = [('xmppircd_sessions', None, len(sessions)),
+                  ('xmppircd_rooms', None, len(self.rooms)),
+                  ('xmppircd_sendq_bytes_total', None, stats['queued']),
+                  ('xmppircd_sendq_peak_bytes', None, stats['peak']),
+                  ('xmppircd_excess_sendq_total', None, stats['excess']),
+                  ('xmppircd_xmpp_queue_stanzas', None, len(self.writer.queue)),
+                  ('xmppircd_iq_pending', None, len(self.tracker.pending)),
+                  ('xmppircd_disco_cache_entries', None, len(self.disco.entries)),
+                  ('xmppircd_registrations_pending', None, self.registering),
+                  ('xmppircd_joins_in_flight', None, len(self.joinsInFlight)),
+                  ('xmppircd_joins_waiting', None, len(self.joinsWaiting)),
+                  ('xmppircd_rooms_lost', None, len([r for r in self.rooms.values() if not r.alive]))]
+        for session in sessions:
+            gauges.append(('xmppircd_sendq_bytes', ('session', session.nickname or session.bare_jid),
+                           session.sendqDepth()))
+        return gauges
+
+    def getRoom(self, room_jid):
+        """Return the shared state of a room, None when no session is in it
+
+        @type room_jid: JID
+        @param room_jid: bare JID of the room
+        @rtype: MucRoom
+        """
+        return self.rooms.get(unicode(room_jid))
+
+    def joinRoom(self, room_jid, irc_client):
+        """Register a session as joining a room
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        @param room_jid: bare JID of the room
+        @param irc_client: the joining session
+        """
+        room = self.rooms.get(unicode(room_jid))
+        if room is None:
+            room = self.rooms[unicode(room_jid)] = MucRoom(room_jid)
+        if irc_client not in room.joining:
+            room.joining.append(irc_client)
+        return room
+
+    def requestJoin(self, room_jid, irc_client, presence):
+        """Register a session as joining a room and send its join presence,
+        or queue it while max_joining joins are awaiting the MUC's answer so
+        a wave of reconnecting clients reaches the MUC service paced
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        @type presence: Presence
+        @param room_jid: bare JID of the room
+        @param irc_client: the joining session
+        @param presence: the join presence
+        """
+        self.joinRoom(room_jid, irc_client)
+        limit = self.options['max_joining']
+        if limit and len(self.joinsInFlight) >= limit:
+            self.metrics.inc('xmppircd_joins_queued_total')
+            self.joinsWaiting.append((room_jid, irc_client, presence))
+            return
+        self.sendJoin(room_jid, irc_client, presence)
+
+    def sendJoin(self, room_jid, irc_client, presence):
+        """Send a join presence and hold a join slot until the MUC answers,
+        or for iq_timeout seconds when it doesn't"""
+        key = (irc_client, unicode(room_jid))
+        if self.options['max_joining']:
+            self.joinsInFlight[key] = self.loop.callLater(self.options['iq_timeout'], self.joinExpired, key)
+        irc_client.sendToXMPP(presence)
+
+    def joinDone(self, room_jid, irc_client):
+        """Free the join slot of a session, the next waiting join is sent
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        """
+        timer = self.joinsInFlight.pop((irc_client, unicode(room_jid)), None)
+        if timer is not None:
+            timer.cancel()
+            self.admitJoins()
+
+    def joinExpired(self, key):
+        with self.lock:
+            if self.joinsInFlight.pop(key, None) is not None:
+                self.metrics.inc('xmppircd_join_timeouts_total')
+                self.admitJoins()
+
+    def admitJoins(self):
+        """Send waiting joins and rejoins while there are free join slots,
+        those of sessions that quit or left meanwhile are dropped"""
+        limit = self.options['max_joining']
+        while self.joinsWaiting and (not limit or len(self.joinsInFlight) < limit):
+            room_jid, irc_client, presence = self.joinsWaiting.popleft()
+            if irc_client.connected and (room_jid in irc_client.joinQueue or room_jid in irc_client.mucs):
+                self.sendJoin(room_jid, irc_client, presence)
+
+    def attachRoom(self, room_jid, irc_client):
+        """Move a session from joining to joined, it then receives occupant
+        updates for the room
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        """
+        self.joinDone(room_jid, irc_client)
+        room = self.rooms[unicode(room_jid)]
+        if irc_client in room.joining:
+            room.joining.remove(irc_client)
+        if irc_client not in room.sessions:
+            room.sessions.append(irc_client)
+            room.sessionJids.add(irc_client.bare_jid)
+        if room.probe is None:
+            room.probe = self.loop.callLater(self.options['room_probe_interval'], self.probeRoom, room)
+
+    def leaveRoom(self, room_jid, irc_client):
+        """Remove a session from a room, the room state is dropped with the
+        last session as nobody receives its presences anymore
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        """
+        self.joinDone(room_jid, irc_client)
+        room = self.rooms.get(unicode(room_jid))
+        if room is None:
+            return
+        if irc_client in room.joining:
+            room.joining.remove(irc_client)
+        if irc_client in room.sessions:
+            room.sessions.remove(irc_client)
+            room.sessionJids.discard(irc_client.bare_jid)
+        if room.isEmpty():
+            del (self.rooms[unicode(room_jid)])
+            if room.probe is not None:
+                room.probe.cancel()
+            if room.modeTimer is not None:
+                room.modeTimer.cancel()
+            if self.history is not None:
+                self.history.close(room.name)
+
+    def partingRoom(self, room_jid, irc_client):
+        """A session sent the presence leaving a room. The MUC stops sending
+        it the room's messages before its leave is confirmed, so the copies
+        of another session are relayed meanwhile
+
+        @type room_jid: JID
+        @type irc_client: ClientSession
+        """
+        room = self.rooms.get(unicode(room_jid))
+        if room is not None and irc_client in room.sessions:
+            room.sessions.remove(irc_client)
+            room.sessions.append(irc_client)
+
+    def scheduleModes(self, room):
+        """Send the queued user mode changes of a room once its mode_delay
+        window is over, so a wave of role changes ends up in a few MODE lines
+
+        @type room: MucRoom
+        @param room: room with pending mode changes
+        """
+        if room.modeTimer is not None:
+            return
+        if self.options['mode_delay'] <= 0 or self.loop is None:
+            self.flushModes(room)
+            return
+        room.modeTimer = self.loop.callLater(self.options['mode_delay'], self.modeDelayEnded, room)
+
+    def modeDelayEnded(self, room):
+        with self.lock:
+            room.modeTimer = None
+            if self.rooms.get(room.name) is room:
+                self.flushModes(room)
+
+    def flushModes(self, room):
+        """Send the pending user mode changes of a room to its sessions
+
+        @type room: MucRoom
+        @param room: the room
+        """
+        changes = room.takeModes()
+        if not changes:
+            return
+        self.metrics.inc('xmppircd_mode_batches_total')
+        for session in room.sessions:
+            session.ircCommandMODEROLES(room, changes)
+
+    def probeRoom(self, room):
+        """Check a room is alive with a disco#info query sent as one of its
+        IRC users, runs on the component's loop every room_probe_interval
+        seconds for as long as the room has sessions
+
+        @type room: MucRoom
+        @param room: the room to check
+        """
+        with self.lock:
+            if self.rooms.get(room.name) is not room:
+                return
+            room.probe = self.loop.callLater(self.options['room_probe_interval'], self.probeRoom, room)
+            if not room.sessions or not self.isConnected():
+                return
+            self.metrics.inc('xmppircd_room_probes_total')
+            iq = protocol.Iq(to=room.jid,
+                             queryNS=NS_DISCO_INFO,
+                             typ = 'get')
+            self.tracker.request(room.sessions[0], iq,
+                                 lambda con, iq: self.roomProbeAnswered(room.jid, iq),
+                                 lambda con, iq: self.roomProbeFailed(room.jid, iq),
+                                 lambda: self.roomLost(room.jid),
+                                 metric='xmppircd_disco_rtt_seconds')
+
+    def roomProbeAnswered(self, room_jid, iq):
+        """A room answered a probe, the answer is as good as a MODE query"""
+        self.disco.store(self.disco.key(room_jid, NS_DISCO_INFO), iq)
+        self.roomAlive(room_jid)
+
+    def roomProbeFailed(self, room_jid, iq):
+        """A room answered a probe with an error, only item-not-found
+        means it is gone"""
+        if iq.getErrorCode() == '404':
+            self.roomLost(room_jid)
+
+    def roomLost(self, room_jid):
+        """Tell the sessions in a room once that it stopped answering
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        room = self.getRoom(room_jid)
+        if room is None or not room.alive:
+            return
+        room.alive = False
+        self.logger.error('MUC %s is not answering' % (room.jid))
+        for session in room.sessions:
+            session.ircCommandMUCLOST(room.jid)
+
+    def roomAlive(self, room_jid):
+        """Tell the sessions in a lost room that it answers again
+
+        @type room_jid: JID
+        @param room_jid: JID of the room
+        """
+        room = self.getRoom(room_jid)
+        if room is None or room.alive:
+            return
+        room.alive = True
+        self.logger.info('MUC %s is answering again' % (room.jid))
+        for session in room.sessions:
+            session.ircCommandMUCBACK(room.jid)
+
     def send(self, msg):
-        """Sends message XMPP server
+        """Queues message for the XMPP writer. While the component is
+        disconnected stanzas are dropped, except for leaving rooms which is
+        done once it is back.
 
-        @type msg: string
+        @type msg: Protocol
         @param msg: message to send
         """
-        self.xmppSem.acquire()
-        self.client.send(msg)
-        self.xmppSem.release()
+        if not self.jc.connected:
+            if msg.getName() == 'presence' and msg.getType() == 'unavailable':
+                self.heldLeaves.append(msg)
+            else:
+                self.metrics.inc('xmppircd_stanzas_dropped_total', ('type', msg.getName()))
+            return
+        self.writer.put(msg)
 
     def messageHandler(self, sess, mess):
         self.logger.info("in messageHandler")
+        self.metrics.inc('xmppircd_stanzas_in_total', ('type', 'message'))
+        self.stanzaReceived = time.time()
         try:
+            if mess.getType() == 'groupchat':
+                self.disco.messageSeen(mess)
+                if self.history is not None:
+                    self.recordMessage(mess)
+            if self.options['fanout'] and mess.getType() == 'groupchat' \
+                    and delayStamp(mess) is None:
+                room = self.getRoom(mess.getFrom().getStripped())
+                if room is not None and room.sessions:
+                    self.fanoutMessage(sess, mess, room)
+                    return
             jid = mess.getTo()
             self.logger.info("jid %s, clients: %s" % (jid, self.clients))
             self.clients[jid].messageHandler(sess, mess)
@@ -1693,10 +4449,98 @@ class XmppComponent():
             pass
 
 
+    def recordMessage(self, mess):
+        """Store a groupchat message in the history, from the copy of the
+        first session joined to the room only
+
+        @type mess: Message
+        @param mess: groupchat message
+        """
+        text = mess.getBody()
+        if not text or mess.getSubject():
+            return
+        jid = mess.getFrom()
+        nick = jid.getResource()
+        if not nick:
+            return
+        room = self.getRoom(jid.getStripped())
+        if room is None or not room.sessions or mess.getTo() != room.sessions[0].bare_jid:
+            return
+        when = delayTime(mess)
+        if when is None:
+            self.history.append(room.name, time.time(), nick, text)
+        else:
+            self.history.append(room.name, when, nick, text, True)
+
+    def fanoutMessage(self, sess, mess, room):
+        """Relay a live groupchat message to every session joined to the
+        room from the copy of a single receiver, the first joined session.
+        The MUC still sends a copy to each occupant, the others are dropped
+        here before any per session work is done. The IRC lines are rendered
+        once for each variant the sessions need, differing in tags and
+        channel name, and the same bytes are queued for all sessions
+        needing it. A receiver kicked from the
+        room gets no more copies, this relies on the MUC's unavailable
+        presence for it, which removes it from the sessions, arriving before
+        the messages it misses. A parting session stops being the receiver
+        as soon as it sends its leave, see partingRoom.
+
+        @type sess: Connection
+        @type mess: Message
+        @type room: MucRoom
+        @param sess: XMPP Connection
+        @param mess: XMPP Message
+        @param room: the room the message was sent to
+        """
+        to = mess.getTo()
+        receiver = room.sessions[0]
+        if to != receiver.bare_jid:
+            if unicode(to) in room.sessionJids:
+                self.metrics.inc('xmppircd_fanout_dropped_total')
+                return
+            # not joined yet, it has to see its own copy
+            self.clients[to].messageHandler(sess, mess)
+            return
+        jid = mess.getFrom()
+        text = mess.getBody()
+        nick = jid.getResource()
+        if not text or not nick or mess.getTag('subject') is not None:
+            for session in list(room.sessions):
+                session.messageHandler(sess, mess)
+            return
+        prefix = receiver.makePrefixFromJID(jid, room)
+        lines = receiver.privmsgLines(text)
+        variants = {}
+        sent = 0
+        for session in list(room.sessions):
+            if session.historyBatches:
+                # live traffic ends the history of the room
+                session.endHistoryBatch(room.jid)
+            if nick == session.nickname:
+                continue
+            key = (session.messageTags(), session.channelName(room.jid, room))
+            data = variants.get(key)
+            if data is None:
+                data = variants[key] = ''.join(['%s:%s PRIVMSG #%s :%s\r\n' % (key[0], prefix, key[1], line)
+                                                for line in lines]).encode('utf-8')
+            session.queueToIRC(data)
+            session.markDelivery(self.stanzaReceived)
+            sent += 1
+        self.metrics.inc('xmppircd_irc_lines_out_total', ('command', 'PRIVMSG'), sent * len(lines))
+
     def presenceHandler(self, sess, mess):
         self.logger.info("in presenceHandler")
+        self.metrics.inc('xmppircd_stanzas_in_total', ('type', 'presence'))
         try:
+            room = self.getRoom(mess.getFrom().getStripped())
+            self.disco.presenceSeen(mess, room)
             jid = mess.getTo()
+            if room is not None and room.rejoining:
+                self.rejoinPresence(room, self.clients[jid], mess)
+            if room is not None and room.unchanged(mess) \
+                    and not self.clients[jid].ownsOccupant(mess.getFrom()):
+                self.metrics.inc('xmppircd_presence_unchanged_total')
+                return
             self.logger.info("jid %s, clients: %s" % (jid, self.clients))
             self.clients[jid].presenceHandler(sess, mess)
         except:
@@ -1705,7 +4549,12 @@ class XmppComponent():
 
     def iqHandler(self, sess, mess):
         self.logger.info("in iqHandler")
+        self.metrics.inc('xmppircd_stanzas_in_total', ('type', 'iq'))
         try:
+            if mess.getType() in ['result', 'error']:
+                if self.tracker.dispatch(sess, mess):
+                    return
+                self.metrics.inc('xmppircd_iq_unmatched_total')
             jid = mess.getTo()
             self.logger.info("jid %s, clients: %s" % (jid, self.clients))
             self.clients[jid].iqHandler(sess, mess)
@@ -1713,17 +4562,454 @@ class XmppComponent():
             self.logger.error("Unexpected error: %s" % sys.exc_info()[0])
             pass
 
-def daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param):
-    service = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    service.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    service.bind(("", port))
-    service.listen(1)
+    def exportState(self, sessions):
+        """The rooms and the given sessions in a form json can carry to the
+        gateway process taking over, see HandoffListener
+
+        @type sessions: list
+        @param sessions: ClientSessions whose sockets are handed over
+        @rtype: dict
+        """
+        return {'rooms': [room.exportState() for room in self.rooms.itervalues()],
+                'sessions': [session.exportState() for session in sessions]}
+
+    def importState(self, state, sockets, listener):
+        """Take over the rooms and sessions of the previous gateway process,
+        the sessions are spread over the listener's loops
+
+        @type state: dict
+        @type sockets: list
+        @type listener: IRCListener
+        @param state: what exportState returned there
+        @param sockets: client sockets in the order of the sessions
+        @param listener: listener the sessions would have been accepted on
+        """
+        with self.lock:
+            for data in state['rooms']:
+                room = self.rooms[data['jid']] = MucRoom(JID(data['jid']))
+                room.alive = data['alive']
+                for jid, role, affiliation, show, status in data['occupants']:
+                    room.addOccupant(JID(jid), role, affiliation, show, status)
+            loops = itertools.cycle(listener.loops)
+            for data, sock in zip(state['sessions'], sockets):
+                session = ClientSession(sock, listener.port, listener.component_name,
+                                        listener.muc_server, self)
+                session.restoreState(data)
+                loop = next(loops)
+                loop.callSoon(session.resume, loop)
+        self.logger.info('took over %d sessions in %d rooms' % (len(sockets), len(self.rooms)))
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the gateway metrics in the Prometheus text format on /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(port, metrics, logger):
+    """Serve metrics over HTTP on localhost from a thread of its own
+
+    @type port: integer
+    @type metrics: Metrics
+    @param port: local port to listen on
+    @param metrics: metrics to serve
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsRequestHandler)
+    server.metrics = metrics
+    thread = Thread(target=server.serve_forever, name='MetricsServer')
+    thread.daemon = True
+    thread.start()
+    logger.info("serving metrics on http://127.0.0.1:%s/metrics" % (port))
+    return server
+
+class TLSHandshake(object):
+    """The TLS handshake of a new IRC connection, driven by the IRC event
+    loop the connection is handed to so a slow or stalled client only holds
+    up itself. The ClientSession is started once the handshake is done."""
+
+    def __init__(self, listener, sock, loop):
+        """Constructor for TLSHandshake class
+
+        @type listener: IRCListener
+        @type sock: SSLSocket
+        @type loop: EventLoop
+        @param listener: listener the connection was accepted on
+        @param sock: nonblocking socket wrapped without a handshake
+        @param loop: loop that serves the connection
+        """
+        self.listener = listener
+        self.socket = sock
+        self.loop = loop
+        self.started = time.time()
+        self.timer = None
+        self.done = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def start(self):
+        """Start the handshake, runs on the loop thread"""
+        self.loop.register(self, EventLoop.READ)
+        self.timer = self.loop.callLater(self.listener.component.options['tls_timeout'], self.expire)
+        self.step()
+
+    def step(self):
+        """Continue the handshake as far as the socket allows"""
+        if self.done:
+            return
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.loop.modify(self, EventLoop.READ)
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.loop.modify(self, EventLoop.WRITE)
+            else:
+                self.fail('failed', e)
+            return
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.fail('failed', e)
+            return
+        self.finish()
+
+    def finish(self):
+        self.done = True
+        self.timer.cancel()
+        self.loop.unregister(self)
+        metrics = self.listener.component.metrics
+        metrics.observe('xmppircd_tls_handshake_seconds', time.time() - self.started)
+        metrics.inc('xmppircd_tls_handshakes_total', ('result', 'ok'))
+        listener = self.listener
+        session = ClientSession(self.socket, listener.port, listener.component_name,
+                                listener.muc_server, listener.component)
+        session.registering = True
+        session.start(self.loop)
+
+    def fail(self, result, error):
+        """Give up on the connection
+
+        @type result: string
+        @type error: Exception
+        @param result: failed or timeout, the metric label
+        @param error: what went wrong, None for a timeout or hang up
+        """
+        if self.done:
+            return
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.loop.unregister(self)
+        self.listener.component.metrics.inc('xmppircd_tls_handshakes_total', ('result', result))
+        self.listener.component.logger.info('Failed SSL handshake (%s): %s' % (result, error))
+        self.socket.close()
+        with self.listener.component.lock:
+            self.listener.component.registering -= 1
+
+    def expire(self):
+        self.fail('timeout', None)
+
+    def handleRead(self):
+        self.step()
+
+    def handleWrite(self):
+        self.step()
+
+    def handleClose(self):
+        self.fail('failed', None)
 
+class IRCListener(object):
+    """Accepts IRC connections on the listening socket and hands them to the
+    least loaded IRC event loop. Accepting pauses while over the accept rate
+    or with too many connections still registering, further clients then
+    wait in the listen backlog."""
+
+    def __init__(self, service, port, component_name, muc_server, component, ssl_ctx, loops):
+        """Constructor for IRCListener class
+
+        @type service: socket
+        @type loops: list
+        @param service: bound and listening socket
+        @param loops: EventLoops new sessions are spread across
+        """
+        self.service = service
+        self.service.setblocking(0)
+        self.port = port
+        self.component_name = component_name
+        self.muc_server = muc_server
+        self.component = component
+        self.ssl_ctx = ssl_ctx
+        self.loops = loops
+        # the listener is polled by the main loop
+        self.loop = loops[0]
+        self.acceptBucket = None
+        rate, burst = component.options['accept_rate']
+        if rate > 0:
+            self.acceptBucket = TokenBucket(rate, burst)
+        self.resumeTimer = None
+        if ssl_ctx is not None:
+            component.metrics.addCollector(self.collectMetrics)
+
+    def fileno(self):
+        return self.service.fileno()
+
+    def collectMetrics(self):
+        """TLS session cache counters, hits are resumed sessions
+
+        @rtype: list
+        @return: list of (name, label, value)
+        """
+        stats = self.ssl_ctx.session_stats()
+        return [('xmppircd_tls_sessions_total', ('kind', kind), stats[kind])
+                for kind in ('accept_good', 'hits', 'misses', 'timeouts')]
+
+    def pickLoop(self):
+        """Return the loop currently serving the fewest sockets"""
+        return min(self.loops, key=lambda loop: len(loop.handlers))
+
+    def admissionWait(self):
+        """Seconds until the next connection may be accepted, 0 if now
+
+        @rtype: float
+        """
+        if self.acceptBucket is not None:
+            wait = self.acceptBucket.wait(time.time())
+            if wait > 0:
+                self.component.metrics.inc('xmppircd_accept_paused_total', ('reason', 'rate'))
+                return wait
+        limit = self.component.options['max_pending']
+        if limit and self.component.registering >= limit:
+            self.component.metrics.inc('xmppircd_accept_paused_total', ('reason', 'pending'))
+            return ADMISSIONRETRY
+        return 0
+
+    def resume(self):
+        self.resumeTimer = None
+        self.loop.register(self)
+
+    def handleRead(self):
+        wait = self.admissionWait()
+        if wait > 0:
+            # stop polling the listener, the kernel holds new clients in
+            # the backlog meanwhile
+            self.loop.unregister(self)
+            self.resumeTimer = self.loop.callLater(wait, self.resume)
+            return
+        try:
+            (clientsocket, address) = self.service.accept()
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED, errno.EINTR):
+                self.component.logger.error('Failed accept: %s' % (e,))
+            return
+        if self.acceptBucket is not None:
+            self.acceptBucket.take()
+        with self.component.lock:
+            self.component.registering += 1
+        loop = self.pickLoop()
+        if self.ssl_ctx is not None:
+            clientsocket.setblocking(0)
+            try:
+                clientsocket = self.ssl_ctx.wrap_socket(clientsocket, server_side = True,
+                                                        do_handshake_on_connect = False)
+            except (ssl.SSLError, socket.error), e:
+                self.component.logger.error('Failed SSL setup: %s' % (e,))
+                clientsocket.close()
+                with self.component.lock:
+                    self.component.registering -= 1
+                return
+            loop.callSoon(TLSHandshake(self, clientsocket, loop).start)
+            return
+        clientsocket.setblocking(1)
+        session = ClientSession(clientsocket, self.port, self.component_name, self.muc_server, self.component)
+        session.registering = True
+        loop.callSoon(session.start, loop)
+
+    def handleWrite(self):
+        pass
+
+    def handleClose(self):
+        self.service.close()
+
+class HandoffListener(object):
+    """Listens on a unix socket for a restarted gateway process and hands it
+    the listening IRC socket, the sockets of the IRC clients and the state of
+    their sessions and rooms, so a restart disconnects nobody and no room is
+    joined again. The component connection is closed last, the new process
+    then connects it under the same name and the old one exits.
+
+    The state goes first as a length prefixed json document, then the file
+    descriptors, the listening socket first, then a single byte once the
+    component connection is closed."""
+
+    def __init__(self, path, listener, metrics_server, logger):
+        """Constructor for HandoffListener class
+
+        @type path: string
+        @type listener: IRCListener
+        @type metrics_server: HTTPServer
+        @param path: unix socket to listen on
+        @param listener: listener of the IRC port
+        @param metrics_server: metrics server to stop before exiting, None
+        if there is none
+        """
+        self.path = path
+        self.listener = listener
+        self.component = listener.component
+        self.metricsServer = metrics_server
+        self.logger = logger
+        if os.path.exists(path):
+            os.unlink(path)
+        self.service = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.service.bind(path)
+        self.service.listen(1)
+        self.service.setblocking(0)
+
+    def fileno(self):
+        return self.service.fileno()
+
+    def handleRead(self):
+        try:
+            (conn, address) = self.service.accept()
+        except socket.error, e:
+            return
+        self.logger.info('handing the IRC connections off to a new gateway process')
+        try:
+            conn.setblocking(1)
+            self.handOff(conn)
+        except:
+            self.logger.exception('Handoff failed')
+            os._exit(1)
+        self.logger.info('handoff done, exiting')
+        os._exit(0)
+
+    def handOff(self, conn):
+        """Hand everything over to the process connected on conn, the
+        connections are left open for it as this process exits
+
+        @type conn: socket
+        @param conn: blocking connection from the new process
+        """
+        component = self.component
+        listener = self.listener
+        if self.metricsServer is not None:
+            self.metricsServer.shutdown()
+            self.metricsServer.server_close()
+        # no session may read or write while its state is taken, this
+        # runs on the main loop, stop the others
+        for loop in listener.loops[1:]:
+            loop.callSoon(loop.stop)
+        for loop in listener.loops[1:]:
+            loop.join(HANDOFFTIMEOUT)
+        with component.lock:
+            sessions = list()
+            for session in component.clients.values():
+                if session.closed:
+                    continue
+                if isinstance(session.socket, ssl.SSLSocket):
+                    # the TLS state stays in this process, these clients
+                    # have to reconnect
+                    session.sendToIRC('ERROR :Closing Link: %s (Server restarting)' % (session.nickname or '*'))
+                    session.connected = False
+                    session.handleClose()
+                    continue
+                for room_jid in session.historyBatches.keys():
+                    session.endHistoryBatch(room_jid)
+                sessions.append(session)
+            # joins still waiting for a slot are sent, their answers go to
+            # the new process
+            while component.joinsWaiting:
+                room_jid, irc_client, presence = component.joinsWaiting.popleft()
+                if irc_client.connected and room_jid in irc_client.joinQueue:
+                    irc_client.sendToXMPP(presence)
+            for room in component.rooms.values():
+                if room.modeTimer is not None:
+                    room.modeTimer.cancel()
+                    component.flushModes(room)
+            state = json.dumps(component.exportState(sessions))
+        component.writer.stop()
+        component.writer.join(HANDOFFTIMEOUT)
+        component.writer.flush()
+        conn.sendall(struct.pack('!I', len(state)) + state)
+        for sock in [listener.service] + [session.socket for session in sessions]:
+            send_handle(conn, sock.fileno(), None)
+        component.jc.closeStream()
+        if component.history is not None:
+            for name in component.history.files.keys():
+                component.history.close(name)
+        conn.sendall('x')
+
+def recvAll(sock, size):
+    """Read exactly size bytes from a blocking socket
+
+    @type sock: socket
+    @type size: integer
+    @rtype: string
+    """
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'handoff connection closed')
+        data += chunk
+    return data
+
+def receiveHandoff(path, logger):
+    """Take over from the gateway process listening for a handoff on path,
+    see HandoffListener. Returns once that process has closed its component
+    connection.
+
+    @type path: string
+    @param path: unix socket of the running gateway
+    @rtype: tuple
+    @return: listening IRC socket, state of the rooms and sessions and the
+    client sockets, None if no gateway is listening on path
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error, e:
+        conn.close()
+        return None
+    logger.info('taking over from the gateway process on %s' % (path))
+    size = struct.unpack('!I', recvAll(conn, 4))[0]
+    state = json.loads(recvAll(conn, size))
+    sockets = list()
+    for i in xrange(len(state['sessions']) + 1):
+        fd = recv_handle(conn)
+        # fromfd gives the bare _socket type, ssl wants the wrapper
+        sockets.append(socket.socket(_sock=socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)))
+        os.close(fd)
+    recvAll(conn, 1)
+    conn.close()
+    return sockets[0], state, sockets[1:]
+
+def daemon_main(server, server_port, port, muc_server, component_name, component_pass, ssl_cert, dh_param, options):
     main_logger = logging.getLogger("main_logger")
     #main_logger.addHandler(logging.handlers.SysLogHandler(address = '/var/run/log'))
     main_logger.addHandler(logging.StreamHandler())
     main_logger.setLevel(10)
 
+    handoff = None
+    if options['handoff'] is not None:
+        handoff = receiveHandoff(options['handoff'], main_logger)
+    if handoff is not None:
+        service = handoff[0]
+    else:
+        service = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        service.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        service.bind(("", port))
+        service.listen(options['backlog'])
+
     main_logger.info("listening on port %s" % (port))
 
     ssl_ctx = None
@@ -1735,33 +5021,171 @@ def daemon_main(server, server_port, port, muc_server, component_name, component
             main_logger.info("Using DH parameter %s" % (dh_param))
             ssl_ctx.load_dh_params(dh_param)
         ssl_ctx.load_cert_chain(ssl_cert)
+        # resumed sessions skip the key exchange, OpenSSL's session cache and
+        # tickets are on by default, tickets also resume across workers as
+        # the forked workers share the ticket keys of this context
+
+    if options['workers'] > 1:
+        def serveWorker(worker):
+            worker_options = dict(options)
+            if options['metrics_port'] is not None:
+                worker_options['metrics_port'] = options['metrics_port'] + worker - 1
+            serveGateway(service, server, server_port, port, muc_server, component_name,
+                         'w%d.%s' % (worker, component_name), component_pass, ssl_ctx,
+                         main_logger, worker_options)
+        WorkerSupervisor(options['workers'], serveWorker, main_logger).run()
+    else:
+        serveGateway(service, server, server_port, port, muc_server, component_name,
+                     component_name, component_pass, ssl_ctx, main_logger, options, handoff)
+
+def connectComponent(server, server_port, component_name, component_pass, logger):
+    """Connect and authenticate the XMPP component
 
+    @rtype: Component
+    @return: the component connection, None if it failed
+    """
     client = Component(component_name, server_port)
 
     #client.connect(proxy={})
-    client.connect((server, server_port))
+    if not client.connect((server, server_port)):
+        logger.error('connecting component %s to %s:%s failed' % (component_name, server, server_port))
+        return None
 
     if not client.auth(component_name, component_pass):
-        main_logger.error('auth failed component: %s pass: %s' % (component_name, component_pass))
+        logger.error('auth failed component: %s pass: %s' % (component_name, component_pass))
+        return None
+    # a lost connection is handled by the gateway, the default handler
+    # raises from wherever it is noticed
+    client.UnregisterDisconnectHandler(client.DisconnectHandler)
+    return client
+
+def serveGateway(service, server, server_port, port, muc_server, server_name, component_name, component_pass, ssl_ctx, main_logger, options, handoff=None):
+    """Connect the component and serve IRC connections from the listening
+    socket until the main loop ends
+
+    @type service: socket
+    @type server_name: string
+    @type component_name: string
+    @type handoff: tuple
+    @param service: bound and listening IRC socket
+    @param server_name: name of the IRC server
+    @param component_name: name of the XMPP component, the domain of the
+    session JIDs
+    @param handoff: what receiveHandoff took over from the previous process
+    """
+    connector = lambda: connectComponent(server, server_port, component_name, component_pass, main_logger)
+    client = connector()
+    # the sessions of the previous process are kept even so
+    if client is None and handoff is None:
         return
 
-    component = XmppComponent(client, main_logger)
-
-    while (True):
-        (clientsocket, address ) = service.accept()
-        if ssl_ctx is not None:
+    component = XmppComponent(client, main_logger, options, component_name)
+    component.connector = connector
+
+    # the main loop reads the component connection, accepts connections and
+    # serves IRC sockets itself, any additional loops get a thread each
+    mainloop = EventLoop(main_logger, 'MainLoop')
+    component.start(mainloop)
+    if client is None:
+        # connect the way a lost connection is connected again
+        component.lostAt = time.time()
+        mainloop.callSoon(component.scheduleReconnect)
+    else:
+        main_logger.info("component %s ready" % (component_name))
+
+    metrics_server = None
+    if options['metrics_port'] is not None:
+        metrics_server = startMetricsServer(options['metrics_port'], component.metrics, main_logger)
+    loops = [mainloop]
+    for i in range(1, options['irc_loops']):
+        loop = EventLoop(main_logger, 'IRCLoop-%d' % i)
+        loop.start()
+        loops.append(loop)
+
+    listener = IRCListener(service, port, server_name, muc_server, component, ssl_ctx, loops)
+    if handoff is not None:
+        component.importState(handoff[1], handoff[2], listener)
+    mainloop.register(listener)
+    if options['handoff'] is not None:
+        mainloop.register(HandoffListener(options['handoff'], listener, metrics_server, main_logger))
+        def restart(signum, frame):
+            main_logger.info('starting a new gateway process to hand off to')
+            subprocess.Popen(RESTARTCOMMAND, close_fds=True)
+        signal.signal(signal.SIGUSR2, restart)
+    mainloop.run()
+
+class WorkerSupervisor(object):
+    """Forks the worker processes of the gateway and restarts the ones that
+    die. The workers inherit the listening socket and accept from it
+    concurrently, the kernel hands each connection to one of them."""
+
+    # seconds a worker has to live to be restarted right away
+    MINUPTIME = 5
+
+    def __init__(self, workers, serve, logger):
+        """Constructor for WorkerSupervisor class
+
+        @type workers: integer
+        @type serve: function
+        @param workers: number of worker processes
+        @param serve: function running a worker, called with its number
+        starting from 1
+        """
+        self.workers = workers
+        self.serve = serve
+        self.logger = logger
+        self.children = {}
+        self.running = True
+
+    def spawn(self, worker):
+        """Fork a worker process"""
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
             try:
-                clientsocket = ssl_ctx.wrap_socket(clientsocket, server_side = True)
+                self.serve(worker)
             except:
-                main_logger.error('Failed SSL handshake: %s - %s' % (sys.exc_info()[0], sys.exc_info()[1]))
-                try:
-                    clientsocket.shutdown(socket.SHUT_RDWR)
-                except socket.error:
-                    main_logger.error('Failed socket shutdown')
-                clientsocket.close()
+                self.logger.exception('worker %d failed' % (worker))
+                status = 1
+            os._exit(status)
+        self.children[pid] = (worker, time.time())
+        self.logger.info('started worker %d as pid %d' % (worker, pid))
+
+    def stop(self, signum, frame):
+        """Signal handler stopping all workers"""
+        self.running = False
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """Start the workers and keep them running until signalled"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in range(1, self.workers + 1):
+            self.spawn(worker)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                break
+            if pid not in self.children:
+                continue
+            worker, started = self.children.pop(pid)
+            if not self.running:
                 continue
-        ct = ClientThread(clientsocket, port, component_name, muc_server, component)
-        ct.start()
+            self.logger.error('worker %d (pid %d) exited with status %d, restarting' % (worker, pid, status))
+            if time.time() - started < self.MINUPTIME:
+                # don't fork in a tight loop when workers fail on startup
+                time.sleep(self.MINUPTIME)
+            if self.running:
+                self.spawn(worker)
 
 if __name__ == "__main__":
     main()